@@ -1,19 +1,62 @@
 # batchprocessing functions
 # created: Jan 15, 2024
 
-import configparser
 import os
 import re
-import shutil
+from concurrent.futures import FIRST_COMPLETED, wait
 
 import numpy as np
-import skimage
+import psutil
 
 # import pandas as pd
-import tifffile as tiff
-from joblib import Parallel, delayed
+from joblib import Parallel, delayed, effective_n_jobs
+from joblib.externals.loky import get_reusable_executor
 from natsort import natsorted
-from tqdm.contrib import tzip
+from tqdm import tqdm
+
+from user_friendly_downsampling_mip_stitch_batchprocess_code.batchprocessing_functions_v5 import (
+    MANIFEST_NAME,
+    PREFETCH_DEPTH,
+    PROJECTIONS,
+    TMP_PREFIX,
+    append_manifest,
+    copy_file,
+    count_stack_planes,
+    create_shared_array,
+    find_lsm_scope,
+    find_overflow_stacks,
+    find_stage_coords_n_pixel_width_from_2D_images,
+    get_mip_save_path,
+    img_stitcher_2D,
+    is_projection_output,
+    is_up_to_date,
+    load_manifest,
+    owned_boxes,
+    params_hash,
+    parse_codec,
+    parse_int_list,
+    parse_projections,
+    parse_slab,
+    parse_z_ranges,
+    place_tile_3D,
+    plan_stitch_3D,
+    probe_image_shape,
+    projections_params_hash,
+    relocate_manifest_outputs,
+    reorder_files_by_pos_tp,
+    save_image,
+    save_projections,
+    save_stitched_3D,
+    slab_ranges,
+    stitch_2D_single_timepoint,
+    stream_downscale_image,
+    stream_downscale_image_levels,
+    stream_image_to_ome_zarr,
+    stream_mip,
+    stream_projections,
+    update_acquisition_index,
+    walk_acquisition,
+)
 
 # from scipy.spatial import distance
 # import plotly.express as px
@@ -21,12 +64,16 @@ from tqdm.contrib import tzip
 ## CONSTANT
 # The pixel spacing in our LSM image is 1µm in the z axis, and  0.1625µm in the x and y axes.
 ZD, XD, YD = 1, 0.1625, 0.1625
-
-## Get global variables
-pos_max = 0
-img_h, img_w = 0, 0
-find_scope_flag = 0
-new_spacing = [0, 0, 0]
+# share of the RAM available at the start of a stage that its tasks may hold at once (see default_byte_budget)
+MEMORY_BUDGET_FRACTION = 0.7
+# memory of one task as a multiple of its image size (or of one plane for images streamed a few planes at a time)
+# the PREFETCH_DEPTH planes read ahead by the reader thread of every task (see prefetch) are added to each
+STREAM_WORKING_PLANES = 12 + PREFETCH_DEPTH  # plane read, planes queued for every level and the running MIPs
+MIP_WORKING_PLANES = 2 + PREFETCH_DEPTH  # the plane read and the running MIP (see stream_mip)
+# running max/min/argmax, float64 mean, squared deviations and their temporaries
+PROJECTION_WORKING_PLANES = 20 + PREFETCH_DEPTH
+STITCH_WORKING_COPIES = 8  # tiles, bg subtracted tiles, both stitched images and the float histogram matching
+STITCH_3D_BG_SUB_COPIES = 5  # the uint16 tile read and its float64 bg subtracted copy, the stitched image is shared
 
 ## Small Helping Functions
 
@@ -36,16 +83,18 @@ def check_create_save_path(save_path):
     save_path = os.path.normpath(save_path)
     if not os.path.exists(save_path):  # check if the dest exists
         print("Save path doesn't exist.")
-        os.makedirs(save_path)
+        os.makedirs(save_path, exist_ok=True)  # another worker can make it at the same time
         # print(f"Directory '{os.path.basename(save_path)}' created")
     # else:
     # print("Save path exists")
 
 
 def remove_non_image_files(big_list, root_path):
-    """removes dir and non-image(tiff) files from a list"""
+    """removes dir, non-image(tiff) and unfinished (temporary) files from a list"""
     small_list = []
     for val in big_list:
+        if val.startswith(TMP_PREFIX):  # still being written
+            continue
         if os.path.isfile(os.path.join(root_path, val)):  # file check
             filename_list = val.split(".")
             # og_name = filename_list[0]
@@ -68,39 +117,6 @@ def remove_non_csv_files(big_list, root_path):
     return small_list
 
 
-def reorder_files_by_pos_tp(file_list):
-    """reoders the file_list by pos and tp"""
-    file_list_arr = np.array(file_list)
-    global pos_max
-    raw_pos_arr = np.zeros_like(file_list_arr, dtype=int)
-    raw_tp_arr = np.zeros_like(file_list_arr, dtype=int)
-    for i, file_name in enumerate(file_list_arr):
-        raw_pos_arr[i], raw_tp_arr[i] = find_pos_tp_in_filename(file_name)
-    pos_max = np.max(raw_pos_arr)  # get pos_max
-    ind = np.lexsort((raw_pos_arr, raw_tp_arr))  # Sort by tp, then by pos
-    return file_list_arr[ind]
-
-
-def find_pos_tp_in_filename(file_name):
-    """finds the 'timepoint' and 'pos' in the filename (must be separated by '_')
-    Returns int: file_name_pos, file_name_tp"""
-    file_name_wo_ext = file_name.split(".")[0]
-    file_name_split_list = file_name_wo_ext.split("_")
-    file_name_pos, file_name_tp = -1, -1
-    for substr in file_name_split_list:
-        substr = substr.casefold()
-        if "pos" in substr:
-            file_name_pos = int(substr.removeprefix("pos"))
-        if "timepoint" in substr:
-            file_name_tp = int(substr.removeprefix("timepoint"))
-    if (file_name_pos == -1) or (file_name_tp == -1):
-        print(f"ParsingError: Couldn't find tp and pos from: {file_name}")
-        print("Exiting...")
-        exit()
-    else:
-        return (file_name_pos, file_name_tp)
-
-
 def find_nearest_target_file(start_path, target):
     """finds the target file in the directory tree starting from start_path, returns the path of the file if found, else None"""
     found_file_path = None
@@ -138,27 +154,106 @@ def find_multi_subdir(subdir_path, subdir_name):
 # Important functions
 
 
-def read_n_downscale_image(read_path, n):
-    """Reads the image from read_path and downscales it by a factor of n in x and y dimensions."""
-    # print(f"Reading: {read_path}")
-    img = tiff.imread(read_path)
-    # print(f"Shape of read image {img.shape}")
-    if len(img.shape) == 2:  # 2 dimensional image, e.g. BF image
-        # use a kernel of nxn, ds by a factor of n in x & y
-        img_downscaled = skimage.transform.downscale_local_mean(img, (n, n))
-    elif len(img.shape) == 3:  # image zstack
-        # use a kernel of 1xnxn, no ds in z
-        img_downscaled = skimage.transform.downscale_local_mean(img, (1, n, n))
-    else:
-        print("Can't process images with >3dimensions")
-        return None
-    # the downsampling algorithm produces float values,
-    # so recast the ds image to the original datatype
-    return np.round(img_downscaled).astype(img.dtype)
-
-
-def single_acquisition_downsample_parallel(acq_path, new_trg_path, n, num_cores):
-    """downsamples the images in the Acquisition folder at the acq_path and saves them in the new_trg_path"""
+def image_nbytes(read_path, plane_only=False):
+    """Returns: size in bytes of the tiff image (or of one plane of it if plane_only) at read_path once read, from its
+    header"""
+    img_shape, og_datatype = probe_image_shape(read_path)
+    return int(np.prod(img_shape[-2:] if plane_only else img_shape)) * og_datatype.itemsize
+
+
+def estimate_task_bytes(read_paths, working_copies, streamed=False):
+    """Returns: estimated memory in bytes of a task reading the tiff images at read_paths (a path or a list), i.e.
+    working_copies times their size from the headers, or times the size of one plane if the task streams them"""
+    read_paths = [read_paths] if isinstance(read_paths, str) else read_paths
+    return sum(image_nbytes(read_path, plane_only=streamed) for read_path in read_paths) * working_copies
+
+
+def default_byte_budget():
+    """Returns: MEMORY_BUDGET_FRACTION of the RAM available now, in bytes"""
+    return int(psutil.virtual_memory().available * MEMORY_BUDGET_FRACTION)
+
+
+def resolve_num_cores(num_cores):
+    """Returns: number of processes for num_cores, negative numbers count back from the number of CPUs like joblib
+    (-1 = all of them, -3 = all but 2), at least 1"""
+    return max(1, effective_n_jobs(num_cores))
+
+
+def memory_limited_n_jobs(num_cores, task_bytes, byte_budget=None):
+    """Returns: number of processes (at most num_cores, see resolve_num_cores) that can each run a task of task_bytes
+    bytes within byte_budget (default default_byte_budget()), at least 1"""
+    byte_budget = byte_budget or default_byte_budget()
+    n_jobs = min(resolve_num_cores(num_cores), max(1, byte_budget // max(task_bytes, 1)))
+    print(f"Using {n_jobs} processes, ~{task_bytes / 1024**3:.2f} GB each (memory budget {byte_budget / 1024**3:.1f} GB)")
+    return n_jobs
+
+
+def run_memory_limited(tasks, func, num_cores=-3, estimate_bytes=None, byte_budget=None):
+    """Runs func(task) for every task in a pool of num_cores processes (see resolve_num_cores). A task only starts
+    once estimate_bytes(task) fits in byte_budget (default default_byte_budget()) along with the running tasks, so big
+    z-stacks run a few at a time while small 2D images use every process. A task bigger than byte_budget runs alone.
+    Yields (task, result of func) as the tasks finish, the first error is raised here"""
+    tasks = list(tasks)
+    num_workers = resolve_num_cores(num_cores)
+    byte_budget = byte_budget or default_byte_budget()
+    task_bytes = [estimate_bytes(task) if estimate_bytes else 0 for task in tasks]
+    if tasks:
+        print(
+            f"Using up to {num_workers} processes, largest task ~{max(task_bytes) / 1024**3:.2f} GB "
+            f"(memory budget {byte_budget / 1024**3:.1f} GB)"
+        )
+    executor = get_reusable_executor(max_workers=num_workers)
+    in_flight = {}  # future -> (task, nbytes)
+    used_bytes, next_task = 0, 0
+    try:
+        while next_task < len(tasks) or in_flight:
+            while next_task < len(tasks) and len(in_flight) < num_workers:
+                if in_flight and used_bytes + task_bytes[next_task] > byte_budget:
+                    break  # wait for a running task to free its memory
+                in_flight[executor.submit(func, tasks[next_task])] = (tasks[next_task], task_bytes[next_task])
+                used_bytes += task_bytes[next_task]
+                next_task += 1
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                task, nbytes = in_flight.pop(future)
+                used_bytes -= nbytes
+                yield (task, future.result())
+    finally:  # also when the caller stops early or a task failed
+        for future in in_flight:
+            future.cancel()
+
+
+def single_acquisition_downsample_parallel(
+    acq_path, new_trg_path, n, num_cores, mip_trg_path=None, zarr_factors=None, codec=None, byte_budget=None
+):
+    """downsamples the images in the Acquisition folder at the acq_path and saves them in the new_trg_path.
+    Fused mode: if mip_trg_path is given, every z-stack is read once to also save its downsampled MIP
+    (in '<channelname>_mip' next to the downsampled stack) and its full resolution MIP (in mip_trg_path)
+    OME-Zarr mode: if zarr_factors are given (e.g. [1, 2, 4, 8]), every image is saved as one '.ome.zarr' pyramid
+    with a level per factor instead of a tiff downscaled by n (only the full resolution MIP is saved in fused mode)
+    Multi-level mode: if n is a list of factors (e.g. [2, 4, 8]) and new_trg_path a list of as many folders, every image
+    is read once and each downscaled level is saved in its own folder (4x is made from 2x, 8x from 4x...)
+    codec: tiff compression of the saved images and MIPs (see parse_codec), by default the n=1 copies are compressed
+    with 'deflate' and everything else is uncompressed
+    Every image is streamed a few planes at a time by one of num_cores processes, which reads the next planes in a
+    thread and writes the downscaled ones from other threads while it downscales (see stream_downscale_image_levels).
+    Processes are started while their planes fit in byte_budget (see run_memory_limited), by default a share of the
+    available RAM (default_byte_budget)
+    Images already downsampled with the same parameters (see the run manifest in new_trg_path) are skipped, the
+    manifest is written by this process as every worker finishes"""
+    copy_codec = codec or "deflate"  # n=1 is a compressed copy
+    n_list = list(n) if isinstance(n, (list, tuple)) else [n]
+    trg_path_list = list(new_trg_path) if isinstance(new_trg_path, (list, tuple)) else [new_trg_path]
+    if zarr_factors:  # all levels go in the one pyramid, n isn't used
+        n_list = n_list[:1]
+    if len(n_list) != len(trg_path_list):
+        print("Error: Need one target folder for every downscaling factor. Exiting")
+        exit()
+    n, new_trg_path = n_list[0], trg_path_list[0]  # single level modes
+    manifest_path = os.path.join(new_trg_path, MANIFEST_NAME)
+    params_digest = params_hash(
+        n=n_list, trg=trg_path_list, mip_trg=mip_trg_path, zarr_factors=zarr_factors, codec=codec
+    )
     # Assuming the acq_path has the acquisition dir:
     # acq_path = Acquisition dir -> {fish1 dir, fish2 dir, etc.} + notes.txt
     files = os.listdir(acq_path)
@@ -168,45 +263,124 @@ def single_acquisition_downsample_parallel(acq_path, new_trg_path, n, num_cores)
         og_name = filename_list[0]  # first of list=name
         ext = filename_list[-1]  # last of list=extension
         if ext == "txt":  # copy text files
-            shutil.copy(os.path.join(acq_path, filename), new_trg_path)
+            for trg_path in trg_path_list:
+                copy_file(os.path.join(acq_path, filename), trg_path)
+            if mip_trg_path:  # notes.txt is needed to stitch the MIPs
+                os.makedirs(mip_trg_path, exist_ok=True)
+                copy_file(os.path.join(acq_path, filename), mip_trg_path)
             # print(f"copied text file: {filename}")
 
     # find if multiple `fish` folders are present at `acq_path`
     multi_fish_flag = find_multi_subdir(subdir_path=acq_path, subdir_name="fish")
 
+    def get_save_paths(og_name, ext):
+        """Returns: (save_path_list, mip_save_path, ds_mip_save_path) of the image og_name"""
+        if multi_fish_flag:  # save the ds images in fish folder
+            fish_num = og_name[og_name.casefold().find("fish") + len("fish")]
+            save_path_list = [os.path.join(trg_path, "fish" + str(fish_num)) for trg_path in trg_path_list]
+            for save_path in save_path_list:
+                check_create_save_path(save_path)  # make fish num folders
+        else:
+            save_path_list = trg_path_list
+        save_path = save_path_list[0]
+
+        mip_save_path, ds_mip_save_path = None, None
+        if mip_trg_path:  # fused mode, MIPs are only saved for z-stacks
+            save_name = og_name.replace("_MMStack", "")
+            mip_save_path = get_mip_save_path(save_path.replace(new_trg_path, mip_trg_path), save_name, ext)
+            ds_mip_name = save_name if n == 1 else f"{save_name}_ds"
+            ds_mip_save_path = get_mip_save_path(save_path, ds_mip_name, ext)
+        return (save_path_list, mip_save_path, ds_mip_save_path)
+
     def single_image_downsample(filepath, filename):
         filename_split_list = filename.split(".")
         og_name = filename_split_list[0]  # first of list=name
         ext = filename_split_list[-1]  # last of list=extension
+        save_path_list, mip_save_path, ds_mip_save_path = get_save_paths(og_name, ext)
+        save_path = save_path_list[0]
+
+        outputs = [mip_save_path, ds_mip_save_path]  # saved files, for the run manifest
+        if zarr_factors:  # all downscaling levels in one file
+            outputs = [os.path.join(save_path, f"{og_name.replace("_MMStack", "")}.ome.zarr"), mip_save_path]
+            stream_image_to_ome_zarr(
+                read_path=filepath,
+                save_path=outputs[0],
+                factors=zarr_factors,
+                mip_save_path=mip_save_path,
+                verbose=False,
+                mip_codec=codec,
+            )
 
-        if multi_fish_flag:  # save the ds images in fish folder
-            fish_num = og_name[og_name.casefold().find("fish") + len("fish")]
-            save_path = os.path.join(new_trg_path, "fish" + str(fish_num))
-            check_create_save_path(save_path)  # make fish num folders
-        else:
-            save_path = new_trg_path
+        elif len(n_list) > 1:  # all levels from one read, n=1 is the compressed copy
+            save_name = og_name.replace("_MMStack", "")
+            level_names = [save_name if factor == 1 else f"{save_name}_ds" for factor in n_list]
+            level_save_paths = [
+                os.path.join(level_save_path, f"{level_name}.{ext}")
+                for level_save_path, level_name in zip(save_path_list, level_names)
+            ]
+            ds_mip_save_paths = [
+                get_mip_save_path(level_save_path, level_name, ext) if mip_trg_path else None
+                for level_save_path, level_name in zip(save_path_list, level_names)
+            ]
+            outputs = level_save_paths + ds_mip_save_paths + [mip_save_path]
+            stream_downscale_image_levels(
+                read_path=filepath,
+                save_paths=level_save_paths,
+                factors=n_list,
+                verbose=False,
+                mip_save_path=mip_save_path,
+                ds_mip_save_paths=ds_mip_save_paths,
+                codecs=[copy_codec if factor == 1 else codec for factor in n_list],
+                mip_codec=codec,
+            )
 
-        if n == 1:  # no downscaling needed
-            img = tiff.imread(filepath)
+        elif n == 1:  # no downscaling needed, a compressed copy streamed like the downscaled images
             save_name = f"{og_name.replace("_MMStack", "")}.{ext}"
-            # shutil.copy(src=filepath, dst=os.path.join(save_path, save_name))
-            tiff.imwrite(os.path.join(save_path, save_name), data=img, compression='Deflate')
-        
+            outputs.append(os.path.join(save_path, save_name))
+            stream_downscale_image_levels(
+                read_path=filepath,
+                save_paths=[outputs[-1]],
+                factors=[1],
+                verbose=False,
+                mip_save_path=mip_save_path,
+                ds_mip_save_paths=[ds_mip_save_path],
+                codecs=[copy_codec],
+                mip_codec=codec,
+            )
+
         else:  # downscale by n
             save_name = f"{og_name.replace("_MMStack", "")}_ds.{ext}"
-            tiff.imwrite(
-                os.path.join(save_path, save_name),
-                read_n_downscale_image(read_path=filepath, n=n),
+            outputs.append(os.path.join(save_path, save_name))
+            # stream page by page so each worker only holds a few planes in memory
+            stream_downscale_image(
+                read_path=filepath,
+                save_path=os.path.join(save_path, save_name),
+                n=n,
+                verbose=False,
+                mip_save_path=mip_save_path,
+                ds_mip_save_path=ds_mip_save_path,
+                codec=codec,
             )
-
-    def joblib_loop_downsample(filepath_list, filename_list):
-        Parallel(n_jobs=num_cores)(
-            delayed(single_image_downsample)(filepath=filepath, filename=filename)
-            for (filepath, filename) in tzip(filepath_list, filename_list)
-        )
-
+        return (filepath, outputs)
+
+    def streamed_loop_downsample(filepath_list, filename_list):
+        # results come back as the workers finish, only this process writes the manifest
+        for _, (filepath, outputs) in tqdm(
+            run_memory_limited(
+                list(zip(filepath_list, filename_list)),
+                lambda task: single_image_downsample(*task),
+                num_cores=num_cores,
+                estimate_bytes=lambda task: estimate_task_bytes(task[0], STREAM_WORKING_PLANES, streamed=True),
+                byte_budget=byte_budget,
+            ),
+            total=len(filepath_list),
+        ):
+            append_manifest(manifest_path, "downsample", [filepath], params_digest, outputs)
+
+    manifest = load_manifest(manifest_path)
+    up_to_date_count = 0
     filename_list, filepath_list = [], []
-    for root, _, filenames in os.walk(acq_path):
+    for root, _, filenames in walk_acquisition(acq_path):
         for filename in filenames:
             filepath = os.path.join(root, filename)
             filename_split_list = filename.split(".")
@@ -216,11 +390,15 @@ def single_acquisition_downsample_parallel(acq_path, new_trg_path, n, num_cores)
             if (ext == "tif" or ext == "tiff") and (
                 not check_overflowed_stack(og_name)
             ):  # only ds tiff files, ignore spill-over stack
+                if is_up_to_date(manifest, "downsample", [filepath], params_digest):
+                    up_to_date_count += 1
+                    continue
                 filepath_list.append(filepath)
                 filename_list.append(filename)
+    if up_to_date_count:
+        print(f"Skipping {up_to_date_count} images that are already downsampled (see {manifest_path})")
 
-    # call joblib downsample loop
-    joblib_loop_downsample(filepath_list, filename_list)
+    streamed_loop_downsample(filepath_list, filename_list)
 
 
 def find_2D_images(main_dir):
@@ -229,7 +407,7 @@ def find_2D_images(main_dir):
     bf_path, gfp_mip_path, rfp_mip_path = "", "", ""
     bf_img_list, gfp_img_list, rfp_img_list = [], [], []
 
-    for root, subfolders, filenames in os.walk(main_dir):
+    for root, subfolders, filenames in walk_acquisition(main_dir):
         for filename in filenames:
             # filepath = os.path.join(root, filename)
             # print(f'Reading: {filepath}')
@@ -245,7 +423,7 @@ def find_2D_images(main_dir):
                         remove_non_image_files(natsorted(os.listdir(root)), root)
                     )
                     bf_flag = True
-                elif "mip" in og_name.casefold():
+                elif og_name.casefold().endswith(PROJECTIONS["max"]):  # only MIPs, not the other projections
                     if (not gfp_flag) and ("gfp" in og_name.casefold()):
                         # print("GFP MIP images found at:" + root)
                         gfp_mip_path = root
@@ -284,7 +462,7 @@ def find_3D_images(main_dir):
     gfp_flag, rfp_flag = False, False  # 0 means not found, 1 mean found
     gfp_path, rfp_path = "", ""
     gfp_img_list, rfp_img_list = [], []
-    for root, subfolders, filenames in os.walk(main_dir):
+    for root, subfolders, filenames in walk_acquisition(main_dir):
         for filename in filenames:
             # print(f'Reading: {filename}')
             # filepath = os.path.join(root, filename)
@@ -295,7 +473,7 @@ def find_3D_images(main_dir):
             if ext == "tif" or ext == "tiff":
                 if ("bf" not in og_name) and (
                     "mip" not in og_name
-                ):  # ignore BF and MIP
+                ) and not og_name.endswith(tuple(PROJECTIONS.values())):  # ignore BF, MIP and other projections
                     if ("gfp" in og_name) and (not gfp_flag):  # find GFP
                         # print("GFP images found at:" + root)
                         gfp_path = root
@@ -325,303 +503,75 @@ def find_3D_images(main_dir):
     )
 
 
-def find_lsm_scope(img_h, img_w):
-    """Finds LSM Scope and downscaling factor automatically using image height and width.
-    Returns:
-    ds_factor_h = downscaling factor in height,
-    ds_factor_w = downscaling factor in width"""
-
-    global findscope_flag  # refer to the global var
-    ds_factor_w, ds_factor_h = 1, 1
-
-    if img_w == img_h:  # probably KLA LSM
-        findscope_flag = 1
-        ds_factor_h = 2048 // img_h
-        ds_factor_w = 2048 // img_w
-        r = 2048 % img_h
-        if r > 0:  # implying downscaling factor is in fraction
-            findscope_flag = 0
-            print("Downscaling factor in fraction. Can't process automatically.")
-
-    elif img_w > img_h:  # probably WIL LSM
-        findscope_flag = 2
-        ds_factor_h = 2160 // img_h
-        ds_factor_w = 2560 // img_w
-        if ds_factor_h != ds_factor_w:
-            findscope_flag = 0
-        r_h = 2160 % img_h
-        r_w = 2560 % img_w
-        if r_h > 0 or r_w > 0:  # implying downscaling factor is in fraction
-            findscope_flag = 0
-            print("Downscaling factor in fraction. Can't process automatically.")
-
-    # if findscope_flag == 1:
-    #     print("LSM Scope used: KLA")
-    #     print(f"Downscaling factor = {ds_factor_w}")
-    # elif findscope_flag == 2:
-    #     print("LSM Scope used: WIL")
-    #     print(f"Downscaling factor = {ds_factor_w}")
-
-    if findscope_flag == 0:  # couldn't find scope, enter manually
-        print("ERROR: Failed to determine LSM scope automatically.\nEnter manually")
-        findscope_flag = int(
-            input(
-                "Enter the scope used:\n1 - KLA LSM Scope\n2 - WIL LSM Scope\nInput (1/2): "
-            )
-        )
-        if findscope_flag == 1 or findscope_flag == 2:
-            ds_factor_h = int(input("Enter the downscaling factor in height: "))
-            ds_factor_w = int(input("Enter the downscaling factor in width: "))
-        else:
-            print("Fatal Error: Exiting")
-            exit()
-    return (ds_factor_h, ds_factor_w)
-
-
-def find_stage_coords_n_pixel_width_from_2D_images(ch_flags, ch_paths, ch_img_lists):
-    """Send channel flags and paths in the order [bf, gfp, rfp]"""
-    # change global image_height and image_width
-    global img_h, img_w, new_spacing
-    # unpack variables
-    bf_flag, gfp_flag, rfp_flag = ch_flags
-    bf_path, gfp_mip_path, rfp_mip_path = ch_paths
-    bf_img_list, gfp_img_list, rfp_img_list = ch_img_lists
-    # find the nearest notes.txt
-    config = configparser.ConfigParser()
-    start_path = ""
-    img_path = ""  # dummy
-    # get start_path for search
-    # get sample image to find scope and downscaling factor
-    if bf_flag:
-        start_path = bf_path
-        img_path = os.path.join(bf_path, bf_img_list[0])
-    elif gfp_flag:
-        start_path = gfp_mip_path
-        img_path = os.path.join(gfp_mip_path, gfp_img_list[0])
-    elif rfp_flag:
-        start_path = rfp_mip_path
-        img_path = os.path.join(rfp_mip_path, rfp_img_list[0])
-
-    # get sample image dimensions
-    img = tiff.imread(img_path)
-    img_h, img_w = img.shape[0], img.shape[1]
-    (ds_h, ds_w) = find_lsm_scope(img_h, img_w)
-    new_spacing = np.array(
-        [ZD, YD * ds_h, XD * ds_w]
-    )  # downscale x&y by n, skimage coords = z, y, x plane, row, col
-    # print(f"Pixel width (plane, row, col): {new_spacing}\n")
-
-    # find the fish number from the image path
-    fish_num = int(
-        img_path[img_path.casefold().rfind("fish") + len("fish")]
-    )  # find fish number starting from the img_name
-    # print(f"found fish_num = {fish_num}")
-
-    target1 = "notes.txt"
-    target2 = "Notes.txt"
-    notes_path = find_nearest_target_file(
-        start_path, target1
-    ) or find_nearest_target_file(start_path, target2)
-    if notes_path is None:
-        print("Error: Can't find notes.txt, Enter manually")
-        notes_path = input("Enter complete path (should end with .txt): ")
-    config.read(notes_path)
-
-    # print(config.sections())
-    abbrev = config.getfloat(f"Fish {fish_num} Region 1", "x_pos", fallback=False)
-    if abbrev:
-        # config_prop_list = ["x_pos", "y_pos", "z_pos"]
-        config_prop_list = [
-            "x_pos",
-            "y_pos",
-            "z_stack_start_pos",
-        ]  # wil and kla stores in this format
-        # print(f"abbreviated props... reading {config_prop_list}")
-    else:
-        # config_prop_list = ["x_position", "y_position", "z_position"]
-        config_prop_list = ["x_position", "y_position", "z_start_position"]
-        # print(f"not abbreviated props... reading {config_prop_list}")
-    stage_coords = np.zeros(shape=(pos_max, 3))
-    for i in range(1, pos_max + 1):
-        for j, val in enumerate(config_prop_list):  # x/y/z axes
-            stage_coords[i - 1][j] = config.getfloat(f"Fish {fish_num} Region {i}", val)
-    # print(f"Found stage_coords: \n{stage_coords}")
-    return stage_coords
-
-
-def find_stage_coords_n_pixel_width_from_3D_images(ch_flags, ch_paths, ch_img_lists):
-    """Send channel flags and paths in the order [gfp, rfp]"""
-    # change global image_height and image_width
-    global img_h, img_w, new_spacing
-    # unpack variables
-    gfp_flag, rfp_flag = ch_flags
-    gfp_stack_path, rfp_stack_path = ch_paths
-    gfp_img_list, rfp_img_list = ch_img_lists
-    # find the nearest notes.txt
-    config = configparser.ConfigParser()
-    start_path = ""
-    img_path = ""  # dummy
-    # get start_path for search
-    # get sample image to find scope and downscaling factor
-    if gfp_flag:
-        start_path = gfp_stack_path
-        img_path = os.path.join(start_path, gfp_img_list[0])
-    elif rfp_flag:
-        start_path = rfp_stack_path
-        img_path = os.path.join(start_path, rfp_img_list[0])
-    # print(start_path)
-    # print(img_path)
-    # get sample image dimensions
-    img = (tiff.imread(img_path))[0]  # type: ignore #get one z slice
-    if img.ndim != 2:
-        print(f"ERROR: Image dimension is {img.ndim + 1}, expected 3")
-        exit()
-    img_h, img_w = img.shape[0], img.shape[1]
-    (ds_h, ds_w) = find_lsm_scope(img_h, img_w)
-    new_spacing = np.array(
-        [ZD, YD * ds_h, XD * ds_w]
-    )  # downscale x&y by n, skimage coords = z, y, x plane, row, col
-    # print(f"Pixel width (plane, row, col): {new_spacing}\n")
-
-    # find the fish number from the image path
-    fish_num = int(
-        img_path[img_path.casefold().rfind("fish") + len("fish")]
-    )  # find fish number starting from the img_name
-    # print(f"found fish_num = {fish_num}")
-
-    target1 = "notes.txt"
-    target2 = "Notes.txt"
-    notes_path = find_nearest_target_file(
-        start_path, target1
-    ) or find_nearest_target_file(start_path, target2)
-    if notes_path is None:
-        print("Error: Can't find notes.txt, Enter manually")
-        notes_path = input("Enter complete path (should end with .txt): ")
-    config.read(notes_path)
-
-    # print(config.sections())
-    abbrev = config.getfloat(f"Fish {fish_num} Region 1", "x_pos", fallback=False)
-    if abbrev:
-        # config_prop_list = ["x_pos", "y_pos", "z_pos"]
-        config_prop_list = [
-            "x_pos",
-            "y_pos",
-            "z_stack_start_pos",
-        ]  # wil and kla stores in this format
-        # print(f"abbreviated props... reading {config_prop_list}")
-    else:
-        # config_prop_list = ["x_position", "y_position", "z_position"]
-        config_prop_list = ["x_position", "y_position", "z_start_position"]
-        # print(f"not abbreviated props... reading {config_prop_list}")
-    stage_coords = np.zeros(shape=(pos_max, 3))
-    for i in range(1, pos_max + 1):
-        for j, val in enumerate(config_prop_list):  # x/y/z axes
-            stage_coords[i - 1][j] = config.getfloat(f"Fish {fish_num} Region {i}", val)
-    # print(f"Found stage_coords: \n{stage_coords}")
-    return stage_coords
-
-
-def global_coordinate_changer(stage_coords):
-    """Parameters: stage_coords: read from notes.txt to stitch images
-                new_spacing: contains pixel width of the images
-    Returns: 2D np.array same shape as stage_coords
-    """
-    # original camera pixel width is 1µm in the z (leading!) axis, and  0.1625µm in the x and y axes.
-    # for downsampled by 4, this will be orig pixel_width*4
-    # To correct for the offset and stitch different acquisition positions together, note the following:
-    # - regionprops generates local coords of objects in the image as `axis-0,1 and 2`: this is our `Local coords system`
-    # - stage positions is saved by micromanager and obtained from the metadata as `XPositionUm`, similarly for y and z. this is a `global coords system` in the sense that it is same for all the images for a given sample
-    # - Finally we define our `Global coordinates` to the data frames as **"y-ap-um", "x-dv-um", "z-lr-um"** where ap is anterior to posterior axis, dv is dorsal to ventral axis, lr is left-right axis (*don't know the direction*, doesn't matter as long as the local and global are in the same direction)
-
-    # The direction of Global coords system is different in Klamath LSM and Willamette LSM:
-
-    # Klamath LSM:
-    # - Stage +Z <-> Global +Z_lr <-> Local axis-0: (so same direction) needs to be ensured that it is same for each acquisition
-    # - Stage +Y <-> Global +Y_ap <-> Local axis-1: (so same direction) same for all acquisition
-    # - Stage -X <-> Global +X_dv <-> Local axis-2: (so inverse direction) same for all acquisition
-
-    # To resolve the inverse directions between global x and local axis-2, I am flipping the global coordinate system's x axis.
-
-    # Willamete LSM:
-    # - Stage +Z <-> Global +Z_lr <-> Local axis-0: (so same direction) needs to be verified for each acquisition
-    # - Stage +Y <-> Global +Y_ap <-> Local axis-1: (so same direction) same for all acquisition
-    # - Stage +X <-> Global -X_dv <-> Local axis-2: (so inverse direction) same for all acquisition
-
-    # To resolve the flipped axes between global x/y and stage x/y, I am exchanging the global coordinate system's axis.
-
-    stage_origin = stage_coords[0].copy()
-    global_coords_um = stage_coords - stage_origin  # set first stage position as zero
-    global_coords_um[:, 0] = global_coords_um[:, 0] * -1  # flip x axis
-    # um to pixels: 1px = (1/pixel width) um
-    # as the stage position is in x (col:axis-2), y(row:axis-1), z(plane:axis-0) format
-    global_coords_px = global_coords_um / [
-        new_spacing[2],
-        new_spacing[1],
-        new_spacing[0],
-    ]
-    return global_coords_px
-
-
-def median_bg_subtraction(img_wo_bg_sub):
-    """subtracts the median pixel intensity of the image from the image"""
-    img_bg_sub = img_wo_bg_sub - np.median(img_wo_bg_sub.flatten())  # subtract median
-    img_bg_sub[img_bg_sub < 0] = 0  # make all negative values zero
-    return img_bg_sub
-
-
 def check_overflowed_stack(filename):
-    """return True if the 'filename' is a overflowed_stack else False"""
-    num = filename[filename.casefold().rfind("mmstack_") + len("mmstack_")]
-    return re.match(r"\d", num)
-
-
-def oswalk_batchprocess_mip_parallel(main_dir, num_cores):
-    """Uses oswalk to find all 3D images in main_dir and create MIPs for GFP and RFP channels."""
+    """return True if the 'filename' (without extension) is a overflowed_stack else False, e.g. 'fish1_GFP_MMStack_1'
+    or 'fish1_GFP_MMStack_Pos0_1'"""
+    return re.search(r"mmstack(_pos\d+)?_\d+$", filename.casefold()) is not None
+
+
+def oswalk_batchprocess_mip_parallel(
+    main_dir,
+    num_cores,
+    codec=None,
+    byte_budget=None,
+    projections=("max",),
+    slab_size=None,
+    slab_stride=None,
+    z_ranges=None,
+):
+    """Uses oswalk to find all 3D images in main_dir and create MIPs for GFP and RFP channels.
+    codec: tiff compression of the MIPs (see parse_codec), default uncompressed
+    projections: projections found together with the MIP or instead of it, each saved in its own folder
+    (see PROJECTIONS and save_projections), default only the MIP
+    slab_size, slab_stride, z_ranges: also save the MIPs of these z slabs as a stack (see slab_ranges)
+    The stacks are read one plane at a time, projected and saved by num_cores processes (see stream_projections), so
+    a process only holds a plane and the accumulators and at most byte_budget bytes of them are in memory
+    (see run_memory_limited).
+    Images whose MIPs are up to date (see the run manifest in main_dir) are skipped"""
     print("Finding Max Intensity Projections...")
     print(
         "Warning: This code ONLY works with single channel z-stack tiff images. It will give unpredictable results with >3 dimensions"
     )
 
-    channel_names = ["GFP", "RFP"]
-
-    def single_image_mip(filename, rootpath):
-
-        filepath = os.path.join(rootpath, filename)
-        filename_split_list = filename.split(".")
-        og_name = filename_split_list[0]  # first of list=name
-        ext = filename_split_list[-1]  # last of list=extension
-
-        read_image = tiff.imread(filepath)
-        if len(read_image.shape) == 3:  # check if 3D images
-            # print(f"Processing MIP for: {filepath}")
-            arr_mip = np.max(read_image, axis=0)  # create MIP
-            for (
-                ch_name
-            ) in (
-                channel_names
-            ):  # save mip array in right directory with correct channel name
-                if ch_name.casefold() in og_name.casefold():
-                    dest = os.path.join(rootpath, ch_name.casefold() + "_mip")
-                    if not os.path.exists(dest):  # check if the dest exists
-                        os.makedirs(dest)
-                    # the downsampling algorithm produces float values,
-                    # so recast the ds image to the original datatype
-                    img_mip = np.round(arr_mip).astype(read_image.dtype)
-
-                    if og_name.endswith("_MMStack"):  # remove 'MMStack' in saved name
-                        save_name = og_name[: -len("_MMStack")] + "_mip." + ext
-                    else:
-                        save_name = og_name + "_mip." + ext
-                    tiff.imwrite(os.path.join(dest, save_name), img_mip)
-
-    def joblib_loop_mip(filename_list, rootpath_list):
-        Parallel(n_jobs=num_cores)(
-            delayed(single_image_mip)(filename=filename, rootpath=rootpath)
-            for (filename, rootpath) in tzip(filename_list, rootpath_list)
-        )
+    manifest_path = os.path.join(main_dir, MANIFEST_NAME)
+    manifest = load_manifest(manifest_path)
+    params_digest = projections_params_hash(codec, projections, slab_size, slab_stride, z_ranges)
+    working_planes = MIP_WORKING_PLANES if list(projections) == ["max"] else PROJECTION_WORKING_PLANES
+
+    def estimate_bytes(filepath):
+        """the accumulators and the slab MIPs"""
+        n_slabs = 0
+        if slab_size or z_ranges:
+            n_slabs = len(slab_ranges(count_stack_planes(filepath), slab_size, slab_stride, z_ranges))
+        return estimate_task_bytes(filepath, working_planes + n_slabs, streamed=True)
+
+    def project_n_save(filepath):
+        """Returns: saved projections, for the run manifest"""
+        arr_projections = stream_projections(filepath, projections, slab_size, slab_stride, z_ranges)
+        if arr_projections is None:  # only 3D images have a MIP
+            return []
+        return save_projections(filepath, arr_projections, codec)
+
+    def loop_mip(filepath_list):
+        # results come back as the processes finish, only this process writes the manifest
+        for filepath, outputs in tqdm(
+            run_memory_limited(
+                filepath_list,
+                project_n_save,
+                num_cores=num_cores,
+                estimate_bytes=estimate_bytes,
+                byte_budget=byte_budget,
+            ),
+            total=len(filepath_list),
+        ):
+            append_manifest(
+                manifest_path, "mip", [filepath] + find_overflow_stacks(filepath), params_digest, outputs
+            )
 
-    filename_list, rootpath_list = [], []
-    for root, _subfolders, filenames in os.walk(main_dir):
+    filepath_list = []
+    for root, subfolders, filenames in walk_acquisition(main_dir):
+        # skip the saved projections, the slab MIP stacks would be projected again into nested folders on every run
+        subfolders[:] = [sub for sub in subfolders if not is_projection_output(sub)]
         for filename in filenames:
             # filepath = os.path.join(root, filename)
             # print(f'Reading: {filepath}')
@@ -631,63 +581,145 @@ def oswalk_batchprocess_mip_parallel(main_dir, num_cores):
             ext = filename.split(".")[-1]
 
             if (ext == "tif" or ext == "tiff") and (
-                not check_overflowed_stack(og_name)
-            ):  # tiff files which are not spilled-over stacks
-                filename_list.append(filename)
-                rootpath_list.append(root)
-
-    # call joblib loop for MIP creation
-    joblib_loop_mip(filename_list, rootpath_list)
-
+                not check_overflowed_stack(og_name) and not is_projection_output(og_name)
+            ):  # tiff files which are not spilled-over stacks or projections
+                filepath = os.path.join(root, filename)
+                if is_up_to_date(manifest, "mip", [filepath] + find_overflow_stacks(filepath), params_digest):
+                    continue
+                filepath_list.append(filepath)
 
-def img_stitcher_2D(global_coords_px, img_list):
-    """accept a list of 2D images in img_list and use stage_coords read from notes.txt to stitch images
-    Returns: 2D np.array containing the stitched image
+    # call parallel loop for MIP creation
+    loop_mip(filepath_list)
+
+
+def stitch_2D_images_parallel(
+    fish_geometry,
+    ch_names,
+    ch_flags,
+    ch_paths,
+    ch_img_lists,
+    num_cores,
+    save_ext="png",
+    tile_size=None,
+    codec=None,
+    byte_budget=None,
+):
+    """Stitches all timepoints of all channels of one fish in parallel, saves them in '<channelname>_stitched'
+    and '<channelname>_stitched_bgsub_rescaled' folders as save_ext images ('png', or 'tif' written with the codec
+    string codec and tiled if tile_size is given, see write_tiff).
+    The fish_geometry (stage coords, pos_max and LSM scope) is found once by the caller and sent to the workers.
+    The first timepoint of every channel is stitched first as it is the histogram matching reference for the rest.
+    Channels whose timepoints are all up to date (see the run manifest in every channel folder) are skipped, if the
+    reference timepoint changed all timepoints of the channel are stitched again.
+    At most num_cores processes are used, fewer if their timepoints don't fit in byte_budget (see memory_limited_n_jobs)
     """
-    if findscope_flag == 0:
-        print("ERROR: Couldn't find the LSM scope")
-        exit()
-    # poses = np.shape(img_list)[0]
-    og_datatype = img_list[0].dtype
-    img_height = np.shape(img_list)[1]
-    img_width = np.shape(img_list)[2]
-
-    # stitched image ax0 is going down, ax1 is to the right
-    ax0_offset, ax1_offset = [], []
-    if findscope_flag == 2:  # wil lsm, stitch horizontally
-        ax0_offset = global_coords_px[:, 0] * -1  # ax0 = -Global X_DV
-        ax1_offset = global_coords_px[:, 1]  # ax1 = Global Y_AP
-    elif findscope_flag == 1:  # kla lsm, stitch vertically
-        ax0_offset = global_coords_px[:, 1]  # ax0 = Global Y_AP
-        ax1_offset = global_coords_px[:, 0]  # ax1 = Global X_DV
-
-    # find offset from min
-    ax0_offset = np.ceil(ax0_offset - np.min(ax0_offset)).astype(int)
-    ax1_offset = np.ceil(ax1_offset - np.min(ax1_offset)).astype(int)
-
-    # find max of each axis
-    ax0_max = img_height + np.max(ax0_offset)
-    ax1_max = img_width + np.max(ax1_offset)
-
-    # create empty stitched image
-    stitched_image = np.zeros(
-        [ax0_max, ax1_max], dtype=og_datatype
-    )  # rows-height, cols-width
-    stitched_image_bg_sub = np.zeros_like(stitched_image)
-
-    # bg subtract all images to be stitched
-    img_list_bg_sub = []
-    for img in img_list:
-        img_list_bg_sub.append(median_bg_subtraction(img))
-
-    # stitch images
-    for i, (h0, w0) in enumerate(zip(ax0_offset, ax1_offset)):
-        stitched_image[h0 : h0 + img_height, w0 : w0 + img_width] = img_list[i]
-        stitched_image_bg_sub[h0 : h0 + img_height, w0 : w0 + img_width] = (
-            img_list_bg_sub[i]
-        )
-    # return (np.round(stitched_image).astype(og_datatype), np.round(stitched_image_bg_sub).astype(og_datatype))
-    # additional check
-    if stitched_image.dtype != og_datatype:
-        raise TypeError("Datatype is not preserved.. Something wrong.. Check code")
-    return (stitched_image, stitched_image_bg_sub)
+    pos_max = fish_geometry.pos_max
+    params_digest = params_hash(
+        coords=fish_geometry.global_coords_px.tolist(), save_ext=save_ext, tile_size=tile_size, codec=codec
+    )
+    ref_jobs, rest_jobs = [], []  # (channel name, manifest path, input paths, stitching args) for each timepoint
+    for ch_name, ch_flag, ch_path, ch_img_list in zip(ch_names, ch_flags, ch_paths, ch_img_lists):
+        if ch_flag:
+            save_path_stitched_img = os.path.join(ch_path, f"{ch_name.casefold()}_stitched")
+            save_path_stitched_edited_img = os.path.join(ch_path, f"{ch_name.casefold()}_stitched_bgsub_rescaled")
+            check_create_save_path(save_path_stitched_img)
+            check_create_save_path(save_path_stitched_edited_img)
+            manifest_path = os.path.join(ch_path, MANIFEST_NAME)
+            manifest = load_manifest(manifest_path)
+
+            ch_jobs = []
+            for i in range(len(ch_img_list) // pos_max):  # once per timepoint
+                save_paths = (
+                    os.path.join(save_path_stitched_img, f"Timepoint{i+1}_{ch_name}_stitched.{save_ext}"),
+                    os.path.join(save_path_stitched_edited_img, f"Timepoint{i+1}_{ch_name}_stitched.{save_ext}"),
+                )
+                img_names = ch_img_list[i * pos_max : (i + 1) * pos_max]
+                read_paths = [os.path.join(ch_path, img_name) for img_name in img_names]
+                stitch_args = (ch_path, img_names, fish_geometry, save_paths)
+                ch_jobs.append((ch_name, manifest_path, read_paths, stitch_args))
+            up_to_date_flags = [
+                is_up_to_date(manifest, "stitch_2D", read_paths, params_digest) for _, _, read_paths, _ in ch_jobs
+            ]
+            if all(up_to_date_flags):
+                print(f"{ch_name} stitched images are up to date, skipping")
+                continue
+            # the reference is always stitched again as the other timepoints need its histogram
+            ref_jobs.append(ch_jobs[0])
+            if up_to_date_flags[0]:
+                rest_jobs += [job for job, up_to_date in zip(ch_jobs[1:], up_to_date_flags[1:]) if not up_to_date]
+            else:  # new reference histogram, every timepoint changes
+                rest_jobs += ch_jobs[1:]
+
+    if not ref_jobs:
+        return
+    # all timepoints of a channel have the same size, the biggest reference is the estimate for every task
+    task_bytes = max(estimate_task_bytes(read_paths, STITCH_WORKING_COPIES) for _, _, read_paths, _ in ref_jobs)
+    n_jobs = memory_limited_n_jobs(num_cores, task_bytes, byte_budget)
+    print(f"Stitching reference timepoint of {[job[0] for job in ref_jobs]}...")
+    ref_img_histograms = {}
+    for (ch_name, manifest_path, read_paths, stitch_args), ref_img in zip(
+        ref_jobs,
+        Parallel(n_jobs=n_jobs, return_as="generator")(
+            delayed(stitch_2D_single_timepoint)(*stitch_args, tile_size=tile_size, codec=codec)
+            for _, _, _, stitch_args in ref_jobs
+        ),
+    ):
+        ref_img_histograms[ch_name] = ref_img
+        append_manifest(manifest_path, "stitch_2D", read_paths, params_digest, stitch_args[3])
+
+    # large reference arrays are memory mapped by joblib, not copied for each task
+    print("Stitching remaining timepoints...")
+    for (ch_name, manifest_path, read_paths, stitch_args), _ in zip(
+        rest_jobs,
+        Parallel(n_jobs=n_jobs, return_as="generator")(
+            delayed(stitch_2D_single_timepoint)(
+                *stitch_args, ref_img_histogram=ref_img_histograms[ch_name], tile_size=tile_size, codec=codec
+            )
+            for ch_name, _, _, stitch_args in tqdm(rest_jobs)
+        ),
+    ):
+        append_manifest(manifest_path, "stitch_2D", read_paths, params_digest, stitch_args[3])
+
+
+def img_stitcher_3D_parallel(
+    fish_geometry,
+    img_path_list,
+    num_cores,
+    bg_sub=True,
+    save_path=None,
+    compression_type=None,
+    tile_size=None,
+    byte_budget=None,
+):
+    """Same as img_stitcher_3D, but the 3D images are read (and bg subtracted) by num_cores processes that place them
+    straight into the stitched image in a shared memory block (see place_tile_3D), so no tile is sent between
+    processes. Every image only sets the part of the stitched image no later image overlaps (see owned_boxes), so the
+    result doesn't depend on the order the processes finish in. At most byte_budget bytes of RAM (default
+    default_byte_budget()) are used with the stitched image, fewer images are read at once if they don't fit.
+    Returns: 3D np.array containing the stitched image, None if it's saved at save_path"""
+    stitched_shape, og_datatype, boxes = plan_stitch_3D(fish_geometry, img_path_list)
+    owned = owned_boxes(boxes)
+    working_copies = STITCH_3D_BG_SUB_COPIES if bg_sub else 1
+    byte_budget = byte_budget or default_byte_budget()
+    stitched_nbytes = int(np.prod(stitched_shape)) * og_datatype.itemsize
+
+    shm, stitched_image, stitched_spec = create_shared_array(stitched_shape, og_datatype)
+    try:
+        tasks = list(zip(img_path_list, boxes, owned))
+        for _ in run_memory_limited(
+            tasks,
+            lambda task: place_tile_3D(stitched_spec, *task, bg_sub=bg_sub),
+            num_cores,
+            estimate_bytes=lambda task: estimate_task_bytes(task[0], working_copies),
+            byte_budget=max(byte_budget - stitched_nbytes, 1),
+        ):
+            pass
+
+        if save_path:
+            save_stitched_3D(stitched_image, fish_geometry, save_path, compression_type, tile_size)
+            return None
+        return stitched_image.copy()  # the shared block is freed below
+    finally:
+        del stitched_image  # the shared block can only be closed once no array uses it
+        shm.close()
+        shm.unlink()
@@ -4,78 +4,64 @@
 #          Only works with Original Images (no processing) acquired in RPLab LSM 
 #
 # Created: July 29, 2023
+#
+# Run without arguments to be asked for every option, or give them on the command line for unattended jobs, e.g.
+#     python -m PARALLEL_user_friendly_downsampling_mip_stitch_batchprocess_code.original_acquisition_visualize_img_stacks_in_2D_generate_mip_stitch
+#         --src D:/exp1 --trg E:/ --channels 012
+# The functions can also be imported, e.g. generate_mips_n_copy_bf(src, trg, [0, 1, 2]) and stitch_acquisitions(new_trg).
 
+import argparse
 import os
-import shutil
+import sys
 
-import numpy as np
 import skimage as ski
 from natsort import natsorted
 from tqdm import tqdm
 
 import PARALLEL_user_friendly_downsampling_mip_stitch_batchprocess_code.batchprocessing_functions_v4_parallel as bpf
 
-action_flag = 0
-
-while action_flag == 0:
-    action_flag = int(input(
-    """This code will find Max intensity projections of `z-stacks` and stitch the resulting images using the metadata found in `notes`
-        Run this *ONLY* on the original acquisition folder of LSM images as it uses the folder structure to find the images
-        Warning: This code ONLY works with single channel z-stack tiff images. It will give unpredictable results with >3 dimensions
-        Number of fish, positions and timepoints can be different in each folder, but channel names should be consistent
-         
-        Do you want to:
-            1. Find Max Intensity Projection AND Stitch (default)
-            2. Only find Max Intensity Projection
-            3. Only Stitch\n"""
-            )
-            or "1"
-    )
+STITCH_CHANNELS = ["BF", "GFP_mip", "RFP_mip"]
 
-    if action_flag == 1 or action_flag == 2 or action_flag == 3:
-        break
-    else:
-        action_flag = 0
-        print("Invalid value: Re-Enter")
 
-## find MIP
-if action_flag != 3: # find MIP
-    #get source and target directories
-    src, trg = "", ""
-    while src == trg or src == "" or trg == "":
-        src = os.path.normpath(
-            input("Enter the Parent folder for original images (should contain 'Acquisition' folders): ")
-        )
-        trg = os.path.normpath(input("Enter the Destination folder: "))
-        if src == trg:
-            print("Parent and Destination folders cannot be empty or have the same location. Re-Enter..")
-    #get ch_list to process mips
-    user_ch_list = None
-    while user_ch_list is None:
-        user_input = input("""Enter the channel numbers to process MIPs: 
-                            0: Brightfield, 1: GFP, 2: RFP (e.g. '012' for all 3 channels):\n""")
-        user_ch_list = [int(ch.strip()) for ch in user_input if ch.strip().isdigit() and int(ch.strip()) in [0, 1, 2]]
-        if not user_ch_list:
-            print("Invalid input. Please enter valid channel numbers.")
-    ch_list = [os.path.join('snap','BF') if ch == 0 
+def get_ch_list(user_ch_list):
+    """Returns: channel subfolders of the original acquisition for the channel numbers in user_ch_list
+    (0: Brightfield, 1: GFP, 2: RFP)"""
+    return [os.path.join('snap','BF') if ch == 0 
             else os.path.join('zstack','GFP') if ch == 1 
             else os.path.join('zstack','RFP') for ch in user_ch_list]
 
-    new_trg = os.path.join(trg, src.split(os.sep)[-1]+"_mip_stitched")
 
-    acq_list = [acq for acq in os.listdir(src) if os.path.isdir(os.path.join(src, acq)) and 'Acquisition' in acq]
-    acq_list = natsorted(acq_list)
+def parse_ch_numbers(text):
+    """parses the channel numbers, e.g. '012' for all 3 channels
+    Returns: list of int, empty if none are valid"""
+    return [int(ch.strip()) for ch in text if ch.strip().isdigit() and int(ch.strip()) in [0, 1, 2]]
 
-    # Function to copy notes.txt from src/acq to trg/acq
-    def copy_notes(src, trg, acq):
-        src_file = os.path.join(src, acq, 'notes.txt')
-        trg_file = os.path.join(trg, acq, 'notes.txt')
-        if os.path.exists(src_file):
-            shutil.copy(src_file, trg_file)
-        else:
-            print(f"Source file {src_file} does not exist.")
-            print("FATAL ERROR: notes.txt not found in the source acquisition folder. It is required for stitching.")
-            exit()
+
+def find_acquisitions(folder):
+    """Returns: natsorted list of the 'Acquisition' folders in folder"""
+    acq_list = [acq for acq in os.listdir(folder) if os.path.isdir(os.path.join(folder, acq)) and 'Acquisition' in acq]
+    return natsorted(acq_list)
+
+
+# Function to copy notes.txt from src/acq to trg/acq
+def copy_notes(src, trg, acq):
+    src_file = os.path.join(src, acq, 'notes.txt')
+    trg_file = os.path.join(trg, acq, 'notes.txt')
+    if os.path.exists(src_file):
+        bpf.copy_file(src_file, trg_file)
+    else:
+        print(f"Source file {src_file} does not exist.")
+        print("FATAL ERROR: notes.txt not found in the source acquisition folder. It is required for stitching.")
+        exit()
+
+
+def generate_mips_n_copy_bf(src, trg, user_ch_list):
+    """finds the MIPs of the GFP/RFP z-stacks and copies the BF images of every acquisition in src, for the channel
+    numbers in user_ch_list (0: Brightfield, 1: GFP, 2: RFP), into '<src name>_mip_stitched' in trg with the notes.txt
+    Returns: new_trg = folder with the MIPs"""
+    ch_list = get_ch_list(user_ch_list)
+    new_trg = os.path.join(trg, src.split(os.sep)[-1]+"_mip_stitched")
+    acq_list = find_acquisitions(src)
 
     # Iterate over the acquisition list and copy notes.txt
     for acq in acq_list:
@@ -131,11 +117,12 @@ if action_flag != 3: # find MIP
                                 ext = filename_list[-1]  # last of list=extension
 
                                 if (ext == "tif" or ext == "tiff") and (not bpf.check_overflowed_stack(og_name)):
-                                    read_image = ski.io.imread(os.path.join(img_folder, filename))
-                                    arr_mip = np.max(read_image, axis=0)  # create MIP                  
-                                    img_mip = np.round(arr_mip).astype(read_image.dtype)
+                                    # running max over the planes, the '_MMStack_1' overflow files are read with the stack
+                                    img_mip = bpf.stream_mip(os.path.join(img_folder, filename))
+                                    if img_mip is None:  # not a z-stack
+                                        continue
                                     save_name = f"{og_name.replace('_MMStack', '')}_mip.tif"
-                                    ski.io.imsave(os.path.join(trg_folder, save_name), img_mip, check_contrast=False)
+                                    bpf.save_image(os.path.join(trg_folder, save_name), img_mip)
         
     # copy BF images
     for acq in acq_list:
@@ -164,34 +151,30 @@ if action_flag != 3: # find MIP
 
                                 if (ext == "tif" or ext == "tiff") and (not bpf.check_overflowed_stack(og_name)):
                                     save_name = f"{og_name.replace('_MMStack', '')}.tif"
-                                    shutil.copy(src=os.path.join(img_folder, filename),
-                                                dst=os.path.join(trg_folder, save_name))
+                                    bpf.copy_file(os.path.join(img_folder, filename),
+                                                  os.path.join(trg_folder, save_name))
+    return new_trg
 
-if action_flag == 3:  # only stitch, so take the input from the user as it wasn't taken before
-    new_trg = os.path.normpath(
-        input("""Enter the folder with images to stitch:
-              Note- it must have the notes.txt, can have multiple `Acquisition` folders\n"""))
-    acq_list = [acq for acq in os.listdir(new_trg) if os.path.isdir(os.path.join(new_trg, acq)) and 'Acquisition' in acq]
-    acq_list = natsorted(acq_list)
 
-## Stitching
-if action_flag != 2: # not 'only mip' so stitch
-    ch_names = ["BF", "GFP_mip", "RFP_mip"]
-
-    for acq in acq_list:
+def stitch_acquisitions(new_trg, scope=None, ds_factor=None, interactive=True):
+    """stitches the MIPs and BF images of every fish in the 'Acquisition' folders of new_trg (each must have its
+    notes.txt), saves them in '<channelname>_stitched' and '<channelname>_stitched_bgsub_rescaled' folders.
+    scope, ds_factor and interactive are passed to bpf.find_lsm_scope"""
+    for acq in find_acquisitions(new_trg):
         fish_list = [fish for fish in os.listdir(os.path.join(new_trg, acq)) if os.path.isdir(os.path.join(new_trg, acq, fish))]
         fish_list = natsorted(fish_list)
         for fish in fish_list:
             print(f"Processing: {os.path.join(new_trg, acq, fish)}")
             ch_2Dimg_flags, ch_2Dimg_paths, ch_2Dimg_lists = bpf.find_2D_images(os.path.join(new_trg, acq, fish))
-            stage_coords = bpf.find_stage_coords_n_pixel_width_from_2D_images(ch_2Dimg_flags, ch_2Dimg_paths, ch_2Dimg_lists)
-            global_coords_px = bpf.global_coordinate_changer(stage_coords)
+            fish_geometry = bpf.find_stage_coords_n_pixel_width_from_2D_images(
+                ch_2Dimg_flags, ch_2Dimg_paths, ch_2Dimg_lists, scope, ds_factor, interactive
+            )
 
             for ch_name, ch_2Dimg_flag, ch_2Dimg_path, ch_2Dimg_list in zip(
-                ch_names, ch_2Dimg_flags, ch_2Dimg_paths, ch_2Dimg_lists
+                STITCH_CHANNELS, ch_2Dimg_flags, ch_2Dimg_paths, ch_2Dimg_lists
             ):
                 if ch_2Dimg_flag:
-                    pos_max = bpf.pos_max
+                    pos_max = fish_geometry.pos_max
                     print(f"Stitching {ch_name} images...")
                     save_path_stitched_img = os.path.join(ch_2Dimg_path, f"{ch_name.casefold()}_stitched")
                     save_path_stitched_edited_img = os.path.join(ch_2Dimg_path, f"{ch_name.casefold()}_stitched_bgsub_rescaled")
@@ -212,7 +195,7 @@ if action_flag != 2: # not 'only mip' so stitch
                             else:
                                 img_list_per_tp[j] = img
 
-                        stitched_img, stitched_img_bgsub = bpf.img_stitcher_2D(global_coords_px, img_list_per_tp)
+                        stitched_img, stitched_img_bgsub = bpf.img_stitcher_2D(fish_geometry, img_list_per_tp)
                         # By default, the min/max intensities of the input image are stretched to the limits allowed by the image’s dtype,
                         # since in_range defaults to ‘image’ and out_range defaults to ‘dtype’:
                         # stitched_img_bgsub_rescaled = ski.exposure.rescale_intensity(stitched_img_bgsub) #produces images with pulsing mean intensity
@@ -227,15 +210,125 @@ if action_flag != 2: # not 'only mip' so stitch
                                 ski.exposure.match_histograms(image=stitched_img_bgsub, reference=ref_img_histogram)
                             ).astype(og_datatype)
 
-                        ski.io.imsave(
+                        bpf.save_image(
                             os.path.join(save_path_stitched_img, f"Timepoint{i+1}_{ch_name}_stitched.png"),
                             stitched_img,
-                            check_contrast=False,
                         )  # save the stitched image
-                        ski.io.imsave(
+                        bpf.save_image(
                             os.path.join(save_path_stitched_edited_img, f"Timepoint{i+1}_{ch_name}_stitched.png"),
                             stitched_img_bgsub_rescaled,
-                            check_contrast=False,
                         )  # save the bg subtracted stitched image
 
-print(f'Done! Processed images are in: {new_trg}')
\ No newline at end of file
+
+def parse_args(argv):
+    """parses the command line options, same as the interactive prompts"""
+    parser = argparse.ArgumentParser(
+        description="Find the MIPs of the z-stacks in an original LSM acquisition folder and/or stitch them"
+    )
+    parser.add_argument(
+        "--action",
+        type=int,
+        choices=[1, 2, 3],
+        default=1,
+        help="1: find MIPs and stitch (default), 2: only find MIPs, 3: only stitch",
+    )
+    parser.add_argument("--src", help="parent folder of the original images (with 'Acquisition' folders)")
+    parser.add_argument("--trg", help="destination folder (action 3: the '_mip_stitched' folder to stitch)")
+    parser.add_argument(
+        "--channels",
+        type=parse_ch_numbers,
+        default=[0, 1, 2],
+        help="channel numbers to process, 0: Brightfield, 1: GFP, 2: RFP (default 012)",
+    )
+    parser.add_argument(
+        "--scope", type=str.upper, choices=["KLA", "WIL"], help="LSM scope, found from the image size if not given"
+    )
+    parser.add_argument("--ds-factor", type=int, help="downscaling factor of the images, found from the image size if not given")
+    args = parser.parse_args(argv)
+    if args.action == 3 and not args.trg:
+        parser.error("--trg (the folder to stitch) is needed")
+    if args.action != 3 and (not args.src or not args.trg or os.path.normpath(args.src) == os.path.normpath(args.trg)):
+        parser.error("--src and --trg are needed and cannot be the same folder")
+    if not args.channels:
+        parser.error("--channels needs valid channel numbers, e.g. 012")
+    return args
+
+
+def prompt_args():
+    """asks the user for the options
+    Returns: options in the same form as parse_args"""
+    args = argparse.Namespace(src=None, channels=[0, 1, 2], scope=None, ds_factor=None)
+    action_flag = 0
+    while action_flag == 0:
+        action_flag = int(input(
+        """This code will find Max intensity projections of `z-stacks` and stitch the resulting images using the metadata found in `notes`
+            Run this *ONLY* on the original acquisition folder of LSM images as it uses the folder structure to find the images
+            Warning: This code ONLY works with single channel z-stack tiff images. It will give unpredictable results with >3 dimensions
+            Number of fish, positions and timepoints can be different in each folder, but channel names should be consistent
+             
+            Do you want to:
+                1. Find Max Intensity Projection AND Stitch (default)
+                2. Only find Max Intensity Projection
+                3. Only Stitch\n"""
+                )
+                or "1"
+        )
+
+        if action_flag == 1 or action_flag == 2 or action_flag == 3:
+            break
+        else:
+            action_flag = 0
+            print("Invalid value: Re-Enter")
+    args.action = action_flag
+
+    if action_flag == 3:  # only stitch, so take the input from the user as it wasn't taken before
+        args.trg = os.path.normpath(
+            input("""Enter the folder with images to stitch:
+                  Note- it must have the notes.txt, can have multiple `Acquisition` folders\n"""))
+        return args
+
+    #get source and target directories
+    src, trg = "", ""
+    while src == trg or src == "" or trg == "":
+        src = os.path.normpath(
+            input("Enter the Parent folder for original images (should contain 'Acquisition' folders): ")
+        )
+        trg = os.path.normpath(input("Enter the Destination folder: "))
+        if src == trg:
+            print("Parent and Destination folders cannot be empty or have the same location. Re-Enter..")
+    args.src, args.trg = src, trg
+    #get ch_list to process mips
+    user_ch_list = None
+    while not user_ch_list:
+        user_input = input("""Enter the channel numbers to process MIPs: 
+                            0: Brightfield, 1: GFP, 2: RFP (e.g. '012' for all 3 channels):\n""")
+        user_ch_list = parse_ch_numbers(user_input)
+        if not user_ch_list:
+            print("Invalid input. Please enter valid channel numbers.")
+    args.channels = user_ch_list
+    return args
+
+
+def run(args, interactive=False):
+    """finds the MIPs and/or stitches them with the options from parse_args or prompt_args,
+    with interactive=False a failed LSM scope detection exits instead of asking the user
+    Returns: new_trg = folder with the processed images"""
+    if args.action != 3: # find MIP
+        new_trg = generate_mips_n_copy_bf(os.path.normpath(args.src), os.path.normpath(args.trg), args.channels)
+    else:  # only stitch the given folder
+        new_trg = os.path.normpath(args.trg)
+    if args.action != 2: # not 'only mip' so stitch
+        stitch_acquisitions(new_trg, args.scope, args.ds_factor, interactive)
+    print(f'Done! Processed images are in: {new_trg}')
+    return new_trg
+
+
+def main(argv=None):
+    """runs with the command line options, or asks for them if there are none"""
+    argv = sys.argv[1:] if argv is None else argv
+    interactive_flag = not argv
+    run(prompt_args() if interactive_flag else parse_args(argv), interactive_flag)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,112 +1,268 @@
+"""Downsample all tiff images inside the acquisition folders by n and/or sort them by channel, images are processed
+in parallel.
+
+Run without arguments to be asked for every option, or give them on the command line for unattended jobs, e.g.
+    python -m PARALLEL_user_friendly_downsampling_mip_stitch_batchprocess_code.run1_downsample_multi_acquisition_n_sort_by_channel
+        --src D:/exp1 --trg E:/ -n 2,4 --cores 8 --codec zstd
+The functions can also be imported, e.g. downsample_acquisitions(src, trg, [4], num_cores=8).
+"""
+
+import argparse
 import os
-import shutil
+import sys
 from pathlib import Path
 
 import PARALLEL_user_friendly_downsampling_mip_stitch_batchprocess_code.batchprocessing_functions_v4_parallel as bpf
 
-# %%
-action_flag = 0
-while action_flag == 0:
-    print("Downsample all tiff images inside acquisition folder by n, enter n=1 for simple copy")
-    print("Sort images ONLY if the original filename has the channel name(BF/GFP/RFP)")
-    action_flag = int(
-        input(
-            """Do you want to:
-                        1. Downsample and sort images by channel (default)
-                        2. Only Downsample images
-                        3. Only Sort images by channel\n"""
-        )
-        or "1"
-    )
-    if action_flag == 1 or action_flag == 2 or action_flag == 3:
-        break
-    else:
-        action_flag = 0
-        print("Invalid value: Re-Enter")
-
-# %%
-# get user input for source and dest
-src, trg = "", ""
-while src == trg or src == "" or trg == "":
-    src = os.path.normpath(
-        input("Enter the Parent folder for original images (should contain 'Acquisition' folders): ")
-    )
-    trg = os.path.normpath(input("Enter the Destination folder: "))
-    if src == trg:
-        print("Parent and Destination folders cannot be empty or have the same location. Re-Enter..")
-
-# n is the downscaling factor in x and y, change it accordingly.
-n = int(input("Enter downscaling factor for x and y dimensions (default=4):") or "4")
-if n < 1:
-    print("User Error: downscaling factor MUST be a positive integer. Exiting")
-    exit()
-elif n == 1:
-    print("Downscaling factor is 1, no downscaling will be done but images will be compressed.")
-    print("Images will be saved in '.tif' format with Lossless 'Deflate' compression. This should reduce file size by ~ 50%.")
-    user_confirm = input("Do you want to continue? ([y]/n):") or "y"
-    if user_confirm.casefold() != "y":
-        print("Exiting..")
-        exit()
-    
-num_cores = int(
-    input("Enter the number of cores to use for parallel processing (default '-3'): ")
-    or "-3"
-)
-
-# single_fish_flag is used to find if single acquisitions have single fish or not
-# single_fish_input = input("Is there ONLY 1 fish per Acquisition? ([y]/n):") or "y"
-# if single_fish_input.casefold() not in ("y", "n"):
-#     print("User Error: Need to enter 'y' or 'n'. Exiting")
-#     exit()
-# single_fish_flag = True if single_fish_input.casefold() == "y" else False
-
-# %%
-new_folder_name = f"{os.path.split(src)[-1]}_downsampled_n{n}"
-trg_path = os.path.join(trg, new_folder_name)
-bpf.check_create_save_path(trg_path)
-
-# %%
-if action_flag != 3:  # Downsample
+SORT_CHANNELS = ["BF", "GFP", "RFP"]
+
+
+def get_trg_path_list(src, trg, n_list, zarr_factors=None):
+    """Returns: list of the target folders in trg, one '<src name>_downsampled_n<factor>' per factor in n_list,
+    or the single '<src name>_omezarr' folder in OME-Zarr mode"""
+    if zarr_factors:
+        return [os.path.join(trg, f"{os.path.split(src)[-1]}_omezarr")]
+    # one folder per downscaling factor
+    return [os.path.join(trg, f"{os.path.split(src)[-1]}_downsampled_n{factor}") for factor in n_list]
+
+
+def downsample_acquisitions(
+    src, trg, n_list, num_cores=-3, zarr_factors=None, mip_flag=False, codec=None, byte_budget=None
+):
+    """downsamples all 'Acquisition' folders in src by every factor in n_list with num_cores processes using at most
+    byte_budget bytes of RAM (see bpf.single_acquisition_downsample_parallel) into the folders of get_trg_path_list,
+    with their full resolution MIPs in '<src name>_mip' if mip_flag
+    Returns: list of the target folders"""
+    trg_path_list = get_trg_path_list(src, trg, n_list, zarr_factors)
+    for trg_path in trg_path_list:
+        bpf.check_create_save_path(trg_path)
+    mip_trg_path = os.path.join(trg, f"{os.path.split(src)[-1]}_mip")
+    print("Indexing acquisitions..")  # slow only the first time, later runs only rescan changed folders
+    bpf.update_acquisition_index(src)
     print("Downsampling images..")
     # oswalk to find all acquisition folders
-    for root, subfolders, filenames in os.walk(src):
+    for root, subfolders, filenames in bpf.walk_acquisition(src):
         for sub in subfolders:  # separate by acquisitions
             if "acquisition" in sub.casefold():
-                single_trg_path = root.replace(src, trg_path)
+                single_trg_path_list = [root.replace(src, trg_path) for trg_path in trg_path_list]
 
                 multi_acq_folder_flag = bpf.find_multi_subdir(subdir_path=root, subdir_name='acquisition')
                 if multi_acq_folder_flag:
                     # print("Multiple acquisition folders found at the same level...")
-                    single_trg_path = os.path.join(single_trg_path, sub)
+                    single_trg_path_list = [os.path.join(single_trg_path, sub) for single_trg_path in single_trg_path_list]
 
                 single_acq_path = os.path.join(root, sub)
-                path = Path(single_trg_path) # copy entire folder structure
-                path.mkdir(parents=True, exist_ok=True)
+                for single_trg_path in single_trg_path_list:
+                    path = Path(single_trg_path) # copy entire folder structure
+                    path.mkdir(parents=True, exist_ok=True)
+
+                single_mip_trg_path = None
+                if mip_flag:  # mirror the folder structure for the full resolution MIPs
+                    single_mip_trg_path = root.replace(src, mip_trg_path)
+                    if multi_acq_folder_flag:
+                        single_mip_trg_path = os.path.join(single_mip_trg_path, sub)
+                bpf.single_acquisition_downsample_parallel(
+                    single_acq_path,
+                    single_trg_path_list,
+                    n_list,
+                    num_cores,
+                    single_mip_trg_path,
+                    zarr_factors,
+                    codec,
+                    byte_budget,
+                )
+    return trg_path_list
 
-                bpf.single_acquisition_downsample_parallel(single_acq_path, single_trg_path, n, num_cores)
 
-if action_flag != 2:  # Sort by channel
+def sort_by_channel(read_dirs, sub_dirs=SORT_CHANNELS):
+    """moves the tiff images in read_dirs into a subfolder per channel in sub_dirs found in their names, a file already
+    in the subfolder (e.g. from an earlier run) is replaced. The run manifests in read_dirs are updated with the new
+    locations, so a rerun still skips the images downsampled before"""
     print("Sorting images by channel..")
-    # sort images by channel
-    sub_dirs = ["BF", "GFP", "RFP"]
-    read_dir = trg_path
-
-    for root, subfolders, filenames in os.walk(read_dir):
-        for filename in filenames:
-            filepath = os.path.join(root, filename)
-            # print(f'Reading: {filepath}')
-            filename_list = filename.split(".")
-            og_name = filename_list[0]  # first of list=name
-            ext = filename_list[-1]  # last of list=extension
-
-            if ext == "tif" or ext == "tiff":  # only if tiff file
-                # check image channel and create directory if it doesn't exist
-                for sub in sub_dirs:
-                    if sub.casefold() in og_name.casefold():
-                        dest = os.path.join(root, sub)
-                        if not os.path.exists(dest):  # check if the subdir exists
-                            print("New path doesn't exist.")
-                            os.makedirs(dest)
-                            print(f"Directory '{sub}' created")
-                        shutil.move(filepath, dest)  # move files
-print("Successfully completed all tasks!")
+    moved_paths, manifest_paths = {}, []
+    for read_dir in read_dirs:  # every downscaling factor folder
+        for root, subfolders, filenames in os.walk(read_dir):
+            # don't move the MIPs saved in fused mode, OME-Zarr pyramids are folders and are not sorted
+            # and images already sorted into channel folders stay there
+            subfolders[:] = [
+                sub for sub in subfolders if not sub.casefold().endswith(("_mip", ".zarr")) and sub not in sub_dirs
+            ]
+            for filename in filenames:
+                filepath = os.path.join(root, filename)
+                # print(f'Reading: {filepath}')
+                if filename == bpf.MANIFEST_NAME:
+                    manifest_paths.append(filepath)
+                    continue
+                filename_list = filename.split(".")
+                og_name = filename_list[0]  # first of list=name
+                ext = filename_list[-1]  # last of list=extension
+
+                if (ext == "tif" or ext == "tiff") and not filename.startswith(bpf.TMP_PREFIX):  # only finished tiff files
+                    # check image channel and create directory if it doesn't exist
+                    for sub in sub_dirs:
+                        if sub.casefold() in og_name.casefold():
+                            dest = os.path.join(root, sub)
+                            if not os.path.exists(dest):  # check if the subdir exists
+                                print("New path doesn't exist.")
+                                os.makedirs(dest)
+                                print(f"Directory '{sub}' created")
+                            moved_paths[filepath] = os.path.join(dest, filename)
+                            os.replace(filepath, moved_paths[filepath])  # move files
+                            break
+    for manifest_path in manifest_paths:
+        bpf.relocate_manifest_outputs(manifest_path, moved_paths)
+
+
+def parse_args(argv):
+    """parses the command line options, same as the interactive prompts"""
+    parser = argparse.ArgumentParser(
+        description="Downsample all tiff images inside acquisition folders by n and/or sort them by channel, in parallel"
+    )
+    parser.add_argument(
+        "--action",
+        type=int,
+        choices=[1, 2, 3],
+        default=1,
+        help="1: downsample and sort by channel (default), 2: only downsample, 3: only sort by channel",
+    )
+    parser.add_argument("--src", required=True, help="parent folder of the original images (with 'Acquisition' folders)")
+    parser.add_argument("--trg", required=True, help="destination folder")
+    parser.add_argument(
+        "-n", type=bpf.parse_int_list, default=[4], help="downscaling factor(s) in x and y, e.g. 4 or 2,4,8 (default 4)"
+    )
+    parser.add_argument("--cores", type=int, default=-3, help="number of processes, negative for all but n-1 cores (default -3)")
+    parser.add_argument(
+        "--mem-budget", type=float, help="GB of RAM the processes may use at once (default 70%% of the available RAM)"
+    )
+    parser.add_argument("--codec", help="tiff compression, e.g. zstd, deflate:6 or zstd:3+predictor (default none)")
+    parser.add_argument(
+        "--zarr", type=bpf.parse_int_list, metavar="LEVELS", help="save OME-Zarr pyramids with these levels, e.g. 1,2,4,8"
+    )
+    parser.add_argument("--mip", action="store_true", help="also save the MIPs of z-stacks in the same pass")
+    parser.add_argument(
+        "--channels", type=lambda text: text.split(","), default=SORT_CHANNELS, help="channels to sort (default BF,GFP,RFP)"
+    )
+    args = parser.parse_args(argv)
+    if os.path.normpath(args.src) == os.path.normpath(args.trg):
+        parser.error("--src and --trg cannot be the same folder")
+    if min(args.n) < 1:
+        parser.error("downscaling factor MUST be a positive integer")
+    bpf.parse_codec(args.codec)  # exits now on a typo instead of after reading the first image
+    return args
+
+
+def prompt_args():
+    """asks the user for the options
+    Returns: options in the same form as parse_args"""
+    args = argparse.Namespace(channels=SORT_CHANNELS, mem_budget=None)
+    action_flag = 0
+    while action_flag == 0:
+        print("Downsample all tiff images inside acquisition folder by n, enter n=1 for simple copy")
+        print("Sort images ONLY if the original filename has the channel name(BF/GFP/RFP)")
+        action_flag = int(
+            input(
+                """Do you want to:
+                        1. Downsample and sort images by channel (default)
+                        2. Only Downsample images
+                        3. Only Sort images by channel\n"""
+            )
+            or "1"
+        )
+        if action_flag == 1 or action_flag == 2 or action_flag == 3:
+            break
+        else:
+            action_flag = 0
+            print("Invalid value: Re-Enter")
+    args.action = action_flag
+
+    # get user input for source and dest
+    src, trg = "", ""
+    while src == trg or src == "" or trg == "":
+        src = os.path.normpath(
+            input("Enter the Parent folder for original images (should contain 'Acquisition' folders): ")
+        )
+        trg = os.path.normpath(input("Enter the Destination folder: "))
+        if src == trg:
+            print("Parent and Destination folders cannot be empty or have the same location. Re-Enter..")
+    args.src, args.trg = src, trg
+
+    # n is the downscaling factor in x and y, change it accordingly.
+    # several factors (e.g. 2,4,8) are all made from one read of the raw images, each in its own folder
+    n_list = bpf.parse_int_list(
+        input("Enter downscaling factor(s) for x and y dimensions, e.g. '4' or '2,4,8' (default=4):") or "4"
+    )
+    if min(n_list) < 1:
+        print("User Error: downscaling factor MUST be a positive integer. Exiting")
+        exit()
+    elif 1 in n_list:
+        print("Downscaling factor is 1, no downscaling will be done but images will be compressed.")
+        print("Images will be saved in '.tif' format with Lossless compression ('Deflate' unless chosen below). This should reduce file size by ~ 50%.")
+        user_confirm = input("Do you want to continue? ([y]/n):") or "y"
+        if user_confirm.casefold() != "y":
+            print("Exiting..")
+            exit()
+    args.n = n_list
+
+    # tiff compression of every saved image, e.g. 'zstd', 'deflate:6' or 'zstd:3+predictor' (predictor helps smooth images)
+    args.codec = (
+        input(
+            "Enter the tiff compression ([none], deflate, zstd, lzw, lzma, optional ':level' and '+predictor'; n=1 copies default to deflate):"
+        )
+        or None
+    )
+    bpf.parse_codec(args.codec)  # exits now on a typo instead of after reading the first image
+
+    args.cores = int(
+        input("Enter the number of cores to use for parallel processing (default '-3'): ")
+        or "-3"
+    )
+
+    # OME-Zarr mode: one chunked pyramid per image with every downscaling level, instead of one tiff per run of n
+    args.zarr = None
+    zarr_flag = (
+        input("Save OME-Zarr pyramids with several downscaling levels instead of tiff? (y/[n]):") or "n"
+    ).casefold() == "y"
+    if zarr_flag:
+        args.zarr = bpf.parse_int_list(input("Enter the pyramid levels (default '1,2,4,8'):") or "1,2,4,8")
+        print(f"Images will be saved as '.ome.zarr' pyramids with levels {args.zarr}, n is not used")
+
+    # fused mode: read each raw stack once to also find the full resolution and downsampled MIPs
+    args.mip = (
+        input("Also find Max Intensity Projections in the same pass? (saves running run2 for MIPs) (y/[n]):") or "n"
+    ).casefold() == "y"
+    if args.mip:
+        print(f"Full resolution MIPs will be saved in: {os.path.join(trg, f'{os.path.split(src)[-1]}_mip')}")
+        print("Downsampled MIPs will be saved in '<channelname>_mip' folders next to the downsampled images")
+
+    # single_fish_flag is used to find if single acquisitions have single fish or not
+    # single_fish_input = input("Is there ONLY 1 fish per Acquisition? ([y]/n):") or "y"
+    # if single_fish_input.casefold() not in ("y", "n"):
+    #     print("User Error: Need to enter 'y' or 'n'. Exiting")
+    #     exit()
+    # single_fish_flag = True if single_fish_input.casefold() == "y" else False
+    return args
+
+
+def run(args):
+    """downsamples and/or sorts the images with the options from parse_args or prompt_args"""
+    src, trg = os.path.normpath(args.src), os.path.normpath(args.trg)
+    if args.action != 3:  # Downsample
+        byte_budget = int(args.mem_budget * 1024**3) if args.mem_budget else None
+        trg_path_list = downsample_acquisitions(
+            src, trg, args.n, args.cores, args.zarr, args.mip, args.codec, byte_budget
+        )
+    else:  # sort the folders downsampled earlier
+        trg_path_list = get_trg_path_list(src, trg, args.n, args.zarr)
+    if args.action != 2:  # Sort by channel
+        sort_by_channel(trg_path_list, args.channels)
+    print("Successfully completed all tasks!")
+
+
+def main(argv=None):
+    """runs with the command line options, or asks for them if there are none"""
+    argv = sys.argv[1:] if argv is None else argv
+    run(prompt_args() if not argv else parse_args(argv))
+
+
+if __name__ == "__main__":
+    main()
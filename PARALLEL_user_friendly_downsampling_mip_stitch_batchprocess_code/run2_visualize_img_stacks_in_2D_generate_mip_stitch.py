@@ -15,126 +15,210 @@
 #
 # Detail: now this works with multi folder/multi acquisition
 
+# %% [markdown]
+# Run without arguments to be asked for every option, or give them on the command line for unattended jobs, e.g.
+#     python -m PARALLEL_user_friendly_downsampling_mip_stitch_batchprocess_code.run2_visualize_img_stacks_in_2D_generate_mip_stitch
+#         --top-dir D:/exp1_downsampled_n4 --cores 8 --tiled --scope KLA
+# The functions can also be imported, e.g. generate_mips(top_dir, 8) and stitch_all_fish(top_dir, 8).
+
+import argparse
 import os
+import sys
 
-import skimage
-import tifffile as tiff
 from natsort import natsorted
-from tqdm import tqdm
 
 import PARALLEL_user_friendly_downsampling_mip_stitch_batchprocess_code.batchprocessing_functions_v4_parallel as bpf
 
-action_flag = 0
+STITCH_CHANNELS = ["BF", "GFP_mip", "RFP_mip"]
+
+
+def generate_mips(
+    top_dir, num_cores=-3, codec=None, byte_budget=None, projections=("max",), slab=None, z_ranges=None
+):
+    """finds the MIPs (or the other projections, see bpf.PROJECTIONS) of all z-stacks in top_dir with num_cores
+    processes using at most byte_budget bytes of RAM (see bpf.oswalk_batchprocess_mip_parallel), and the MIPs of
+    the z slabs if slab (slab size, stride, see bpf.parse_slab) or z_ranges (see bpf.parse_z_ranges) are given"""
+    slab_size, slab_stride = slab or (None, None)
+    bpf.update_acquisition_index(top_dir)  # later walks over top_dir only rescan changed folders
+    bpf.oswalk_batchprocess_mip_parallel(
+        main_dir=top_dir,
+        num_cores=num_cores,
+        codec=codec,
+        byte_budget=byte_budget,
+        projections=projections,
+        slab_size=slab_size,
+        slab_stride=slab_stride,
+        z_ranges=z_ranges,
+    )
+
+
+def find_fish_dirs(top_dir):
+    """Returns: natsorted list of the folders in top_dir with BF/GFP/RFP subfolders, each with ONE fish data"""
+    # all unique BF/GFP/RFP location gets added to the main_dir_list
+    main_dir_list = []
+    for root, subfolders, _ in bpf.walk_acquisition(top_dir):
+        if ("BF" in subfolders) or ("GFP" in subfolders) or ("RFP" in subfolders):
+            main_dir_list.append(root)
+    return natsorted(main_dir_list)
+
+
+def stitch_all_fish(
+    top_dir, num_cores=-3, tiled_flag=False, scope=None, ds_factor=None, interactive=True, byte_budget=None
+):
+    """stitches every fish found in top_dir, timepoints and channels in parallel using at most byte_budget bytes of RAM
+    (see bpf.stitch_2D_images_parallel), as png or as tiled tiff (512x512 tiles, Deflate) if tiled_flag.
+    scope, ds_factor and interactive are passed to bpf.find_lsm_scope"""
+    save_ext, tile_size, codec = ("tif", 512, "deflate") if tiled_flag else ("png", None, None)
+    main_dir_list = find_fish_dirs(top_dir)
+    print(f"Found these fish data:\n{main_dir_list}")
+
+    # main_dir = location of Directory containing ONE fish data
+    for main_dir in main_dir_list:
+        print(f"Processing {main_dir}...")
+        ch_2Dimg_flags, ch_2Dimg_paths, ch_2Dimg_lists = bpf.find_2D_images(main_dir)
+        fish_geometry = bpf.find_stage_coords_n_pixel_width_from_2D_images(
+            ch_2Dimg_flags, ch_2Dimg_paths, ch_2Dimg_lists, scope, ds_factor, interactive
+        )
+
+        # timepoints and channels are stitched in parallel
+        bpf.stitch_2D_images_parallel(
+            fish_geometry,
+            STITCH_CHANNELS,
+            ch_2Dimg_flags,
+            ch_2Dimg_paths,
+            ch_2Dimg_lists,
+            num_cores,
+            save_ext,
+            tile_size,
+            codec,
+            byte_budget,
+        )
+
+
+def parse_args(argv):
+    """parses the command line options, same as the interactive prompts"""
+    parser = argparse.ArgumentParser(
+        description="Find the MIPs of the z-stacks and/or stitch them to visualize them, in parallel"
+    )
+    parser.add_argument(
+        "--action",
+        type=int,
+        choices=[1, 2, 3],
+        default=1,
+        help="1: find MIPs and stitch (default), 2: only find MIPs, 3: only stitch",
+    )
+    parser.add_argument("--top-dir", required=True, help="top directory with ALL acquisitions")
+    parser.add_argument("--cores", type=int, default=-3, help="number of processes, negative for all but n-1 cores (default -3)")
+    parser.add_argument(
+        "--mem-budget", type=float, help="GB of RAM the processes may use at once (default 70%% of the available RAM)"
+    )
+    parser.add_argument("--codec", help="tiff compression of the MIPs, e.g. zstd or deflate:6 (default none)")
+    parser.add_argument(
+        "--projections",
+        type=bpf.parse_projections,
+        default=["max"],
+        help=f"projections found in one pass, any of {','.join(bpf.PROJECTIONS)} (default max)",
+    )
+    parser.add_argument(
+        "--slab",
+        type=bpf.parse_slab,
+        metavar="SIZE[:STRIDE]",
+        help="also save the MIPs of z slabs of SIZE planes every STRIDE planes (default SIZE), e.g. 25:5",
+    )
+    parser.add_argument(
+        "--z-ranges", type=bpf.parse_z_ranges, help="also save the MIPs of these planes (from 1), e.g. 1-50,100-150"
+    )
+    parser.add_argument("--tiled", action="store_true", help="save stitched images as tiled tiff instead of png")
+    parser.add_argument(
+        "--scope", type=str.upper, choices=["KLA", "WIL"], help="LSM scope, found from the image size if not given"
+    )
+    parser.add_argument("--ds-factor", type=int, help="downscaling factor of the images, found from the image size if not given")
+    args = parser.parse_args(argv)
+    bpf.parse_codec(args.codec)  # exits now on a typo instead of after reading the first image
+    return args
+
 
-while action_flag == 0:
-    action_flag = int(
-        input(
-            """Do you want to:
+def prompt_args():
+    """asks the user for the options
+    Returns: options in the same form as parse_args"""
+    args = argparse.Namespace(
+        codec=None, tiled=False, scope=None, ds_factor=None, mem_budget=None, projections=["max"], slab=None, z_ranges=None
+    )
+    action_flag = 0
+    while action_flag == 0:
+        action_flag = int(
+            input(
+                """Do you want to:
                         1. Find Max Intensity Projection AND Stitch (default)
                         2. Only find Max Intensity Projection
                         3. Only Stitch\n"""
+            )
+            or "1"
         )
-        or "1"
-    )
-    if action_flag == 1 or action_flag == 2 or action_flag == 3:
-        break
-    else:
-        action_flag = 0
-        print("Invalid value: Re-Enter")
-
-if action_flag != 2:  # more info for stitching
-    print(
-        """Instructions for stitching:
+        if action_flag == 1 or action_flag == 2 or action_flag == 3:
+            break
+        else:
+            action_flag = 0
+            print("Invalid value: Re-Enter")
+    args.action = action_flag
+
+    if action_flag != 2:  # more info for stitching
+        print(
+            """Instructions for stitching:
         - Image stitching works by reading stage positions from the 'notes.txt' file generated during acquisition
         - Images MUST have:
             a. 'timepoint' substring in their names
             b. 'pos' or 'region' substring in their names
             c. channel substring(BF/GFP/RFP) in their names"""
+        )
+
+        user_check = input("Do you want to continue? (y/[n])") or "n"
+        if user_check.casefold() == "n":
+            print("Okay, bye!")
+            exit()
+
+    args.top_dir = os.path.normpath(input("Enter the top directory with ALL acquisitions: "))
+    args.cores = int(
+        input("Enter the number of cores to use for parallel processing (default '-3'): ")
+        or "-3"
     )
 
-    user_check = input("Do you want to continue? (y/[n])") or "n"
-    if user_check.casefold() == "n":
-        print("Okay, bye!")
-        exit()
-
-top_dir = os.path.normpath(input("Enter the top directory with ALL acquisitions: "))
-num_cores = int(
-    input("Enter the number of cores to use for parallel processing (default '-3'): ")
-    or "-3"
-)
-
-# %%
-if action_flag != 3:
-    bpf.oswalk_batchprocess_mip_parallel(main_dir=top_dir, num_cores=num_cores)
-
-# # Stitching
-if action_flag == 2:  # don't stitch and exit
-    exit()
-
-## Stitching
-# all unique BF/GFP/RFP location gets added to the main_dir_list
-main_dir_list = []
-for root, subfolders, _ in os.walk(top_dir):
-    if ("BF" in subfolders) or ("GFP" in subfolders) or ("RFP" in subfolders):
-        main_dir_list.append(root)
-main_dir_list = natsorted(main_dir_list)
-print(f"Found these fish data:\n{main_dir_list}")
-
-ch_names = ["BF", "GFP_mip", "RFP_mip"]
-
-# main_dir = location of Directory containing ONE fish data
-for main_dir in main_dir_list:
-    print(f"Processing {main_dir}...")
-    ch_2Dimg_flags, ch_2Dimg_paths, ch_2Dimg_lists = bpf.find_2D_images(main_dir)
-    stage_coords = bpf.find_stage_coords_n_pixel_width_from_2D_images(ch_2Dimg_flags, ch_2Dimg_paths, ch_2Dimg_lists)
-    global_coords_px = bpf.global_coordinate_changer(stage_coords)
-
-    for ch_name, ch_2Dimg_flag, ch_2Dimg_path, ch_2Dimg_list in zip(
-        ch_names, ch_2Dimg_flags, ch_2Dimg_paths, ch_2Dimg_lists
-    ):
-        if ch_2Dimg_flag:
-            pos_max = bpf.pos_max
-            print(f"Stitching {ch_name} images...")
-            save_path_stitched_img = os.path.join(ch_2Dimg_path, f"{ch_name.casefold()}_stitched")
-            save_path_stitched_edited_img = os.path.join(ch_2Dimg_path, f"{ch_name.casefold()}_stitched_bgsub_rescaled")
-            bpf.check_create_save_path(save_path_stitched_img)
-            bpf.check_create_save_path(save_path_stitched_edited_img)
-
-            for i in tqdm(range(len(ch_2Dimg_list) // pos_max)):  # run once per timepoint
-                # print(f"tp: {i+1}")
-                img_list_per_tp = [0] * pos_max
-                for j in range(0, pos_max):
-                    loc = i * pos_max + j
-                    # print(loc)
-                    # save all pos images in 3D array
-                    img = tiff.imread(os.path.join(ch_2Dimg_path, ch_2Dimg_list[loc]))
-                    if len(img.shape) != 2:
-                        print(f"{ch_2Dimg_list[loc]}: Image shape is not 2D... something is wrong. exiting...")
-                        exit()
-                    else:
-                        img_list_per_tp[j] = img
-
-                stitched_img, stitched_img_bgsub = bpf.img_stitcher_2D(global_coords_px, img_list_per_tp)
-                # By default, the min/max intensities of the input image are stretched to the limits allowed by the image’s dtype, since in_range defaults to ‘image’ and out_range defaults to ‘dtype’:
-                # stitched_img_bgsub_rescaled = skimage.exposure.rescale_intensity(stitched_img_bgsub) #produces images with pulsing mean intensity
-
-                og_datatype = stitched_img_bgsub.dtype
-                # use histogram matching using the first image
-                if i == 0:  # set first stitched image as reference
-                    ref_img_histogram = stitched_img_bgsub
-                    stitched_img_bgsub_rescaled = stitched_img_bgsub
-                else:  # match remaining images histogram to the first image
-                    stitched_img_bgsub_rescaled = (
-                        skimage.exposure.match_histograms(image=stitched_img_bgsub, reference=ref_img_histogram)
-                    ).astype(og_datatype)
-
-                skimage.io.imsave(
-                    os.path.join(save_path_stitched_img, f"Timepoint{i+1}_{ch_name}_stitched.png"),
-                    stitched_img,
-                    check_contrast=False,
-                )  # save the stitched image
-                skimage.io.imsave(
-                    os.path.join(save_path_stitched_edited_img, f"Timepoint{i+1}_{ch_name}_stitched.png"),
-                    stitched_img_bgsub_rescaled,
-                    check_contrast=False,
-                )  # save the bg subtracted stitched image
+    if action_flag != 3:
+        # mean/std projections for QC and the argmax (depth of the max) map are found in the same pass as the MIP
+        args.projections = bpf.parse_projections(
+            input(f"Enter the projections to find, any of {','.join(bpf.PROJECTIONS)} (default 'max'): ") or "max"
+        )
+        # a full depth MIP of a thick stack washes out structure, MIPs of z slabs are found in the same pass
+        slab_text = input("Enter the slab size and stride for slab MIPs, e.g. '25:5' ([none]): ")
+        args.slab = bpf.parse_slab(slab_text) if slab_text.strip() else None
+        z_ranges_text = input("Enter z ranges (planes from 1) for more slab MIPs, e.g. '1-50,100-150' ([none]): ")
+        args.z_ranges = bpf.parse_z_ranges(z_ranges_text) or None
+
+    if action_flag != 2:
+        # tiled tiffs open faster than png in Fiji/napari when zooming into a region of large stitched images
+        args.tiled = (
+            input("Save stitched images as tiled tiff (512x512 tiles, Deflate) instead of png? (y/[n])") or "n"
+        ).casefold() == "y"
+    return args
+
+
+def run(args, interactive=False):
+    """finds the MIPs and/or stitches them with the options from parse_args or prompt_args,
+    with interactive=False a failed LSM scope detection exits instead of asking the user"""
+    top_dir = os.path.normpath(args.top_dir)
+    byte_budget = int(args.mem_budget * 1024**3) if args.mem_budget else None
+    if args.action != 3:
+        generate_mips(top_dir, args.cores, args.codec, byte_budget, args.projections, args.slab, args.z_ranges)
+    if args.action != 2:  # Stitching
+        stitch_all_fish(top_dir, args.cores, args.tiled, args.scope, args.ds_factor, interactive, byte_budget)
+
+
+def main(argv=None):
+    """runs with the command line options, or asks for them if there are none"""
+    argv = sys.argv[1:] if argv is None else argv
+    interactive_flag = not argv
+    run(prompt_args() if interactive_flag else parse_args(argv), interactive_flag)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,69 +7,73 @@
 #
 # License: GNU GPL v3.0
 
+# %% [markdown]
+# Run without arguments to be asked for every option, or give them on the command line for unattended jobs, e.g.
+#     python batchprocess_stitch_3D_images.py --top-dir D:/exp1 --save-dir E:/ --bg-sub --codec Zstd:3 --tile-size 512
+# with --cores 8 the regions of a timepoint are read by 8 processes that place them in a shared stitched image
+# The functions can also be imported, e.g. stitch_3D_all_fish(top_dir, bg_sub_flag=True).
+
+import argparse
 import os
+import sys
 
 from natsort import natsorted
 from tqdm import tqdm
 
 import user_friendly_downsampling_mip_stitch_batchprocess_code.batchprocessing_functions_v5 as bpf
 
-print(
-    """Instructions for stitching:
-    - Image stitching works by reading stage positions from the 'notes.txt' file generated during acquisition
-    - Images MUST have:
-        a. 'timepoint' substring in their names
-        b. 'pos' or 'region' substring in their names
-        c. channel substring(GFP/RFP) in their names"""
-)
-top_dir = os.path.normpath(input("Enter the top directory with ALL acquisitions: "))
-
-# all unique GFP/RFP location gets added to the main_dir_list
-main_dir_list = []
-for root, subfolders, _ in os.walk(top_dir):
-    if ("GFP" in subfolders) or ("RFP" in subfolders):
-        main_dir_list.append(root)
-main_dir_list = natsorted(main_dir_list)
-print(f"Found these fish data:\n{main_dir_list}")
-
-diff_savedir_flag = (
-    input("Do you want to save the images in a different folder? (y/[n])") or "n"
-).casefold() == "y"
-if diff_savedir_flag:
-    user_save_dir = os.path.normpath(input("Enter the save dir: "))
-    new_save_dir = os.path.join(
-        user_save_dir, f"{os.path.basename(top_dir)}_3D_stitched"
-    )
-    bpf.check_create_save_path(new_save_dir)
+ch_names = ["GFP", "RFP"]
 
-bg_sub_flag = (
-    input("Do you want to subtract background? (y/[n])") or "n"
-).casefold() == "y"
 
-# get compression type from user
-compression_type = (
-    input("Enter the compression type ([Deflate], LZW, LZMA, Zstd): ") or "Deflate"
-)
+def find_fish_dirs(top_dir):
+    """Returns: natsorted list of the folders in top_dir with GFP/RFP subfolders, each with ONE fish data"""
+    # all unique GFP/RFP location gets added to the main_dir_list
+    main_dir_list = []
+    for root, subfolders, _ in os.walk(top_dir):
+        if ("GFP" in subfolders) or ("RFP" in subfolders):
+            main_dir_list.append(root)
+    return natsorted(main_dir_list)
 
-ch_names = ["GFP", "RFP"]
 
-for (
-    main_dir
-) in main_dir_list:  # main_dir = location of Directory containing ONE fish data
-    print(f"Processing {main_dir}...")
+def stitch_3D_fish(
+    main_dir,
+    top_dir,
+    new_save_dir=None,
+    bg_sub_flag=False,
+    compression_type="Deflate",
+    tile_size=None,
+    low_mem_flag=False,
+    save_ext="tif",
+    scope=None,
+    ds_factor=None,
+    interactive=True,
+    num_cores=1,
+):
+    """stitches all timepoints of the GFP/RFP z-stacks of the fish in main_dir into '<channelname>_3D_stitched'
+    folders next to the images, or under new_save_dir (mirroring the folders below top_dir) if given.
+    compression_type: tiff codec (see bpf.parse_codec), save_ext: 'tif' or 'ome.zarr',
+    low_mem_flag: stitch plane by plane (see bpf.img_stitcher_3D_streaming),
+    num_cores: processes reading the regions of a timepoint (see img_stitcher_3D_parallel) when more than 1,
+    scope, ds_factor and interactive are passed to bpf.find_lsm_scope
+    Returns: save_path of the last stitched channel"""
+    if num_cores != 1 and not low_mem_flag:
+        # the parallel module imports joblib and psutil, only needed here
+        from PARALLEL_user_friendly_downsampling_mip_stitch_batchprocess_code.batchprocessing_functions_v4_parallel import (
+            img_stitcher_3D_parallel,
+        )
+    save_path = None
     ch_3Dimg_flags, ch_3Dimg_paths, ch_3Dimg_lists = bpf.find_3D_images(main_dir)
-    stage_coords = bpf.find_stage_coords_n_pixel_width_from_3D_images(
-        ch_3Dimg_flags, ch_3Dimg_paths, ch_3Dimg_lists
+    fish_geometry = bpf.find_stage_coords_n_pixel_width_from_3D_images(
+        ch_3Dimg_flags, ch_3Dimg_paths, ch_3Dimg_lists, scope, ds_factor, interactive
     )
-    global_coords_px = bpf.global_coordinate_changer(stage_coords)
 
     for ch_name, ch_3Dimg_flag, ch_3Dimg_path, ch_3Dimg_list in zip(
         ch_names, ch_3Dimg_flags, ch_3Dimg_paths, ch_3Dimg_lists
     ):
         if ch_3Dimg_flag:
-            pos_max = bpf.pos_max
+            pos_max = fish_geometry.pos_max
             print(f"Stitching {ch_name} 3D images...")
-            if diff_savedir_flag:
+            if new_save_dir:
                 save_subdir = main_dir.replace(top_dir, "").strip(
                     os.sep
                 )  # find and remove the top_dir from the main_dir
@@ -81,6 +85,16 @@ for (
                     ch_3Dimg_path, f"{ch_name.casefold()}_3D_stitched"
                 )
             bpf.check_create_save_path(save_path)
+            # timepoints stitched in an earlier run are skipped (see the run manifest in the save folder)
+            manifest_path = os.path.join(save_path, bpf.MANIFEST_NAME)
+            manifest = bpf.load_manifest(manifest_path)
+            params_digest = bpf.params_hash(
+                coords=fish_geometry.global_coords_px.tolist(),
+                bg_sub=bg_sub_flag,
+                compression=compression_type,
+                tile_size=tile_size,
+                save_ext=save_ext,
+            )
 
             for i in tqdm(
                 range(len(ch_3Dimg_list) // pos_max)
@@ -96,19 +110,194 @@ for (
                     )
 
                 if bg_sub_flag:
-                    save_name = f"Timepoint{i+1}_{ch_name}_stitched_3D_bg_sub.tif"
+                    save_name = f"Timepoint{i+1}_{ch_name}_stitched_3D_bg_sub.{save_ext}"
+                else:
+                    save_name = f"Timepoint{i+1}_{ch_name}_stitched_3D.{save_ext}"
+                if bpf.is_up_to_date(manifest, "stitch_3D", img_path_list_per_tp, params_digest):
+                    continue
+
+                if low_mem_flag:
+                    bpf.img_stitcher_3D_streaming(
+                        fish_geometry,
+                        img_path_list_per_tp,
+                        os.path.join(save_path, save_name),
+                        bg_sub_flag,
+                        compression_type,
+                        tile_size,
+                    )
+                elif num_cores != 1:
+                    img_stitcher_3D_parallel(
+                        fish_geometry,
+                        img_path_list_per_tp,
+                        num_cores,
+                        bg_sub_flag,
+                        os.path.join(save_path, save_name),
+                        compression_type,
+                        tile_size,
+                    )
                 else:
-                    save_name = f"Timepoint{i+1}_{ch_name}_stitched_3D.tif"
-
-                bpf.img_stitcher_3D(
-                    global_coords_px,
-                    img_path_list_per_tp,
-                    bg_sub_flag,
-                    os.path.join(save_path, save_name),
-                    compression_type,
+                    bpf.img_stitcher_3D(
+                        fish_geometry,
+                        img_path_list_per_tp,
+                        bg_sub_flag,
+                        os.path.join(save_path, save_name),
+                        compression_type,
+                        tile_size,
+                    )
+                bpf.append_manifest(
+                    manifest_path, "stitch_3D", img_path_list_per_tp, params_digest, [os.path.join(save_path, save_name)]
                 )
+    return save_path
+
+
+def stitch_3D_all_fish(
+    top_dir,
+    save_dir=None,
+    bg_sub_flag=False,
+    compression_type="Deflate",
+    tile_size=None,
+    low_mem_flag=False,
+    zarr_flag=False,
+    scope=None,
+    ds_factor=None,
+    interactive=True,
+    num_cores=1,
+):
+    """stitches every fish found in top_dir (see stitch_3D_fish), in '<top_dir name>_3D_stitched' inside save_dir
+    if given, as OME-Zarr pyramids if zarr_flag
+    Returns: save_path of the last stitched channel"""
+    main_dir_list = find_fish_dirs(top_dir)
+    print(f"Found these fish data:\n{main_dir_list}")
+    new_save_dir = None
+    if save_dir:
+        new_save_dir = os.path.join(
+            save_dir, f"{os.path.basename(top_dir)}_3D_stitched"
+        )
+        bpf.check_create_save_path(new_save_dir)
+    save_ext = "ome.zarr" if zarr_flag else "tif"
+
+    save_path = None
+    for (
+        main_dir
+    ) in main_dir_list:  # main_dir = location of Directory containing ONE fish data
+        print(f"Processing {main_dir}...")
+        save_path = stitch_3D_fish(
+            main_dir,
+            top_dir,
+            new_save_dir,
+            bg_sub_flag,
+            compression_type,
+            tile_size,
+            low_mem_flag,
+            save_ext,
+            scope,
+            ds_factor,
+            interactive,
+            num_cores,
+        ) or save_path
+    return save_path
+
+
+def parse_args(argv):
+    """parses the command line options, same as the interactive prompts"""
+    parser = argparse.ArgumentParser(description="Stitch the GFP/RFP z-stacks of every fish using the notes.txt stage positions")
+    parser.add_argument("--top-dir", required=True, help="top directory with ALL acquisitions")
+    parser.add_argument("--save-dir", help="save the stitched images in this folder instead of next to the images")
+    parser.add_argument("--bg-sub", action="store_true", help="subtract the background")
+    parser.add_argument(
+        "--codec", default="Deflate", help="tiff compression, e.g. Deflate, Zstd:3+predictor or None (default Deflate)"
+    )
+    parser.add_argument("--tile-size", type=int, help="tile size for tiled tiff, e.g. 256 or 512 (default untiled)")
+    parser.add_argument("--low-mem", action="store_true", help="stitch plane by plane to save RAM")
+    parser.add_argument(
+        "--cores", type=int, default=1, help="processes reading the regions of a timepoint, negative for all but n-1 cores (default 1)"
+    )
+    parser.add_argument("--zarr", action="store_true", help="save as OME-Zarr pyramid instead of tiff")
+    parser.add_argument(
+        "--scope", type=str.upper, choices=["KLA", "WIL"], help="LSM scope, found from the image size if not given"
+    )
+    parser.add_argument("--ds-factor", type=int, help="downscaling factor of the images, found from the image size if not given")
+    args = parser.parse_args(argv)
+    bpf.parse_codec(args.codec)  # exits now on a typo instead of after stitching the first image
+    return args
+
+
+def prompt_args():
+    """asks the user for the options
+    Returns: options in the same form as parse_args"""
+    args = argparse.Namespace(save_dir=None, scope=None, ds_factor=None, cores=1)
+    print(
+        """Instructions for stitching:
+    - Image stitching works by reading stage positions from the 'notes.txt' file generated during acquisition
+    - Images MUST have:
+        a. 'timepoint' substring in their names
+        b. 'pos' or 'region' substring in their names
+        c. channel substring(GFP/RFP) in their names"""
+    )
+    args.top_dir = os.path.normpath(input("Enter the top directory with ALL acquisitions: "))
+
+    diff_savedir_flag = (
+        input("Do you want to save the images in a different folder? (y/[n])") or "n"
+    ).casefold() == "y"
+    if diff_savedir_flag:
+        args.save_dir = os.path.normpath(input("Enter the save dir: "))
+
+    args.bg_sub = (
+        input("Do you want to subtract background? (y/[n])") or "n"
+    ).casefold() == "y"
+
+    # get compression type from user, a level and/or horizontal differencing can be added e.g. 'Zstd:3+predictor'
+    args.codec = (
+        input("Enter the compression type ([Deflate], LZW, LZMA, Zstd, None, optional ':level' and '+predictor'): ")
+        or "Deflate"
+    )
+    bpf.parse_codec(args.codec)  # exits now on a typo instead of after stitching the first image
+
+    # tiled tiffs let Fiji/napari (and bpf.read_tiff_roi) read only the tiles of the region they show
+    args.tile_size = int(
+        input("Enter the tile size for tiled tiff, e.g. 256 or 512 ([0] for untiled): ") or "0"
+    ) or None
+
+    # the streaming stitcher writes one z plane at a time, needed when the stitched image doesn't fit in RAM
+    args.low_mem = (
+        input("Stitch plane by plane to save RAM (for large full resolution images)? (y/[n])") or "n"
+    ).casefold() == "y"
+
+    # OME-Zarr output: chunked multiscale pyramid (levels 1, 2, 4, 8) that viewers can browse without loading everything
+    args.zarr = (
+        input("Save as OME-Zarr pyramid instead of tiff? (y/[n])") or "n"
+    ).casefold() == "y"
+    return args
+
+
+def run(args, interactive=False):
+    """stitches the 3D images with the options from parse_args or prompt_args,
+    with interactive=False a failed LSM scope detection exits instead of asking the user"""
+    save_path = stitch_3D_all_fish(
+        os.path.normpath(args.top_dir),
+        os.path.normpath(args.save_dir) if args.save_dir else None,
+        args.bg_sub,
+        args.codec,
+        args.tile_size,
+        args.low_mem,
+        args.zarr,
+        args.scope,
+        args.ds_factor,
+        interactive,
+        args.cores,
+    )
+    print(f'Done! Processed images are in: {save_path}')
+
+
+def main(argv=None):
+    """runs with the command line options, or asks for them if there are none"""
+    argv = sys.argv[1:] if argv is None else argv
+    interactive_flag = not argv
+    run(prompt_args() if interactive_flag else parse_args(argv), interactive_flag)
+    if interactive_flag:
+        #wait for user to close the window
+        input("Press Enter to close the program...")
+
 
-print(f'Done! Processed images are in: {save_path}')
-#wait for user to close the window
-input("Press Enter to close the program...")
-exit()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
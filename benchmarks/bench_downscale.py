@@ -0,0 +1,59 @@
+"""Throughput of the integer downscaling kernel (bpf.downscale_planes_int) against the skimage float path it replaced,
+in megapixels of input per second.
+
+    python benchmarks/bench_downscale.py --shape 20,2048,2048 -n 2,4,8
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import skimage.transform
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import user_friendly_downsampling_mip_stitch_batchprocess_code.batchprocessing_functions_v5 as bpf  # noqa: E402
+
+
+def skimage_downscale(img, n):
+    """the downscaling before the integer kernel"""
+    kernel = (1,) * (img.ndim - 2) + (n, n)
+    return np.round(skimage.transform.downscale_local_mean(img, kernel)).astype(img.dtype)
+
+
+def best_time(func, repeat):
+    """Returns: fastest of repeat runs of func in seconds"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the integer downscaling kernel against skimage")
+    parser.add_argument("--shape", type=bpf.parse_int_list, default=[10, 2048, 2048], help="image shape (default 10,2048,2048)")
+    parser.add_argument("-n", type=bpf.parse_int_list, default=[2, 4, 8], help="downscaling factors (default 2,4,8)")
+    parser.add_argument("--dtype", default="uint16", help="image dtype (default uint16)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement, the fastest is kept (default 3)")
+    args = parser.parse_args(argv)
+
+    dtype = np.dtype(args.dtype)
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, np.iinfo(dtype).max, size=args.shape, endpoint=True, dtype=dtype)
+    megapixels = img.size / 1e6
+    print(f"image {img.shape} {dtype}, {megapixels:.1f} MP")
+    print(f"{'n':>3} {'kernel MP/s':>12} {'skimage MP/s':>13} {'speedup':>8}")
+    for n in args.n:
+        kernel_time = best_time(lambda: bpf.downscale_planes_int(img, n), args.repeat)
+        skimage_time = best_time(lambda: skimage_downscale(img, n), args.repeat)
+        print(
+            f"{n:>3} {megapixels / kernel_time:>12.1f} {megapixels / skimage_time:>13.1f} "
+            f"{skimage_time / kernel_time:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -9,13 +9,16 @@ import numpy as np
 import skimage
 import tifffile as tiff
 
+import user_friendly_downsampling_mip_stitch_batchprocess_code.batchprocessing_functions_v5 as bpf
+
 #ask the user for the inputs
 print('Warning: This code ONLY works with single channel z-stack tiff images. It will give unpredictable results with >3 dimensions')
 main_dir = os.path.normpath(input('Enter the Parent directory where ALL the image stacks are stored: '))
 bg_sub_flag = ''
-while bg_sub_flag!='y' or bg_sub_flag!='n':
+while bg_sub_flag not in ('y', 'n'):
     bg_sub_flag = input('do you want median background subtraction? (y/n)')
-    print('enter a valid value')
+    if bg_sub_flag not in ('y', 'n'):
+        print('enter a valid value')
 
 # Batchprocess MIP
 channel_names = ['GFP', 'RFP']
@@ -28,17 +31,16 @@ for root, subfolders, filenames in os.walk(main_dir):
         og_name = filename_list[0] #first of list=name
         ext = filename_list[-1] #last of list=extension
 
-        if ext=="tif" or ext=="tiff": #tiff files
-            read_image = tiff.imread(filepath)
+        if (ext=="tif" or ext=="tiff") and not bpf.check_overflowed_stack(og_name): #tiff files, '_MMStack_1' files are read with their stack
+            arr_mip_wo_bg_sub = bpf.stream_mip(filepath) #create MIP, one plane in memory at a time
 
-            if len(read_image.shape)==3: #check if 3D images
+            if arr_mip_wo_bg_sub is not None: #check if 3D images
                 print(f'Processing MIP for: {filepath}')
                 if bg_sub_flag=='y':
-                    arr_mip_wo_bg_sub = np.max(read_image, axis=0) #create MIP
                     arr_mip = arr_mip_wo_bg_sub - np.median(arr_mip_wo_bg_sub) #subtract median
                     arr_mip[arr_mip<0] = 0 #make all negative values zero
                 else:
-                    arr_mip = np.max(read_image, axis=0) #create MIP
+                    arr_mip = arr_mip_wo_bg_sub
 
                 for ch_name in channel_names: #save mip array in right directory with correct channel name
                     if ch_name.casefold() in og_name.casefold():
@@ -49,9 +51,7 @@ for root, subfolders, filenames in os.walk(main_dir):
                             print(f"Directory '{ch_name.casefold()}_mip' created")
 
                         img_mip = skimage.util.img_as_uint(skimage.exposure.rescale_intensity(arr_mip))
-                        if og_name.endswith('_MMStack_1'): #skip file
-                            continue
-                        elif og_name.endswith('_MMStack'): #remove 'MMStack' in saved name
+                        if og_name.endswith('_MMStack'): #remove 'MMStack' in saved name
                             save_name = og_name[:-len('_MMStack')]+'_mip.'+ext
                         else:
                             save_name = og_name+'_mip.'+ext
@@ -13,21 +13,35 @@ to strings using str() or vice versa with pathlib.Path().
 """
 
 import contextlib
+import copy
+import functools
 import json
+import mmap
 import os
 import pathlib
+import re
 import shutil
 from ast import literal_eval
-from configparser import ConfigParser
 from enum import Enum
 
 import numpy as np
 import psutil
 import skimage.io
 from natsort import natsorted
-from tifffile import TiffFile
+
+from user_friendly_downsampling_mip_stitch_batchprocess_code.batchprocessing_functions_v5 import (
+    load_notes_table,
+    read_tiff_stack,
+)
+
+try:  # optional, several times faster to decode the Micro-Manager metadata
+    import orjson
+except ImportError:
+    orjson = None
 
 RE_NUM = "[0-9]"
+# top level keys of a Micro-Manager *_metadata.txt file, the value of each is a JSON object
+RE_MM_METADATA_KEY = re.compile(rb'"(Summary|FrameKey-[0-9-]+)"\s*:\s*')
 
 
 class ImageFileType(Enum):
@@ -336,12 +350,12 @@ def read_image(file_path: pathlib.Path) -> np.ndarray:
 
     This is mostly here because tifffile loads in all images from all image 
     files that share metadata, which hogs memory. If file_path is a tif file,
-    this loads in only the images stored in that file.
+    this loads in only the images stored in that file. Uncompressed tif files
+    (e.g. Micro-Manager MMStack files) are returned as a read-only memory-mapped
+    view instead of a copy.
     """
     if get_file_type(file_path) == ImageFileType.TIF:
-        stack = TiffFile(file_path)
-        num_pages = len(stack.pages)
-        image = stack.asarray(range(num_pages))
+        image = read_tiff_stack(file_path, single_file=True)
     else:
         image = skimage.io.imread(file_path)
     return image
@@ -401,6 +415,78 @@ def from_same_mm_series(file_list) -> bool:
         return False
 
 
+def index_mm_metadata(file_path: pathlib.Path) -> dict:
+    """
+    Finds where the value of every top level key ("Summary" and the 
+    "FrameKey-..." keys) is in a Micro-Manager metadata file, without parsing
+    the JSON, so single frames can be decoded later with 
+    read_mm_metadata_value. The index is cached per file path and 
+    modification time.
+
+    ### Returns:
+
+    index: dict
+        {key: (start, end)} byte offsets of the values, in file order.
+    """
+    file_stat = os.stat(file_path)
+    return _index_mm_metadata(
+        os.path.abspath(file_path), file_stat.st_mtime_ns, file_stat.st_size)
+
+
+@functools.lru_cache(maxsize=64)
+def _index_mm_metadata(file_path: str, mtime_ns: int, file_size: int) -> dict:
+    if file_size == 0:
+        return {}
+    with open(file_path, "rb") as file, \
+            mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        keys = [(match.group(1).decode(), match.start(), match.end())
+                for match in RE_MM_METADATA_KEY.finditer(buffer)]
+    # each value ends where the next key starts, the last one at the end of file
+    ends = [key_start for _, key_start, _ in keys[1:]] + [file_size]
+    return {key: (value_start, end) for (key, _, value_start), end in zip(keys, ends)}
+
+
+def read_mm_metadata_value(file_path: pathlib.Path, key: str):
+    """
+    Decodes the value of one top level key of a Micro-Manager metadata file
+    (see index_mm_metadata), with orjson if it is installed, else (or for 
+    values orjson rejects, e.g. NaN) with json. Falls back to parsing the 
+    whole file, once per file version, if the value can't be cut out cleanly.
+    """
+    index = index_mm_metadata(file_path)
+    if key not in index:
+        raise KeyError(key)
+    start, end = index[key]
+    with open(file_path, "rb") as file:
+        file.seek(start)
+        value = file.read(end - start).rstrip()
+    file_stat = os.stat(file_path)
+    if end == file_stat.st_size and value.endswith(b"}"):
+        value = value[:-1].rstrip()  # closing brace of the whole file
+    value = value.rstrip(b",")
+    if orjson:
+        try:
+            return orjson.loads(value)
+        except ValueError:  # e.g. NaN values, which json accepts
+            pass
+    try:
+        return json.loads(value)
+    except ValueError:  # e.g. a key string inside a value
+        metadata_dict = _load_mm_metadata(
+            os.path.abspath(file_path), file_stat.st_mtime_ns, file_stat.st_size)
+        return copy.deepcopy(metadata_dict[key])
+
+
+@functools.lru_cache(maxsize=4)
+def _load_mm_metadata(file_path: str, mtime_ns: int, file_size: int) -> dict:
+    """
+    Whole metadata file, cached per file path and modification time for the 
+    values read_mm_metadata_value can't decode on their own.
+    """
+    with open(file_path) as file:
+        return json.load(file)
+
+
 class MMMetadata(object):
     """
     Class to hold Micro-Manager metadata from Micro-Manager tif stack files.
@@ -409,6 +495,9 @@ class MMMetadata(object):
 
     file_path: str
         file path of MM tif image.
+
+    Only the Summary block is decoded when the object is made, the metadata
+    of each frame is decoded when it is needed (see get_frame_metadata).
     """
     #Possible axes in Micro-Manager metadata
     _Z = "z"
@@ -418,53 +507,61 @@ class MMMetadata(object):
 
     def __init__(self, file_path: pathlib.Path):
         self.file_path = file_path
-        self._metadata_dict: dict = self._get_metadata_dict()
-        self.summary_metadata: dict = self._metadata_dict["Summary"]
+        self.metadata_path: pathlib.Path = self._get_metadata_path()
+        self.summary_metadata: dict = read_mm_metadata_value(
+            self.metadata_path, "Summary")
         self.axis_order = self._get_axis_order()
-        self.frame_keys: list = [k for k in self._metadata_dict if "FrameKey" in k]
+        self.frame_keys: list = [
+            k for k in index_mm_metadata(self.metadata_path) if "FrameKey" in k]
         self.image_width: int = int(self.summary_metadata["Width"])
         self.image_height: int = int(self.summary_metadata["Height"])
         self.dims: dict = self._get_dimensions()
         self.num_dims: int = len(self.dims)
         self.directory = str(pathlib.Path(file_path).parent)
-        self.all_filenames: list = self._get_all_filenames()
-        self.is_multifile: bool = len(self.all_filenames) > 1
+
+    @functools.cached_property
+    def all_filenames(self) -> list:
+        return self._get_all_filenames()
+
+    @property
+    def is_multifile(self) -> bool:
+        return len(self.all_filenames) > 1
 
     def get_image_metadata(self, image_num: int):
         return MMImageMetadata(self, image_num)
+
+    def get_frame_metadata(self, frame_key: str) -> dict:
+        return read_mm_metadata_value(self.metadata_path, frame_key)
     
     def get_filename_start_num(self, filename: pathlib.Path):
         filename = pathlib.Path(filename).name
         for key in self.frame_keys:
-            meta_filename = self._metadata_dict[key]["FileName"]
+            meta_filename = self.get_frame_metadata(key)["FileName"]
             if filename == meta_filename:
                 return self.frame_keys.index(key)
 
-    def _get_metadata_dict(self) -> dict:
+    def _get_metadata_path(self) -> pathlib.Path:
         file_path = pathlib.Path(self.file_path)
         filename = get_reduced_filename(file_path)
         if file_path.is_file():
             if get_file_type(file_path) in ImageFileType:
                 file_path = file_path.parent
-        file_generator = file_path.iterdir()
-        parent_files = [file for file in file_generator]
-        for file in parent_files:
-            if is_mm_metadata(file_path) and filename in file.name:
-                return json.load(open(file))
+        metadata_files = [file for file in file_path.iterdir() if is_mm_metadata(file)]
+        for file in metadata_files:
+            if filename in file.name:
+                return file
         else:
             #If no metadata file is found that matches name of image, assume
             #only one metadata file is in folder that doesn't match name.
-            for file in parent_files:
-                if is_mm_metadata(file):
-                    return json.load(open(file))  
+            for file in metadata_files:
+                return file
         raise FileNotFoundError("MMMetadata file not found in directory.")
 
     def _get_axis_order(self):
-        axis_order: list = self.summary_metadata["AxisOrder"]
         #Delete position axis because images at different x-y stage positions
         #in MM are saved in different files with different metadata files.
-        axis_order.remove(self._POSITION)
-        return axis_order
+        return [axis for axis in self.summary_metadata["AxisOrder"]
+                if axis != self._POSITION]
 
     def _get_dimensions(self) -> dict:
         intended_dims = self.summary_metadata["IntendedDimensions"]
@@ -476,7 +573,7 @@ class MMMetadata(object):
     def _get_all_filenames(self):
         filenames = []
         for key in self.frame_keys:
-            filename = self._metadata_dict[key]["FileName"]
+            filename = self.get_frame_metadata(key)["FileName"]
             if filename not in filenames:
                 filenames.append(filename)
         return filenames
@@ -487,7 +584,7 @@ class MMImageMetadata(object):
         self._mm_metadata: MMMetadata = mm_metadata
         self.image_index: int = image_index
         self.framekey: str = mm_metadata.frame_keys[image_index]
-        self.image_metadata: dict = mm_metadata._metadata_dict[self.framekey]
+        self.image_metadata: dict = mm_metadata.get_frame_metadata(self.framekey)
         self.coords: dict = self._get_coords()
         self.pixel_size: float = float(self.image_metadata["PixelSizeUm"])
         self.binning: int = int(self.image_metadata["Binning"])
@@ -553,28 +650,25 @@ class LSPycroMetadata(object):
     REGION = "Region"
 
     def __init__(self, path: pathlib.Path):
-        self.config = ConfigParser()
-        self._init_config(path)
+        # parsed once per notes file and modification time, shared with the stitchers
+        self.notes_table = load_notes_table(self._find_notes_file(path))
+        self.config = self.notes_table.config
 
-    def _init_config(self, path: pathlib.Path):
+    def _find_notes_file(self, path: pathlib.Path) -> str:
         path = pathlib.Path(path)
         if path.is_file() and is_ls_pycro_notes(path):
-            self.config.read(file)
-        elif self.ACQUISITION in path:
-            cur_directory = path
+            return str(path)
+        elif any(self.ACQUISITION in part for part in path.parts):
+            cur_directory = path if path.is_dir() else path.parent
             while self.ACQUISITION not in cur_directory.name:
                 cur_directory = cur_directory.parent
-            file_generator = pathlib.Path(cur_directory)
-            file_list = [str(file) for file in file_generator]
-            for file in file_list:
+            for file in natsorted(cur_directory.iterdir()):
                 if is_ls_pycro_notes(file):
-                    self.config.read(file)
-                    break
-            else:
-                raise FileNotFoundError("LSPycroMetadata file not found.")
+                    return str(file)
+            raise FileNotFoundError("LSPycroMetadata file not found.")
         else:
             raise FileNotFoundError("LSPycroMetadata file not found. Not ls pycro acquisition.")
-    
+
     def get_section_dict(self, section: str) -> dict:
         section_dict = {}
         for item in self.config.items(section):
@@ -586,19 +680,15 @@ class LSPycroMetadata(object):
         return self.get_section_dict(section)
     
     def get_num_fish(self) -> int:
-        num_fish = 0
-        for section in self.config.sections():
-            if self.FISH in section and self.REGION in section:
-                num_fish += 1
-        return num_fish
-    
+        return len(np.unique(self.notes_table.fish))
+
     def get_num_regions(self, fish_num: int) -> int:
-        region_num = 1
-        section = self._get_region_section(fish_num, region_num)
-        while self.config.has_section(section):
-            region_num += 1
-            section = self._get_region_section(fish_num, region_num)
-        return region_num - 1
+        return int(np.count_nonzero(self.notes_table.fish == fish_num))
+
+    def get_stage_coords(self, fish_num: int) -> np.ndarray:
+        """Returns: stage x, y, z of the regions of fish fish_num, in region order"""
+        fish_rows = np.flatnonzero(self.notes_table.fish == fish_num)
+        return self.notes_table.coords[fish_rows[np.argsort(self.notes_table.region[fish_rows])]]
 
     def _get_region_section(self, fish_num: int, region_num: int) -> str:
         return f"{self.FISH} {fish_num} {self.REGION} {region_num}"
@@ -0,0 +1,152 @@
+"""the SQLite acquisition index follows changes to the tree and walk_acquisition walks it like os.walk"""
+
+import os
+
+import numpy as np
+import pytest
+
+import user_friendly_downsampling_mip_stitch_batchprocess_code.batchprocessing_functions_v5 as bpf
+
+
+@pytest.fixture
+def experiment(tmp_path, monkeypatch):
+    """experiment tree with two fish folders of small z-stacks, a BF image and a notes.txt"""
+    monkeypatch.setattr(bpf, "ACQ_INDEX_DIR", str(tmp_path / "index"))
+    top_dir = tmp_path / "exp1"
+    for fish in (1, 2):
+        fish_dir = top_dir / "Acquisition" / f"fish{fish}"
+        fish_dir.mkdir(parents=True)
+        for ch in ("GFP", "RFP"):
+            img = np.zeros((3, 8, 8), np.uint16)
+            bpf.tiff.imwrite(fish_dir / f"fish{fish}_pos1_{ch}_timepoint1_MMStack.ome.tif", img)
+        bpf.tiff.imwrite(fish_dir / f"fish{fish}_pos1_BF_timepoint1.tif", np.zeros((8, 8), np.uint8))
+    (top_dir / "Acquisition" / "notes.txt").write_text("[Fish 1 Region 1]\n")
+    return top_dir
+
+
+def touch_dir(dir_path):
+    """moves the mtime of dir_path forward, filesystems with coarse timestamps can keep it within a test"""
+    mtime_ns = os.stat(dir_path).st_mtime_ns + 10**9
+    os.utime(dir_path, ns=(mtime_ns, mtime_ns))
+
+
+def walk_listing(walk):
+    """Returns: {root: (sorted subfolders, sorted filenames)} of an os.walk like generator"""
+    return {os.fspath(root): (sorted(subfolders), sorted(filenames)) for root, subfolders, filenames in walk}
+
+
+def indexed_paths(top_dir, **filters):
+    return [os.path.relpath(record["path"], top_dir) for record in bpf.query_acquisition_index(top_dir, **filters)]
+
+
+def test_walk_acquisition_matches_os_walk(experiment):
+    assert walk_listing(bpf.walk_acquisition(experiment)) == walk_listing(os.walk(experiment))  # not indexed yet
+    bpf.update_acquisition_index(experiment)
+    assert walk_listing(bpf.walk_acquisition(experiment)) == walk_listing(os.walk(experiment))
+    sub_dir = experiment / "Acquisition" / "fish2"
+    assert walk_listing(bpf.walk_acquisition(sub_dir)) == walk_listing(os.walk(sub_dir))
+
+
+def test_walk_acquisition_prunes_subfolders_in_place(experiment):
+    bpf.update_acquisition_index(experiment)
+    roots = []
+    for root, subfolders, _ in bpf.walk_acquisition(experiment):
+        roots.append(os.path.relpath(root, experiment))
+        subfolders[:] = [sub for sub in subfolders if sub != "fish1"]
+    assert roots == [".", "Acquisition", os.path.join("Acquisition", "fish2")]
+
+
+def test_query_acquisition_index_records(experiment):
+    assert bpf.query_acquisition_index(experiment) is None  # not indexed
+    bpf.update_acquisition_index(experiment)
+    records = bpf.query_acquisition_index(experiment, channel="GFP")
+    assert [os.path.relpath(record["path"], experiment) for record in records] == [
+        os.path.join("Acquisition", f"fish{fish}", f"fish{fish}_pos1_GFP_timepoint1_MMStack.ome.tif") for fish in (1, 2)
+    ]
+    assert records[1]["fish"] == 2 and records[1]["region"] == 1 and records[1]["timepoint"] == 1
+    assert records[1]["shape"] == (3, 8, 8) and records[1]["dtype"] == "uint16"
+    assert len(bpf.query_acquisition_index(experiment)) == 6  # tiff files only, not notes.txt
+    with pytest.raises(ValueError):
+        bpf.query_acquisition_index(experiment, colour="GFP")
+
+
+def test_index_finds_new_files(experiment):
+    bpf.update_acquisition_index(experiment)
+    fish_dir = experiment / "Acquisition" / "fish1"
+    bpf.tiff.imwrite(fish_dir / "fish1_pos2_GFP_timepoint1_MMStack.ome.tif", np.zeros((4, 8, 8), np.uint16))
+    touch_dir(fish_dir)
+    records = bpf.query_acquisition_index(experiment, fish=1, region=2)
+    assert [record["shape"] for record in records] == [(4, 8, 8)]
+
+
+def test_index_drops_removed_folders(experiment):
+    bpf.update_acquisition_index(experiment)
+    fish_dir = experiment / "Acquisition" / "fish2"
+    for filename in os.listdir(fish_dir):
+        os.remove(fish_dir / filename)
+    fish_dir.rmdir()
+    touch_dir(experiment / "Acquisition")
+    assert indexed_paths(experiment, fish=2) == []
+    assert len(indexed_paths(experiment)) == 3
+    assert walk_listing(bpf.walk_acquisition(experiment)) == walk_listing(os.walk(experiment))
+
+
+def test_index_follows_renamed_files_and_folders(experiment):
+    bpf.update_acquisition_index(experiment)
+    acq_dir = experiment / "Acquisition"
+    os.rename(acq_dir / "fish2", acq_dir / "fish3")
+    touch_dir(acq_dir)
+    fish3_dir = acq_dir / "fish3"
+    os.rename(fish3_dir / "fish2_pos1_BF_timepoint1.tif", fish3_dir / "fish3_pos1_BF_timepoint1.tif")
+    touch_dir(fish3_dir)
+    assert indexed_paths(experiment, channel="BF") == [
+        os.path.join("Acquisition", "fish1", "fish1_pos1_BF_timepoint1.tif"),
+        os.path.join("Acquisition", "fish3", "fish3_pos1_BF_timepoint1.tif"),
+    ]
+    assert not any(path.startswith(os.path.join("Acquisition", "fish2")) for path in indexed_paths(experiment))
+    assert walk_listing(bpf.walk_acquisition(experiment)) == walk_listing(os.walk(experiment))
+
+
+def test_unchanged_folders_are_not_listed_again(experiment, monkeypatch):
+    bpf.update_acquisition_index(experiment)
+    listed_dirs = []
+    scandir = os.scandir
+    monkeypatch.setattr(os, "scandir", lambda path: listed_dirs.append(os.fspath(path)) or scandir(path))
+    bpf.update_acquisition_index(experiment)
+    assert listed_dirs == []
+    fish_dir = experiment / "Acquisition" / "fish1"
+    (fish_dir / "fish1_notes.txt").write_text("")
+    touch_dir(fish_dir)
+    bpf.update_acquisition_index(experiment)
+    assert listed_dirs == [str(fish_dir)]
+
+
+def test_start_dir_refreshes_only_its_subtree(experiment):
+    bpf.update_acquisition_index(experiment)
+    acq_dir = experiment / "Acquisition"
+    for fish in (1, 2):
+        bpf.tiff.imwrite(acq_dir / f"fish{fish}" / f"fish{fish}_pos2_BF_timepoint1.tif", np.zeros((8, 8), np.uint8))
+        touch_dir(acq_dir / f"fish{fish}")
+    bpf.update_acquisition_index(experiment, start_dir=acq_dir / "fish2")
+    index_path = bpf.get_acquisition_index_path(experiment)
+    con = bpf.open_acquisition_index(index_path)
+    try:
+        filenames = {filename for (filename,) in con.execute("SELECT filename FROM files WHERE region = 2")}
+    finally:
+        con.close()
+    assert filenames == {"fish2_pos2_BF_timepoint1.tif"}  # fish1 isn't scanned until its subtree is refreshed
+    assert len(indexed_paths(acq_dir / "fish1", region=2)) == 1
+
+
+@pytest.mark.parametrize(
+    "rel_path, fields",
+    [
+        ("fish1/fish1_pos2_GFP_timepoint3_MMStack_1.ome.tif", (1, 2, "GFP", 3, 1)),
+        ("fish2/pos3/GFP/timepoint4_MMStack.ome.tif", (2, 3, "GFP", 4, None)),  # fields from the folder names
+        ("fish2/fish1_region3_rfp_timepoint4.tif", (1, 3, "RFP", 4, None)),  # the file name wins
+        ("fish1_mip/fish1_BFP.tif", (1, None, None, None, None)),
+    ],
+)
+def test_parse_acquisition_path(rel_path, fields):
+    keys = ("fish", "region", "channel", "timepoint", "overflow")
+    assert bpf.parse_acquisition_path(rel_path) == dict(zip(keys, fields))
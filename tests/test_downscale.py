@@ -0,0 +1,102 @@
+"""parity of the integer downscaling kernels with the skimage float path they replaced"""
+
+import numpy as np
+import pytest
+import skimage.transform
+
+import user_friendly_downsampling_mip_stitch_batchprocess_code.batchprocessing_functions_v5 as bpf
+
+FACTORS = [2, 3, 4, 8]
+SHAPES = [(37, 53), (64, 64), (5, 37, 53), (3, 64, 96)]  # odd and multiple of n sizes, 2D and 3D
+
+
+def reference_downscale(img, n):
+    """the downscaling before the integer kernel: float mean of each nxn block, rounded and cast back"""
+    kernel = (1,) * (img.ndim - 2) + (n, n)
+    return np.round(skimage.transform.downscale_local_mean(img, kernel)).astype(img.dtype)
+
+
+def random_image(shape, dtype, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(np.iinfo(dtype).min, np.iinfo(dtype).max, size=shape, endpoint=True, dtype=dtype)
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16, np.int16])
+@pytest.mark.parametrize("shape", SHAPES)
+@pytest.mark.parametrize("n", FACTORS)
+def test_downscale_planes_int_matches_skimage(n, shape, dtype):
+    img = random_image(shape, dtype)
+    result = bpf.downscale_planes_int(img, n)
+    assert result.dtype == img.dtype
+    np.testing.assert_array_equal(result, reference_downscale(img, n))
+
+
+@pytest.mark.parametrize("n", [2, 4, 8])
+def test_downscale_planes_int_rounds_ties_to_even(n):
+    # half of each block set to 1 and 3 gives means of 0.5 and 1.5, np.round rounds them to the even 0 and 2
+    img = np.zeros((2 * n, 2 * n), np.uint16)
+    img[:, : n // 2] = 1
+    img[:, n : n + n // 2] = 3
+    assert bpf.downscale_planes_int(img, n).tolist() == [[0, 2], [0, 2]]
+    np.testing.assert_array_equal(bpf.downscale_planes_int(img, n), reference_downscale(img, n))
+
+
+@pytest.mark.parametrize("shape", SHAPES)
+def test_downscale_pyramid_planes_matches_skimage(shape):
+    img = random_image(shape, np.uint16, seed=1)
+    factors = [1, 2, 3, 4, 8]
+    levels = bpf.downscale_pyramid_planes(img, factors)
+    np.testing.assert_array_equal(levels[0], img)
+    for factor, level in zip(factors[1:], levels[1:]):
+        np.testing.assert_array_equal(level, reference_downscale(img, factor))
+
+
+def test_stream_downscale_image_levels_writes_every_plane(tmp_path):
+    # every level writer must get all planes of the stack, not stop after the first one
+    img = random_image((7, 37, 53), np.uint16, seed=2)
+    read_path = tmp_path / "fish1_GFP_MMStack.ome.tif"
+    bpf.tiff.imwrite(read_path, img)
+    factors = [4, 2, 8]
+    save_paths = [tmp_path / f"ds_n{factor}.tif" for factor in factors]
+    mip_paths = [tmp_path / f"ds_n{factor}_mip.tif" for factor in factors]
+    ds_shapes = bpf.stream_downscale_image_levels(
+        read_path, save_paths, factors, pages_per_chunk=2, verbose=False, ds_mip_save_paths=mip_paths
+    )
+    assert ds_shapes == [(7, 19, 27), (7, 10, 14), (7, 5, 7)]  # by increasing factor
+    for factor, save_path, mip_path in zip(factors, save_paths, mip_paths):
+        level = bpf.tiff.imread(save_path)
+        assert level.shape[0] == img.shape[0]
+        np.testing.assert_array_equal(level, reference_downscale(img, factor))
+        np.testing.assert_array_equal(bpf.tiff.imread(mip_path), level.max(axis=0))
+
+
+def test_single_acquisition_downsample_streams_n1_copies(tmp_path, monkeypatch):
+    # n=1 copies a compressed stack and finds its MIPs page by page, like the parallel path, without reading it whole
+    monkeypatch.setattr(bpf, "ACQ_INDEX_DIR", str(tmp_path / "index"))
+    monkeypatch.setattr(bpf, "read_tiff_stack", lambda *args, **kwargs: pytest.fail("read the whole stack"))
+    img = random_image((6, 37, 53), np.uint16, seed=3)
+    acq_path = tmp_path / "Acquisition"
+    acq_path.mkdir()
+    bpf.tiff.imwrite(acq_path / "fish1_pos1_GFP_timepoint1_MMStack.ome.tif", img, compression="zlib")
+    trg_path, mip_trg_path = tmp_path / "n1", tmp_path / "mip"
+    bpf.single_acquisition_downsample(str(acq_path), str(trg_path), 1, mip_trg_path=str(mip_trg_path))
+    copy_path = trg_path / "fish1_pos1_GFP_timepoint1.tif"
+    np.testing.assert_array_equal(bpf.tiff.imread(copy_path), img)
+    with bpf.tiff.TiffFile(copy_path) as tif:
+        assert tif.pages[0].compression != bpf.tiff.COMPRESSION.NONE  # the default n=1 codec
+    for mip_dir in (trg_path, mip_trg_path):
+        mip = bpf.tiff.imread(mip_dir / "gfp_mip" / "fish1_pos1_GFP_timepoint1_mip.tif")
+        np.testing.assert_array_equal(mip, img.max(axis=0))
+
+
+@pytest.mark.parametrize("as_planes", [False, True])
+def test_write_tiff_saves_3_plane_stacks_as_planes(tmp_path, as_planes):
+    # a 3 plane z-stack (or slab MIP stack) is 3 grayscale pages, not one RGB page
+    img = random_image((3, 16, 16), np.uint16, seed=4)
+    save_path = tmp_path / "fish1_GFP_slabmip.tif"
+    data = iter(img) if as_planes else img
+    bpf.write_tiff(save_path, data, "zlib", shape=img.shape, dtype=img.dtype)
+    with bpf.tiff.TiffFile(save_path) as tif:
+        assert len(tif.pages) == 3
+        assert tif.pages[0].photometric == bpf.tiff.PHOTOMETRIC.MINISBLACK
+    np.testing.assert_array_equal(bpf.tiff.imread(save_path), img)
@@ -0,0 +1,84 @@
+"""parse_image_filenames parses whole listings like the per-name split parsing it replaced"""
+
+import numpy as np
+import pytest
+
+import user_friendly_downsampling_mip_stitch_batchprocess_code.batchprocessing_functions_v5 as bpf
+
+
+def reference_pos_tp(file_name):
+    """pos and timepoint of the '_' separated fields of the name, as found before the compiled regex (-1 if missing)"""
+    file_name_pos, file_name_tp = -1, -1
+    for substr in file_name.split(".")[0].split("_"):
+        substr = substr.casefold()
+        if "pos" in substr:
+            file_name_pos = int(substr.removeprefix("pos"))
+        if "timepoint" in substr:
+            file_name_tp = int(substr.removeprefix("timepoint"))
+    return (file_name_pos, file_name_tp)
+
+
+def test_parse_image_filenames_fields():
+    records, bad_names = bpf.parse_image_filenames(
+        [
+            "fish1_pos2_GFP_timepoint3_MMStack_1.ome.tif",
+            "fish12_region3_rfp_timepoint10_MMStack.ome.tif",
+            "Fish4_Pos5_bf_Timepoint6.tiff",
+            "fish1_pos1_BFP_timepoint1.tif",  # not a channel
+            "fish1_BF_timepoint1.tif",  # no pos
+        ]
+    )
+    assert records.fish.tolist() == [1, 12, 4, 1, 1]
+    assert records.pos.tolist() == [2, 3, 5, 1, -1]
+    assert records.channel.tolist() == ["GFP", "RFP", "BF", "", "BF"]
+    assert records.timepoint.tolist() == [3, 10, 6, 1, 1]
+    assert records.overflow.tolist() == [1, -1, -1, -1, -1]
+    assert bad_names == ["fish1_BF_timepoint1.tif"]
+
+
+def test_parse_image_filenames_matches_split_parsing():
+    rng = np.random.default_rng(0)
+    file_list = [
+        f"fish{fish}_pos{pos}_{ch}_timepoint{tp}_MMStack{overflow}.ome.tif"
+        for fish, pos, ch, tp, overflow in zip(
+            rng.integers(1, 20, 200),
+            rng.integers(1, 30, 200),
+            rng.choice(["GFP", "RFP", "BF", "gfp"], 200),
+            rng.integers(1, 500, 200),
+            rng.choice(["", "_1", "_2"], 200),
+        )
+    ]
+    records, bad_names = bpf.parse_image_filenames(file_list)
+    assert bad_names == []
+    assert list(zip(records.pos.tolist(), records.timepoint.tolist())) == [reference_pos_tp(name) for name in file_list]
+    assert records.channel.tolist() == [name.split("_")[2].upper() for name in file_list]
+
+
+def test_parse_image_filenames_empty_listing():
+    records, bad_names = bpf.parse_image_filenames([])
+    assert len(records) == 0 and bad_names == []
+
+
+def test_sort_files_by_pos_tp_skips_bad_names(capsys):
+    file_list = [
+        "fish1_pos2_GFP_timepoint1.tif",
+        "fish1_pos1_GFP_timepoint2.tif",
+        "fish1_GFP_mip.tif",
+        "fish1_pos10_GFP_timepoint1.tif",
+        "fish1_pos1_GFP_timepoint1.tif",
+    ]
+    file_list_arr, pos_max = bpf.sort_files_by_pos_tp(file_list)
+    assert file_list_arr.tolist() == [
+        "fish1_pos1_GFP_timepoint1.tif",
+        "fish1_pos2_GFP_timepoint1.tif",
+        "fish1_pos10_GFP_timepoint1.tif",
+        "fish1_pos1_GFP_timepoint2.tif",
+    ]
+    assert pos_max == 10
+    assert "fish1_GFP_mip.tif" in capsys.readouterr().out
+
+
+def test_find_pos_tp_in_filename():
+    assert bpf.find_pos_tp_in_filename("fish1_pos12_RFP_timepoint7_MMStack_2.ome.tif") == (12, 7)
+    with pytest.raises(SystemExit):
+        bpf.find_pos_tp_in_filename("fish1_RFP_mip.tif")
@@ -0,0 +1,34 @@
+"""Micro-Manager metadata frames are decoded from their own slice of the file"""
+
+import json
+from unittest import mock
+
+import misc_functions_rplab
+
+
+def write_metadata(tmp_path, frames):
+    metadata = {"Summary": {"Width": "4", "Height": "3"}}
+    metadata.update(frames)
+    metadata_path = tmp_path / "img_MMStack_Pos0_metadata.txt"
+    metadata_path.write_text(json.dumps(metadata, indent=1))  # json writes NaN like Micro-Manager does
+    return metadata_path, metadata
+
+
+def test_nan_values_are_decoded_without_parsing_the_whole_file(tmp_path):
+    frames = {f"FrameKey-0-0-{z}": {"ZPositionUm": float("nan") if z == 1 else z} for z in range(3)}
+    metadata_path, metadata = write_metadata(tmp_path, frames)
+    with mock.patch.object(misc_functions_rplab.json, "load", side_effect=AssertionError("whole file parsed")):
+        for key in metadata:
+            value = misc_functions_rplab.read_mm_metadata_value(metadata_path, key)
+            assert json.dumps(value) == json.dumps(metadata[key])
+
+
+def test_whole_file_fallback_is_parsed_once(tmp_path):
+    # a nested key that looks like a frame key can't be cut out of the file
+    frames = {"FrameKey-0-0-0": {"Inner": {"FrameKey-9-9-9": 1}, "A": 1}}
+    metadata_path, metadata = write_metadata(tmp_path, frames)
+    json_load = json.load
+    with mock.patch.object(misc_functions_rplab.json, "load", side_effect=json_load) as load:
+        for _ in range(3):
+            assert misc_functions_rplab.read_mm_metadata_value(metadata_path, "FrameKey-0-0-0") == frames["FrameKey-0-0-0"]
+    assert load.call_count == 1
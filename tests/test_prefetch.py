@@ -0,0 +1,67 @@
+"""prefetch reads items ahead in a thread, in order, and stops with its caller"""
+
+import itertools
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import user_friendly_downsampling_mip_stitch_batchprocess_code.batchprocessing_functions_v5 as bpf
+
+
+def test_prefetch_yields_every_item_in_order():
+    planes = [np.full((4, 4), i, np.uint16) for i in range(10)]
+    assert [int(plane[0, 0]) for plane in bpf.prefetch(iter(planes))] == list(range(10))
+    assert list(bpf.prefetch(iter([]))) == []
+
+
+def test_prefetch_reads_ahead_of_the_caller():
+    second_read = threading.Event()
+
+    def items():
+        yield 0
+        yield 1
+        second_read.set()
+
+    for item in bpf.prefetch(items(), depth=2):
+        if item == 0:  # the next item is read while the caller still works on this one
+            assert second_read.wait(timeout=5)
+
+
+def test_prefetch_raises_the_reader_error():
+    def items():
+        yield 0
+        raise OSError("truncated page")
+
+    with pytest.raises(OSError, match="truncated page"):
+        list(bpf.prefetch(items()))
+
+
+def test_prefetch_stops_reading_when_the_caller_stops():
+    n_read = itertools.count()
+
+    def items():
+        while True:
+            next(n_read)
+            yield 0
+
+    prefetched = bpf.prefetch(items(), depth=2)
+    assert next(prefetched) == 0
+    prefetched.close()  # joins the reader
+    n_stopped = next(n_read)
+    time.sleep(0.05)
+    assert next(n_read) == n_stopped + 1 and n_stopped <= 5
+
+
+def test_stream_projections_raises_the_read_error(tmp_path, monkeypatch):
+    read_path = tmp_path / "fish1_GFP_MMStack.ome.tif"
+    bpf.tiff.imwrite(read_path, np.zeros((4, 8, 8), np.uint16))
+
+    def iter_stack_planes(read_path):
+        yield np.zeros((8, 8), np.uint16)
+        raise OSError("truncated page")
+
+    monkeypatch.setattr(bpf, "iter_stack_planes", iter_stack_planes)
+    with pytest.raises(OSError, match="truncated page"):
+        bpf.stream_projections(read_path, ["max"])
@@ -0,0 +1,174 @@
+"""the projections found in one streamed pass over a z-stack match numpy on the whole stack"""
+
+import itertools
+import os
+
+import numpy as np
+import pytest
+
+import user_friendly_downsampling_mip_stitch_batchprocess_code.batchprocessing_functions_v5 as bpf
+
+
+def write_stack(tmp_path, img, name="fish1_pos1_GFP_timepoint1_MMStack.ome.tif", overflow_planes=()):
+    """writes img at tmp_path/name, the planes from each of overflow_planes on go to its next overflow file"""
+    bounds = [0, *overflow_planes, len(img)]
+    og_name, dot, exts = name.partition(".")
+    for i, (z0, z1) in enumerate(itertools.pairwise(bounds)):
+        bpf.tiff.imwrite(tmp_path / (name if i == 0 else f"{og_name}_{i}{dot}{exts}"), img[z0:z1])
+    return tmp_path / name
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16, np.float32])
+def test_stream_projections_match_numpy(tmp_path, dtype):
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 5, size=(9, 13, 17)).astype(dtype)  # few values, so argmax has ties
+    arr_projections = bpf.stream_projections(write_stack(tmp_path, img), list(bpf.PROJECTIONS))
+    assert list(arr_projections) == list(bpf.PROJECTIONS)
+    np.testing.assert_array_equal(arr_projections["max"], img.max(axis=0))
+    np.testing.assert_array_equal(arr_projections["min"], img.min(axis=0))
+    np.testing.assert_array_equal(arr_projections["argmax"], img.argmax(axis=0))  # first plane with the max
+    np.testing.assert_allclose(arr_projections["mean"], img.mean(axis=0, dtype=np.float64), rtol=1e-6)
+    np.testing.assert_allclose(arr_projections["std"], img.std(axis=0, dtype=np.float64), rtol=1e-5, atol=1e-6)
+    assert arr_projections["max"].dtype == arr_projections["min"].dtype == dtype
+    assert arr_projections["mean"].dtype == arr_projections["std"].dtype == np.float32
+    assert arr_projections["argmax"].dtype == np.uint16
+
+
+def test_stream_projections_reads_overflow_files(tmp_path):
+    rng = np.random.default_rng(1)
+    img = rng.integers(0, 4096, size=(10, 8, 8), dtype=np.uint16)
+    read_path = write_stack(tmp_path, img, overflow_planes=(4, 7))
+    arr_projections = bpf.stream_projections(read_path, ["max", "mean", "argmax"])
+    np.testing.assert_array_equal(arr_projections["max"], img.max(axis=0))
+    np.testing.assert_array_equal(arr_projections["argmax"], img.argmax(axis=0))
+    np.testing.assert_allclose(arr_projections["mean"], img.mean(axis=0), rtol=1e-6)
+    np.testing.assert_array_equal(bpf.stream_mip(read_path), img.max(axis=0))
+
+
+def test_stream_projections_skips_2D_images(tmp_path):
+    read_path = tmp_path / "fish1_pos1_BF_timepoint1.tif"
+    bpf.tiff.imwrite(read_path, np.zeros((8, 8), np.uint16))
+    assert bpf.stream_projections(read_path, ["max", "std"]) is None
+    assert bpf.stream_mip(read_path) is None
+
+
+def test_parse_projections():
+    assert bpf.parse_projections("std, MAX,mean") == ["max", "mean", "std"]  # in the order of PROJECTIONS
+    for text in ("", "max,median"):
+        with pytest.raises(ValueError):
+            bpf.parse_projections(text)
+
+
+def test_save_projections_folders(tmp_path):
+    filepath = tmp_path / "fish1_pos1_GFP_timepoint1_MMStack.ome.tif"
+    arr_projections = {"max": np.ones((4, 4), np.uint16), "std": np.ones((4, 4), np.float32)}
+    outputs = bpf.save_projections(str(filepath), arr_projections)
+    assert [os.path.relpath(output, tmp_path) for output in outputs] == [
+        os.path.join("gfp_mip", "fish1_pos1_GFP_timepoint1_mip.tif"),
+        os.path.join("gfp_stdip", "fish1_pos1_GFP_timepoint1_stdip.tif"),
+    ]
+    np.testing.assert_array_equal(bpf.tiff.imread(outputs[1]), arr_projections["std"])
+    assert bpf.save_projections(str(tmp_path / "fish1_pos1_BF_timepoint1.tif"), arr_projections) == []
+
+
+@pytest.mark.parametrize(
+    "n_planes, slab_size, slab_stride, z_ranges, slabs",
+    [
+        (10, 5, None, None, [(0, 5), (5, 10)]),
+        (12, 5, None, None, [(0, 5), (5, 10), (10, 12)]),  # the last slab is thinner
+        (10, 5, 2, None, [(0, 5), (2, 7), (4, 9), (6, 10)]),  # overlapping, until the last plane is in a slab
+        (10, None, None, [(0, 3), (8, 20), (12, 15)], [(0, 3), (8, 10)]),  # clipped to the stack
+        (10, 5, None, [(0, 5), (3, 4)], [(0, 5), (3, 4), (5, 10)]),  # no duplicate slabs
+        (3, 5, None, None, [(0, 3)]),
+    ],
+)
+def test_slab_ranges(n_planes, slab_size, slab_stride, z_ranges, slabs):
+    assert bpf.slab_ranges(n_planes, slab_size, slab_stride, z_ranges) == slabs
+
+
+def test_parse_slab():
+    assert bpf.parse_slab("25") == (25, None)
+    assert bpf.parse_slab(" 25:5 ") == (25, 5)
+    for text in ("", "a", "25:b", "0", "25:0", "-5"):
+        with pytest.raises(ValueError):
+            bpf.parse_slab(text)
+
+
+def test_parse_z_ranges():
+    assert bpf.parse_z_ranges("1-50, 100-150,") == [(0, 50), (99, 150)]  # from 0 with stop excluded
+    assert bpf.parse_z_ranges("7-7") == [(6, 7)]
+    for text in ("1-", "a-5", "0-5", "5-4"):
+        with pytest.raises(ValueError):
+            bpf.parse_z_ranges(text)
+
+
+@pytest.mark.parametrize(
+    "slab_size, slab_stride, z_ranges", [(4, None, None), (5, 2, None), (3, 5, [(1, 9)]), (None, None, [(2, 3), (0, 11)])]
+)
+def test_stream_projections_slab_mips_match_numpy(tmp_path, slab_size, slab_stride, z_ranges):
+    rng = np.random.default_rng(2)
+    img = rng.integers(0, 4096, size=(11, 9, 7), dtype=np.uint16)
+    read_path = write_stack(tmp_path, img, overflow_planes=(6,))
+    arr_projections = bpf.stream_projections(read_path, ["max", "mean"], slab_size, slab_stride, z_ranges)
+    slabs = bpf.slab_ranges(len(img), slab_size, slab_stride, z_ranges)
+    expected = np.stack([img[z0:z1].max(axis=0) for z0, z1 in slabs])
+    assert arr_projections["slab"].dtype == img.dtype
+    np.testing.assert_array_equal(arr_projections["slab"], expected)
+    np.testing.assert_array_equal(arr_projections["max"], img.max(axis=0))  # found in the same pass
+    np.testing.assert_allclose(arr_projections["mean"], img.mean(axis=0), rtol=1e-6)
+
+
+def test_save_projections_slab_mip_stack(tmp_path):
+    filepath = tmp_path / "fish1_pos1_RFP_timepoint1_MMStack.ome.tif"
+    slab_mips = np.arange(2 * 4 * 4, dtype=np.uint16).reshape(2, 4, 4)
+    outputs = bpf.save_projections(str(filepath), {"slab": slab_mips})
+    assert outputs == [str(tmp_path / "rfp_slabmip" / "fish1_pos1_RFP_timepoint1_slabmip.tif")]
+    np.testing.assert_array_equal(bpf.tiff.imread(outputs[0]), slab_mips)
+
+
+def tree_mtimes(top_dir):
+    """Returns: {relative path: mtime_ns} of every tiff under top_dir"""
+    return {
+        os.path.relpath(os.path.join(root, filename), top_dir): os.stat(os.path.join(root, filename)).st_mtime_ns
+        for root, _, filenames in os.walk(top_dir)
+        for filename in filenames
+        if filename.endswith(".tif")
+    }
+
+
+@pytest.mark.parametrize("parallel", [False, True])
+@pytest.mark.parametrize("keep_manifest", [True, False])
+def test_mip_rerun_skips_saved_projections(tmp_path, monkeypatch, parallel, keep_manifest):
+    # the slab MIP stacks are 3D tiffs in the tree, a rerun must not project them again into nested folders
+    import PARALLEL_user_friendly_downsampling_mip_stitch_batchprocess_code.batchprocessing_functions_v4_parallel as pbpf
+
+    monkeypatch.setattr(bpf, "ACQ_INDEX_DIR", str(tmp_path / "index"))
+    main_dir = tmp_path / "exp1"
+    main_dir.mkdir()
+    rng = np.random.default_rng(3)
+    for ch in ("GFP", "RFP"):
+        write_stack(main_dir, rng.integers(0, 4096, size=(12, 8, 8), dtype=np.uint16), f"fish1_pos1_{ch}_timepoint1.tif")
+
+    def run_mip():
+        if parallel:
+            pbpf.oswalk_batchprocess_mip_parallel(str(main_dir), 1, projections=["max", "std"], slab_size=5)
+        else:
+            bpf.oswalk_batchprocess_mip(str(main_dir), projections=["max", "std"], slab_size=5)
+
+    run_mip()
+    first_outputs = tree_mtimes(main_dir)
+    assert sorted(first_outputs) == sorted(
+        [f"fish1_pos1_{ch}_timepoint1.tif" for ch in ("GFP", "RFP")]
+        + [
+            os.path.join(f"{ch}{suffix}", f"fish1_pos1_{ch.upper()}_timepoint1{suffix}.tif")
+            for ch in ("gfp", "rfp")
+            for suffix in ("_mip", "_stdip", "_slabmip")
+        ]
+    )
+    if not keep_manifest:  # e.g. a tree copied without its manifest, the raw stacks are projected again
+        os.remove(main_dir / bpf.MANIFEST_NAME)
+    run_mip()
+    run_mip()
+    assert sorted(tree_mtimes(main_dir)) == sorted(first_outputs)  # no nested projection folders
+    if keep_manifest:
+        assert tree_mtimes(main_dir) == first_outputs  # nothing written again
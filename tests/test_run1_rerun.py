@@ -0,0 +1,65 @@
+"""a second run1 over the same folders skips every image downsampled (and sorted by channel) by the first one"""
+
+import os
+
+import numpy as np
+import pytest
+import tifffile
+
+import batchprocessing_functions_v5
+import PARALLEL_user_friendly_downsampling_mip_stitch_batchprocess_code.run1_downsample_multi_acquisition_n_sort_by_channel as run1_parallel
+import run1_downsample_multi_acquisition_n_sort_by_channel as run1
+
+
+@pytest.fixture
+def acquisition(tmp_path, monkeypatch):
+    """source folder with 8 small z-stacks (2 positions, 2 timepoints, GFP and RFP) and a notes.txt"""
+    monkeypatch.setattr(batchprocessing_functions_v5, "ACQ_INDEX_DIR", str(tmp_path / "index"))
+    acq_path = tmp_path / "exp1" / "Acquisition"
+    (acq_path / "fish1").mkdir(parents=True)
+    (acq_path / "notes.txt").write_text("[Fish 1 Region 1]\nx_pos = 0\ny_pos = 0\nz_stack_start_pos = 0\n")
+    rng = np.random.default_rng(0)
+    for pos in (1, 2):
+        for tp in (1, 2):
+            for ch in ("GFP", "RFP"):
+                img = rng.integers(0, 4096, size=(5, 16, 16), dtype=np.uint16)
+                tifffile.imwrite(acq_path / "fish1" / f"fish1_pos{pos}_{ch}_timepoint{tp}_MMStack.ome.tif", img)
+    return tmp_path / "exp1", tmp_path / "trg"
+
+
+def output_mtimes(trg):
+    """Returns: {path: mtime_ns} of every tiff in trg"""
+    return {
+        os.path.join(root, filename): os.stat(os.path.join(root, filename)).st_mtime_ns
+        for root, _, filenames in os.walk(trg)
+        for filename in filenames
+        if filename.endswith(".tif")
+    }
+
+
+@pytest.mark.parametrize("run1_module, extra_args", [(run1, []), (run1_parallel, ["--cores", "1"])])
+def test_rerun_skips_sorted_outputs(acquisition, run1_module, extra_args, capsys):
+    src, trg = acquisition
+    argv = ["--src", str(src), "--trg", str(trg), "-n", "2", "--mip"] + extra_args
+    run1_module.main(argv)
+    first_outputs = output_mtimes(trg)
+    ds_dir = trg / "exp1_downsampled_n2"
+    assert len(os.listdir(ds_dir / "GFP")) == len(os.listdir(ds_dir / "RFP")) == 4
+    capsys.readouterr()
+
+    run1_module.main(argv)  # returns normally, nothing is moved over an existing file
+    out = capsys.readouterr().out
+    assert "Reading:" not in out
+    assert output_mtimes(trg) == first_outputs  # nothing written again
+    assert not any(name.endswith(".tif") for name in os.listdir(ds_dir))  # nothing left unsorted
+
+
+def test_sort_by_channel_replaces_sorted_file(tmp_path):
+    # an image written again after an earlier sort (e.g. by a run that crashed before sorting) replaces the sorted one
+    (tmp_path / "GFP").mkdir()
+    (tmp_path / "GFP" / "fish1_pos1_GFP_timepoint1_ds.tif").write_bytes(b"old")
+    (tmp_path / "fish1_pos1_GFP_timepoint1_ds.tif").write_bytes(b"new")
+    run1.sort_by_channel([str(tmp_path)])
+    assert os.listdir(tmp_path / "GFP") == ["fish1_pos1_GFP_timepoint1_ds.tif"]
+    assert (tmp_path / "GFP" / "fish1_pos1_GFP_timepoint1_ds.tif").read_bytes() == b"new"
+    assert not (tmp_path / "GFP" / "GFP").exists()
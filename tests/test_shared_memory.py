@@ -0,0 +1,57 @@
+"""shared memory blocks attached in other processes stay owned by the creating process"""
+
+import os
+import subprocess
+import sys
+import textwrap
+
+CREATOR_SCRIPT = textwrap.dedent(
+    """
+    import subprocess
+    import sys
+
+    import numpy as np
+    from joblib.externals.loky import get_reusable_executor
+
+    import user_friendly_downsampling_mip_stitch_batchprocess_code.batchprocessing_functions_v5 as bpf
+
+    ATTACH_SCRIPT = '''
+    import sys
+    import user_friendly_downsampling_mip_stitch_batchprocess_code.batchprocessing_functions_v5 as bpf
+    spec = bpf.SharedArraySpec(sys.argv[1], (4, 4), "<u2")
+    with bpf.attach_shared_array(spec) as arr:
+        arr[:] = 7
+    '''
+
+    def fill(spec, value):
+        with bpf.attach_shared_array(spec) as arr:
+            arr[value] = value
+        return True
+
+    if __name__ == "__main__":
+        shm, arr, spec = bpf.create_shared_array((4, 4), np.uint16)
+        # a process with its own resource tracker
+        subprocess.run([sys.executable, "-c", ATTACH_SCRIPT, spec.name], check=True)
+        assert (arr == 7).all()
+        # loky workers, which share the resource tracker of this process
+        executor = get_reusable_executor(max_workers=2)
+        assert all(executor.map(fill, [spec] * 4, range(4)))
+        executor.shutdown(wait=True, kill_workers=True)
+        with bpf.attach_shared_array(spec) as arr_again:  # not unlinked by any of them
+            assert arr_again[3, 0] == 3
+        shm.close()
+        shm.unlink()
+        print("ok")
+    """
+)
+
+
+def test_attached_blocks_are_not_unlinked_or_unregistered(tmp_path):
+    # run in a fresh interpreter, the resource trackers only report leaks and unregister errors from their process
+    script_path = tmp_path / "creator.py"
+    script_path.write_text(CREATOR_SCRIPT)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))  # the modules pytest can import
+    result = subprocess.run([sys.executable, str(script_path)], capture_output=True, text=True, timeout=120, env=env)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == "ok"
+    assert "leaked" not in result.stderr and "KeyError" not in result.stderr, result.stderr
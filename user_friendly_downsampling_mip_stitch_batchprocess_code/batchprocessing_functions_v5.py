@@ -1,10 +1,21 @@
 # batchprocessing functions
 # created: Jan 15, 2024
 
+import collections
 import configparser
+import contextlib
+import functools
+import hashlib
+import itertools
+import json
 import os
+import queue
 import re
 import shutil
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
 
 import numpy as np
 import skimage
@@ -19,12 +30,10 @@ from natsort import natsorted
 ## CONSTANT
 # The pixel spacing in our LSM image is 1µm in the z axis, and  0.1625µm in the x and y axes.
 ZD, XD, YD = 1, 0.1625, 0.1625
-
-## Get global variables
-pos_max = 0
-img_h, img_w = 0, 0
-find_scope_flag = 0
-new_spacing = [0, 0, 0]
+# local folder (not on the NAS) for the acquisition index files
+ACQ_INDEX_DIR = os.path.join(os.path.expanduser("~"), ".cache", "batch_processing")
+# outputs are written to hidden temporary files/folders with this prefix and renamed when complete
+TMP_PREFIX = ".tmp_"
 
 ## Small Helping Functions
 
@@ -40,10 +49,49 @@ def check_create_save_path(save_path):
         print("Save path exists")
 
 
+@contextlib.contextmanager
+def atomic_save_path(save_path):
+    """yields a temporary path to write the output of save_path to, in the same folder (so the rename is atomic) with
+    the TMP_PREFIX and the same extension. The temporary file (or folder, e.g. '.zarr') replaces save_path only if the
+    with block finishes, on an error it is deleted. So an interrupted run never leaves a truncated output at save_path
+    and readers never see an output that is still being written."""
+    save_dir, save_name = os.path.split(os.path.abspath(save_path))
+    tmp_path = os.path.join(save_dir, f"{TMP_PREFIX}{os.getpid()}_{save_name}")
+    try:
+        yield tmp_path
+    except BaseException:
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        elif os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    if os.path.isdir(tmp_path) and os.path.isdir(save_path):  # a folder can't be replaced by rename
+        shutil.rmtree(save_path)
+    os.replace(tmp_path, save_path)
+
+
+def save_image(save_path, img):
+    """saves the image img with skimage.io.imsave (format from the extension of save_path, e.g. png) through a
+    temporary file, see atomic_save_path"""
+    with atomic_save_path(save_path) as tmp_path:
+        skimage.io.imsave(tmp_path, img, check_contrast=False)
+
+
+def copy_file(src_path, dst):
+    """shutil.copy through a temporary file (see atomic_save_path), dst can be a file path or a folder"""
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src_path))
+    with atomic_save_path(dst) as tmp_path:
+        shutil.copy(src_path, tmp_path)
+    return dst
+
+
 def remove_non_image_files(big_list, root_path):
-    """removes dir and non-image(tiff) files from a list"""
+    """removes dir, non-image(tiff) and unfinished (temporary) files from a list"""
     small_list = []
     for val in big_list:
+        if val.startswith(TMP_PREFIX):  # still being written
+            continue
         if os.path.isfile(os.path.join(root_path, val)):  # file check
             filename_list = val.split(".")
             # og_name = filename_list[0]
@@ -66,37 +114,77 @@ def remove_non_csv_files(big_list, root_path):
     return small_list
 
 
+# fields of the image names are separated by '_', e.g. fish1_pos2_GFP_timepoint3_MMStack_1.ome.tif
+# (path separators and new lines also separate fields so whole paths and joined listings can be parsed)
+IMG_NAME_FIELD_RE = re.compile(
+    r"(?<![^_\n/\\])"
+    r"(?:fish(?P<fish>\d+)|(?:pos|region)(?P<pos>\d+)|timepoint(?P<timepoint>\d+)|mmstack_(?P<overflow>\d+)"
+    r"|(?P<channel>bf|gfp|rfp))"
+    r"(?![^_.\n/\\])",
+    re.IGNORECASE,
+)
+
+
+def parse_image_filenames(file_list):
+    """parses fish, pos (or region), channel, timepoint and MMStack overflow number of all file names in one regex pass
+    over the joined listing. Missing numbers are -1 and a missing channel is ''.
+    Returns: (record array with fields name, fish, pos, channel, timepoint, overflow; list of names without pos or tp)"""
+    stems = [file_name.split(".")[0] for file_name in file_list]
+    records = np.zeros(
+        len(stems),
+        dtype=[("name", object), ("fish", int), ("pos", int), ("channel", "U3"), ("timepoint", int), ("overflow", int)],
+    )
+    records["name"] = file_list
+    for key in ("fish", "pos", "timepoint", "overflow"):
+        records[key] = -1
+    # start offset of each name in the joined listing, to find which name a match belongs to
+    name_starts = np.cumsum([0] + [len(stem) + 1 for stem in stems[:-1]])
+    match_starts = {key: [] for key in ("fish", "pos", "channel", "timepoint", "overflow")}
+    match_values = {key: [] for key in match_starts}
+    for match in IMG_NAME_FIELD_RE.finditer("\n".join(stems)):
+        match_starts[match.lastgroup].append(match.start())
+        match_values[match.lastgroup].append(match[match.lastgroup])
+    for key, starts in match_starts.items():
+        if starts:  # the last match in a name wins
+            rows = np.searchsorted(name_starts, starts, side="right") - 1
+            values = [value.upper() for value in match_values[key]] if key == "channel" else np.array(match_values[key], dtype=int)
+            records[key][rows] = values
+    bad_names = list(records["name"][(records["pos"] == -1) | (records["timepoint"] == -1)])
+    return (records.view(np.recarray), bad_names)
+
+
+def sort_files_by_pos_tp(file_list):
+    """sorts the file_list by tp, then by pos. Names without pos or tp are reported together and left out.
+    Returns: (sorted file names array, pos_max)"""
+    records, bad_names = parse_image_filenames(file_list)
+    if bad_names:
+        print(f"ParsingError: Couldn't find tp and pos from {len(bad_names)} file(s), skipping them:")
+        for file_name in bad_names:
+            print(f"    {file_name}")
+        records = records[(records.pos != -1) & (records.timepoint != -1)]
+    if len(records) == 0:
+        print("ParsingError: No file names with tp and pos found. Exiting...")
+        exit()
+    ind = np.lexsort((records.pos, records.timepoint))  # Sort by tp, then by pos
+    return (records.name[ind].astype(str), np.max(records.pos))
+
+
 def reorder_files_by_pos_tp(file_list):
     """reoders the file_list by pos and tp"""
-    file_list_arr = np.array(file_list)
-    global pos_max
-    raw_pos_arr = np.zeros_like(file_list_arr, dtype=int)
-    raw_tp_arr = np.zeros_like(file_list_arr, dtype=int)
-    for i, file_name in enumerate(file_list_arr):
-        raw_pos_arr[i], raw_tp_arr[i] = find_pos_tp_in_filename(file_name)
-    pos_max = np.max(raw_pos_arr)  # get pos_max
-    ind = np.lexsort((raw_pos_arr, raw_tp_arr))  # Sort by tp, then by pos
-    return file_list_arr[ind]
+    file_list_arr, _ = sort_files_by_pos_tp(file_list)
+    return file_list_arr
 
 
 def find_pos_tp_in_filename(file_name):
     """finds the 'timepoint' and 'pos' in the filename (must be separated by '_')
     Returns int: file_name_pos, file_name_tp"""
-    file_name_wo_ext = file_name.split(".")[0]
-    file_name_split_list = file_name_wo_ext.split("_")
-    file_name_pos, file_name_tp = -1, -1
-    for substr in file_name_split_list:
-        substr = substr.casefold()
-        if "pos" in substr:
-            file_name_pos = int(substr.removeprefix("pos"))
-        if "timepoint" in substr:
-            file_name_tp = int(substr.removeprefix("timepoint"))
-    if (file_name_pos == -1) or (file_name_tp == -1):
+    records, bad_names = parse_image_filenames([file_name])
+    if bad_names:
         print(f"ParsingError: Couldn't find tp and pos from: {file_name}")
         print("Exiting...")
         exit()
     else:
-        return (file_name_pos, file_name_tp)
+        return (int(records.pos[0]), int(records.timepoint[0]))
 
 
 def find_nearest_target_file(start_path, target):
@@ -119,6 +207,15 @@ def find_nearest_target_file(start_path, target):
     return found_file_path
 
 
+def parse_int_list(text):
+    """parses comma separated integers, e.g. '2,4,8' (command line and prompt answers)
+    Returns: list of int"""
+    try:
+        return [int(val) for val in str(text).split(",") if val.strip()]
+    except ValueError:
+        raise ValueError(f"'{text}' is not a comma separated list of integers, e.g. '2,4,8'")
+
+
 def find_multi_subdir(subdir_path, subdir_name):
     """finds if there are multiple subdirectories at 'subdir_path' with the name 'subdir_name'"""
     sub_dir = os.listdir(subdir_path)
@@ -154,30 +251,1124 @@ def check_n_rename_old_imgname(save_name, path_name):
     return save_name
 
 
+def rounded_int_divide(img_sum, divisor):
+    """divides the integer array img_sum by divisor, rounding half to even like np.round does for float division"""
+    quotient, remainder = np.divmod(img_sum, divisor)
+    round_up = (2 * remainder > divisor) | ((2 * remainder == divisor) & (quotient % 2 == 1))
+    quotient += round_up
+    return quotient
+
+
+def bin_sum_int(img, n):
+    """sums each nxn block of the last two axes (y, x) of the integer image img in an integer accumulator.
+    Edge blocks are zero padded (like skimage.transform.downscale_local_mean) when the size is not a multiple of n."""
+    img_h, img_w = img.shape[-2], img.shape[-1]
+    pad_h, pad_w = -img_h % n, -img_w % n
+    if pad_h or pad_w:  # only copies images whose size isn't a multiple of n
+        img = np.pad(img, [(0, 0)] * (img.ndim - 2) + [(0, pad_h), (0, pad_w)])
+    ds_h, ds_w = (img_h + pad_h) // n, (img_w + pad_w) // n
+    # uint32 holds the sum of n*n uint16 pixels up to n=256
+    acc_dtype = np.uint32 if img.dtype.itemsize <= 2 else np.uint64
+    if np.issubdtype(img.dtype, np.signedinteger):
+        acc_dtype = np.int32 if img.dtype.itemsize <= 2 else np.int64
+    img_blocks = img.reshape(img.shape[:-2] + (ds_h, n, ds_w, n))
+    return img_blocks.sum(axis=(-3, -1), dtype=acc_dtype)
+
+
+def downscale_planes_int(img, n):
+    """downscales the last two axes (y, x) of the integer image img by n using the mean of each nxn block.
+    Bit-exact with skimage.transform.downscale_local_mean followed by np.round, without the float64 copy of the image."""
+    return rounded_int_divide(bin_sum_int(img, n), n * n).astype(img.dtype)
+
+
+def downscale_pyramid_planes(img, factors):
+    """downscales the last two axes (y, x) of img by every factor in factors (sorted in increasing order).
+    For integer images the block sums of a level are binned again for the next level when its factor is a multiple
+    of the previous one (2x from raw, 4x from 2x...), so every level is the same as downscale_planes_int(img, factor)
+    while the full resolution image is binned only once.
+    Returns: list with the downscaled image of each factor (factor 1 is img itself)"""
+    levels = []
+    if np.issubdtype(img.dtype, np.integer):
+        img_sum, prev_factor = img, 1
+        for factor in factors:
+            if factor % prev_factor:  # not a multiple, start again from the full resolution image
+                img_sum, prev_factor = img, 1
+            if factor > prev_factor:
+                img_sum = bin_sum_int(img_sum, factor // prev_factor)
+            levels.append(img if factor == 1 else rounded_int_divide(img_sum, factor * factor).astype(img.dtype))
+            prev_factor = factor
+    else:  # floats keep using skimage
+        for factor in factors:
+            kernel = (1,) * (img.ndim - 2) + (factor, factor)
+            levels.append(
+                img if factor == 1 else np.round(skimage.transform.downscale_local_mean(img, kernel)).astype(img.dtype)
+            )
+    return levels
+
+
+def probe_image_shape(img_path):
+    """Returns (shape, dtype) of the tiff image at img_path from its headers only (the series metadata, e.g. the
+    Micro-Manager summary or OME-XML), without reading any pixel data.
+    Results are cached per path and file modification time."""
+    file_stat = os.stat(img_path)
+    return _probe_image_shape(os.path.abspath(img_path), file_stat.st_mtime_ns, file_stat.st_size)
+
+
+@functools.lru_cache(maxsize=4096)
+def _probe_image_shape(img_path, mtime_ns, file_size):
+    """cached by probe_image_shape, a modified file gets a new (mtime_ns, file_size) key"""
+    with tiff.TiffFile(img_path) as tif:
+        series = tif.series[0]
+        return tuple(series.shape), np.dtype(series.dtype)
+
+
+def read_tiff_stack(read_path, single_file=False):
+    """Reads the tiff image at read_path without copying it into memory when possible.
+    Uncompressed images whose planes are at a regular stride in one file (e.g. Micro-Manager MMStack files, where each
+    plane is followed by its IFD) are returned as a read-only view of a np.memmap, so every byte is read once from the
+    page cache when it's used. Other images are read page by page into a new array.
+    single_file=True only reads the pages stored in this file and ignores the rest of a multi-file series."""
+    with tiff.TiffFile(read_path) as tif:
+        if single_file:
+            pages = list(tif.pages)
+            keyframe = pages[0].keyframe
+            img_shape = keyframe.shape if len(pages) == 1 else (len(pages),) + keyframe.shape
+            og_datatype = keyframe.dtype
+        else:
+            series = tif.series[0]
+            pages = list(series)
+            keyframe = series.keyframe
+            img_shape, og_datatype = series.shape, series.dtype
+        plane_shape = keyframe.shape
+        if len(pages) * np.prod(plane_shape) != np.prod(img_shape):  # e.g. multi-sample pages
+            return tif.asarray() if single_file else series.asarray()
+
+        itemsize = np.dtype(og_datatype).itemsize
+        plane_nbytes = int(np.prod(plane_shape)) * itemsize
+        plane_offsets = []
+        mmap_flag = (
+            keyframe.compression == 1
+            and keyframe.predictor == 1
+            and keyframe.samplesperpixel == 1
+            and len(plane_shape) == 2
+        )
+        for page in pages:
+            if not mmap_flag:
+                break
+            if page is None or page.parent is not tif:  # missing page or page in another file
+                mmap_flag = False
+                break
+            offsets, bytecounts = page.dataoffsets, page.databytecounts
+            strips_contiguous = all(
+                offsets[i] + bytecounts[i] == offsets[i + 1] for i in range(len(offsets) - 1)
+            )
+            mmap_flag = strips_contiguous and sum(bytecounts) == plane_nbytes
+            plane_offsets.append(offsets[0])
+        plane_strides = np.unique(np.diff(plane_offsets))
+        if mmap_flag and len(plane_strides) <= 1:
+            stride = int(plane_strides[0]) if len(plane_strides) else plane_nbytes
+            file_bytes = np.memmap(
+                read_path,
+                dtype=np.uint8,
+                mode="r",
+                offset=plane_offsets[0],
+                shape=(stride * (len(pages) - 1) + plane_nbytes,),
+            )
+            img = np.ndarray(
+                shape=(len(pages), plane_shape[0], plane_shape[1]),
+                dtype=np.dtype(og_datatype).newbyteorder(tif.byteorder),
+                buffer=file_bytes,
+                strides=(stride, plane_shape[1] * itemsize, itemsize),
+            )
+            return img.reshape(img_shape)
+
+        # page-wise read, only the pages of this image are loaded
+        img = np.empty((len(pages),) + plane_shape, dtype=og_datatype)
+        for i, page in enumerate(pages):
+            if page is None:  # missing page in a multi-file series
+                img[i] = 0
+            else:
+                img[i] = page.asarray()
+        return img.reshape(img_shape)
+
+
+## TIFF compression
+# Every tiff writer takes a codec string "<name>[:<level>][+predictor]", e.g. "deflate:6", "zstd", "zstd:3+predictor",
+# and writes through write_tiff. None (or "none") writes uncompressed, like before.
+
+TIFF_CODECS = {
+    "none": None,
+    "deflate": "deflate",
+    "zlib": "zlib",  # Adobe Deflate, same zlib stream with the newer tiff tag
+    "zstd": "zstd",
+    "lzw": "lzw",
+    "lzma": "lzma",
+    "packbits": "packbits",
+}
+LEVEL_CODECS = ("deflate", "zlib", "zstd", "lzma")  # codecs with a compression level
+# rows per strip of compressed planes, so that a plane has several strips to encode in parallel (~256 KB for 2048x2048)
+CODEC_ROWS_PER_STRIP = 64
+
+
+def parse_codec(codec):
+    """parses the codec string "<name>[:<level>][+predictor]" (case insensitive)
+    Returns: (name, level, predictor_flag), name is None for no compression and level is None for the codec default"""
+    if codec is None:
+        return (None, None, False)
+    codec = codec.strip().casefold()
+    predictor_flag = codec.endswith("+predictor")
+    codec = codec.removesuffix("+predictor")
+    name, _, level = codec.partition(":")
+    name = name or "none"
+    if name == "lz4":  # tiff has no lz4 compression, zstd level 1 is the nearest fast codec
+        print("Warning: tiff doesn't support LZ4 compression, using 'zstd:1' instead")
+        name, level = "zstd", "1"
+    if name not in TIFF_CODECS:
+        print(f"User Error: Unknown compression '{codec}', use one of {list(TIFF_CODECS)}. Exiting")
+        exit()
+    try:
+        level = int(level) if level else None
+    except ValueError:
+        print(f"User Error: compression level in '{codec}' MUST be an integer. Exiting")
+        exit()
+    if level is not None and name not in LEVEL_CODECS:
+        print(f"Warning: '{name}' has no compression level, ignoring level {level}")
+        level = None
+    return (TIFF_CODECS[name], level, predictor_flag)
+
+
+def tiff_codec_kwargs(codec, maxworkers=None):
+    """returns the tifffile.imwrite keyword arguments for the codec string (see parse_codec).
+    Compressed planes are split in strips of CODEC_ROWS_PER_STRIP rows that are encoded by maxworkers threads
+    (default: half the cpus); +predictor applies horizontal differencing before compression."""
+    compression, level, predictor_flag = parse_codec(codec)
+    if compression is None:
+        return {}
+    codec_kwargs = {
+        "compression": compression,
+        "rowsperstrip": CODEC_ROWS_PER_STRIP,
+        "maxworkers": maxworkers or max(1, (os.cpu_count() or 2) // 2),
+    }
+    if level is not None:
+        codec_kwargs["compressionargs"] = {"level": level}
+    if predictor_flag:
+        codec_kwargs["predictor"] = True
+    return codec_kwargs
+
+
+def iter_plane_tiles(planes, tile_size):
+    """yields the (tile_size, tile_size) tiles of every 2D plane in planes, in tiff order (row by row), the
+    tiles at the right and bottom edges are zero padded"""
+    for plane in planes:
+        for y in range(0, plane.shape[0], tile_size):
+            for x in range(0, plane.shape[1], tile_size):
+                tile = plane[y : y + tile_size, x : x + tile_size]
+                if tile.shape != (tile_size, tile_size):
+                    tile = np.pad(tile, ((0, tile_size - tile.shape[0]), (0, tile_size - tile.shape[1])))
+                yield tile
+
+
+def write_tiff(save_path, data, codec=None, maxworkers=None, tile_size=None, **kwargs):
+    """saves data (an array, or an iterator of planes with shape and dtype in kwargs) at save_path compressed with
+    the codec string (see parse_codec), other kwargs are passed to tifffile.imwrite.
+    tile_size: save planes in (tile_size, tile_size) tiles instead of strips, so that viewers and read_tiff_roi only
+    read the tiles of the region they show (MUST be a multiple of 16, e.g. 256 or 512)"""
+    codec_kwargs = tiff_codec_kwargs(codec, maxworkers)
+    # the output only appears at save_path once it is complete
+    if tile_size:
+        if tile_size % 16:
+            print(f"User Error: tile size {tile_size} MUST be a multiple of 16, e.g. 256 or 512. Exiting")
+            exit()
+        codec_kwargs.pop("rowsperstrip", None)  # tiles are encoded in parallel instead of strips
+        codec_kwargs["tile"] = (tile_size, tile_size)
+        if not isinstance(data, np.ndarray):  # tifffile takes iterators of tiles, not planes
+            data = iter_plane_tiles(data, tile_size)
+    # stacks of 3 or 4 planes are z planes (or slabs), not the color channels tifffile would save them as by default
+    kwargs.setdefault("photometric", "minisblack")
+    with atomic_save_path(save_path) as tmp_path:
+        tiff.imwrite(tmp_path, data=data, **{**codec_kwargs, **kwargs})
+
+
+def read_tiff_roi(read_path, rows, cols, planes=None):
+    """reads the region [planes, rows, cols] of the 2D or 3D tiff image at read_path, each given as a
+    (start, stop) tuple (planes=None for all planes, ignored for 2D images). Only the tiles (or strips, for untiled
+    images) that overlap the region are read from the file and decoded.
+    Returns: np.array of the region (2D for 2D images)"""
+    with tiff.TiffFile(read_path) as tif:
+        series = tif.series[0]
+        img_shape = series.shape
+        if len(img_shape) not in (2, 3):
+            print(f"{read_path}: Can't read a region of images with >3dimensions")
+            return None
+        (y0, y1), (x0, x1) = [
+            (max(0, start), min(ax_len, stop)) for (start, stop), ax_len in zip((rows, cols), img_shape[-2:])
+        ]
+        if len(img_shape) == 2:
+            z0, z1 = 0, 1
+        else:
+            z0, z1 = (0, img_shape[0]) if planes is None else (max(0, planes[0]), min(img_shape[0], planes[1]))
+        roi = np.zeros((max(0, z1 - z0), max(0, y1 - y0), max(0, x1 - x0)), dtype=series.dtype)
+        if roi.size == 0:
+            return roi if len(img_shape) == 3 else roi[0]
+
+        for roi_z, z in enumerate(range(z0, z1)):
+            page = series[z]
+            if page is None:  # missing page in a multi-file series
+                continue
+            keyframe = page.keyframe  # pages of a series share the tiling and compression of their keyframe
+            if keyframe.is_tiled:
+                seg_h, seg_w = keyframe.tilelength, keyframe.tilewidth
+            else:  # strips are full width
+                seg_h, seg_w = keyframe.rowsperstrip, keyframe.imagewidth
+            n_seg_x = -(-keyframe.imagewidth // seg_w)
+            filehandle = page.parent.filehandle
+            for seg_y in range(y0 // seg_h, -(-y1 // seg_h)):
+                for seg_x in range(x0 // seg_w, -(-x1 // seg_w)):
+                    index = seg_y * n_seg_x + seg_x
+                    data = None
+                    if page.databytecounts[index]:
+                        filehandle.seek(page.dataoffsets[index])
+                        data = filehandle.read(page.databytecounts[index])
+                    segment, _, seg_shape = keyframe.decode(data, index)
+                    if segment is None:  # empty tile, stays 0
+                        continue
+                    segment = segment.reshape(seg_shape)[0, :, :, 0]  # (depth, length, width, samples)
+                    # overlap of the segment and the region
+                    sy0, sx0 = seg_y * seg_h, seg_x * seg_w
+                    oy0, oy1 = max(y0, sy0), min(y1, sy0 + segment.shape[0])
+                    ox0, ox1 = max(x0, sx0), min(x1, sx0 + segment.shape[1])
+                    roi[roi_z, oy0 - y0 : oy1 - y0, ox0 - x0 : ox1 - x0] = segment[
+                        oy0 - sy0 : oy1 - sy0, ox0 - sx0 : ox1 - sx0
+                    ]
+    return roi if len(img_shape) == 3 else roi[0]
+
+
+def stream_downscale_image(
+    read_path,
+    save_path,
+    n,
+    pages_per_chunk=1,
+    verbose=True,
+    mip_save_path=None,
+    ds_mip_save_path=None,
+    codec=None,
+):
+    """Downscales the tiff image at read_path by a factor of n in x and y dimensions and saves it at save_path.
+    The stack is read `pages_per_chunk` pages at a time and the downscaled planes are appended to the output file,
+    so memory use is a few planes irrespective of the number of z slices.
+    For z-stacks, the full resolution MIP and the downscaled MIP are found in the same pass and saved at
+    mip_save_path and ds_mip_save_path if given. codec: tiff compression of all outputs (see parse_codec).
+    Returns the shape of the saved image or None if the image can't be processed."""
+    ds_shapes = stream_downscale_image_levels(
+        read_path,
+        [save_path],
+        [n],
+        pages_per_chunk=pages_per_chunk,
+        verbose=verbose,
+        mip_save_path=mip_save_path,
+        ds_mip_save_paths=[ds_mip_save_path],
+        codecs=[codec],
+        mip_codec=codec,
+    )
+    return ds_shapes[0] if ds_shapes else None
+
+
+def put_plane(plane_queue, plane, writer):
+    """puts plane in the plane_queue of a writer thread, raises the writer's error instead of waiting forever if it
+    stopped"""
+    while True:
+        try:
+            plane_queue.put(plane, timeout=1)
+            return
+        except queue.Full:
+            if writer.done():
+                writer.result()  # raises the error of the writer
+                raise RuntimeError("Writer thread stopped before all planes were written")
+
+
+def iter_queue(item_queue):
+    """yields the items put in item_queue until None is put (iter(item_queue.get, None) can't be used for arrays, they
+    are compared to None element by element)"""
+    while True:
+        item = item_queue.get()
+        if item is None:
+            return
+        yield item
+
+
+# items (planes or chunks of planes) read ahead of the computation by the reader thread of prefetch
+PREFETCH_DEPTH = 2
+
+
+def prefetch(items, depth=PREFETCH_DEPTH):
+    """yields the items of the iterable items (which can't be None), read by a thread into a queue of at most depth
+    items, so the next pages are read and decoded (which releases the GIL) while the caller computes on the last ones.
+    The error of the reader is raised here. If the caller stops early the reader stops after its current item."""
+    item_queue = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        """Returns: False if the caller stopped before item could be queued"""
+        while not stop.is_set():
+            try:
+                item_queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read_items():
+        try:
+            for item in items:
+                if not put(item):
+                    return
+        finally:
+            put(None)  # end of the items, also if reading failed
+
+    with ThreadPoolExecutor(1) as pool:
+        reader = pool.submit(read_items)
+        try:
+            yield from iter_queue(item_queue)
+        finally:
+            stop.set()
+        reader.result()  # raises the error of the reader
+
+
+def stream_downscale_image_levels(
+    read_path,
+    save_paths,
+    factors,
+    pages_per_chunk=1,
+    verbose=True,
+    mip_save_path=None,
+    ds_mip_save_paths=None,
+    codecs=None,
+    mip_codec=None,
+):
+    """Downscales the tiff image at read_path by every factor in factors (in x and y dimensions) and saves each level
+    at the matching save_paths from a single read of the stack. The stack is read `pages_per_chunk` pages at a time,
+    each level is derived from the previous one (2x from raw, 4x from 2x...; see downscale_pyramid_planes) and
+    written by its own thread, so memory use is a few planes per level irrespective of the number of z slices.
+    A reader thread reads the next chunks while the last one is downscaled (see prefetch), so reads, downscaling and
+    writes overlap.
+    For z-stacks, the full resolution MIP and the downscaled MIP of every level are found in the same pass and saved at
+    mip_save_path and ds_mip_save_paths if given.
+    codecs: tiff compression of every level and mip_codec of the MIPs (see parse_codec, default uncompressed).
+    Returns the list of shapes of the saved images (by increasing factor) or None if the image can't be processed."""
+    ds_mip_save_paths = ds_mip_save_paths or [None] * len(factors)
+    codecs = codecs or [None] * len(factors)
+    # increasing factors, so that every level can be binned from the previous one
+    levels = sorted(zip(factors, save_paths, ds_mip_save_paths, codecs), key=lambda level: level[0])
+    factors = [factor for factor, _, _, _ in levels]
+    if verbose:
+        print(f"Reading: {read_path}")
+    with tiff.TiffFile(read_path) as tif:
+        series = tif.series[0]
+        img_shape, og_datatype = series.shape, series.dtype
+        if verbose:
+            print(f"Shape of read image {img_shape}")
+        if len(img_shape) not in (2, 3):
+            print("Can't process images with >3dimensions")
+            return None
+        ds_shapes = [img_shape[:-2] + (-(-img_shape[-2] // factor), -(-img_shape[-1] // factor)) for factor in factors]
+        mips = {}  # running max of the full resolution and downscaled planes
+
+        def read_chunks():
+            pages = iter(series)
+            while True:
+                chunk = []
+                for page in itertools.islice(pages, pages_per_chunk):
+                    # missing pages in a multi-file series are read as zeros
+                    chunk.append(np.zeros(img_shape[-2:], og_datatype) if page is None else page.asarray())
+                if not chunk:
+                    return
+                yield np.stack(chunk)
+
+        def write_level(save_path, ds_shape, codec, plane_queue):
+            write_tiff(save_path, iter_queue(plane_queue), codec, shape=ds_shape, dtype=og_datatype)
+
+        plane_queues = [queue.Queue(maxsize=2 * pages_per_chunk) for _ in levels]
+        with ThreadPoolExecutor(len(levels)) as pool:
+            writers = [
+                pool.submit(write_level, save_path, ds_shape, codec, plane_queue)
+                for (_, save_path, _, codec), ds_shape, plane_queue in zip(levels, ds_shapes, plane_queues)
+            ]
+            try:
+                # the next chunks are read by a thread while this one is downscaled and the writers write
+                # (closed before the file, also if downscaling or writing failed)
+                with contextlib.closing(prefetch(read_chunks())) as chunks:
+                    for chunk in chunks:
+                        chunk_levels = downscale_pyramid_planes(chunk, factors)
+                        for key, planes in [("mip", chunk)] + list(enumerate(chunk_levels)):
+                            if key in mips:
+                                np.maximum(mips[key], planes.max(axis=0), out=mips[key])
+                            else:
+                                mips[key] = planes.max(axis=0)
+                        for plane_queue, writer, chunk_downscaled in zip(plane_queues, writers, chunk_levels):
+                            for plane in chunk_downscaled:
+                                put_plane(plane_queue, plane, writer)
+            finally:  # let the writers finish (or stop, if reading failed)
+                for plane_queue, writer in zip(plane_queues, writers):
+                    if not writer.done():
+                        put_plane(plane_queue, None, writer)
+            for writer in writers:
+                writer.result()  # raises the error of a failed writer
+    if len(img_shape) == 3:  # only z-stacks have a MIP
+        if mip_save_path:
+            write_tiff(mip_save_path, mips["mip"], mip_codec)
+        for i, (_, _, ds_mip_save_path, _) in enumerate(levels):
+            if ds_mip_save_path:
+                write_tiff(ds_mip_save_path, mips[i], mip_codec)
+    return ds_shapes
+
+
+def get_mip_save_path(save_dir, og_name, ext, ch_names=("GFP", "RFP")):
+    """returns the save path of the MIP of the image og_name in the '<channelname>_mip' folder inside save_dir,
+    named like oswalk_batchprocess_mip names them. Returns None if og_name has none of the ch_names."""
+    for ch_name in ch_names:
+        if ch_name.casefold() in og_name.casefold():
+            dest = os.path.join(save_dir, ch_name.casefold() + "_mip")
+            os.makedirs(dest, exist_ok=True)
+            return os.path.join(dest, f"{og_name.replace('_MMStack', '')}_mip.{ext}")
+    return None
+
+
+## OME-Zarr output
+# Multiscale pyramids (OME-NGFF v0.4) with chunked, compressed levels so viewers only load the chunks they need.
+# zarr is only imported when an OME-Zarr file is written.
+
+
+def import_zarr():
+    """imports zarr (v2 API) which is only needed for OME-Zarr outputs"""
+    try:
+        import zarr
+    except ImportError:
+        print("ERROR: OME-Zarr output needs the zarr package, install it with: pip install 'zarr<3'. Exiting")
+        exit()
+    return zarr
+
+
+def zarr_compressor(codec):
+    """returns the Blosc compressor of the codec string "<name>[:<level>]" for OME-Zarr chunks, name is one of
+    'zstd', 'lz4', 'deflate' (zlib) or 'none' (uncompressed chunks, returns None)"""
+    import_zarr()
+    from numcodecs import Blosc  # installed with zarr
+
+    name, _, level = (codec or "none").strip().casefold().removesuffix("+predictor").partition(":")
+    blosc_names = {"zstd": "zstd", "lz4": "lz4", "deflate": "zlib", "zlib": "zlib"}
+    if name == "none":
+        return None
+    if name not in blosc_names:
+        print(f"User Error: OME-Zarr compression MUST be one of {list(blosc_names)} or 'none', not '{codec}'. Exiting")
+        exit()
+    # bit shuffle groups the same bits of neighbouring pixels, which compresses microscopy images much better
+    return Blosc(cname=blosc_names[name], clevel=int(level) if level else 5, shuffle=Blosc.BITSHUFFLE)
+
+
+def write_ome_zarr(
+    save_path,
+    planes,
+    shape,
+    dtype,
+    factors=(1, 2, 4, 8),
+    pixel_spacing=(ZD, YD, XD),
+    chunk_size=512,
+    z_chunk=8,
+    codec="zstd:5",
+):
+    """Writes a 2D image or z-stack, given plane by plane in `planes` (an iterable of 2D arrays), as an OME-Zarr
+    multiscale pyramid at save_path with one level per downscaling factor (in x and y, not z).
+    All levels are written in one pass over the planes, z_chunk planes at a time, in chunks of
+    (z_chunk, chunk_size, chunk_size) compressed with Blosc (codec: 'zstd', 'lz4' or 'deflate' with optional ':level').
+    pixel_spacing: pixel width (plane, row, col) in µm of the given planes"""
+    zarr = import_zarr()
+
+    factors = sorted(set(factors))
+    if factors[0] < 1:
+        print(f"User Error: pyramid factors {factors} MUST be positive integers. Exiting")
+        exit()
+    shape = tuple(int(ax_len) for ax_len in shape)
+    compressor = zarr_compressor(codec)
+    # written in a temporary folder, a killed run never leaves a half written pyramid at save_path
+    with atomic_save_path(save_path) as tmp_path:
+        group = zarr.open_group(tmp_path, mode="w")
+        level_arrays = []
+        for i, factor in enumerate(factors):
+            level_shape = shape[:-2] + (-(-shape[-2] // factor), -(-shape[-1] // factor))
+            level_chunks = (z_chunk,) * (len(shape) - 2) + (chunk_size, chunk_size)
+            level_arrays.append(
+                group.create_dataset(
+                    str(i),
+                    shape=level_shape,
+                    chunks=level_chunks,
+                    dtype=dtype,
+                    compressor=compressor,
+                    dimension_separator="/",
+                )
+            )
+
+        # metadata so that viewers (napari, Fiji, neuroglancer...) know the levels and physical pixel size
+        axes = [{"name": ax_name, "type": "space", "unit": "micrometer"} for ax_name in ("z", "y", "x")]
+        axes = axes[-len(shape) :]
+        datasets = []
+        for i, factor in enumerate(factors):
+            scale = [pixel_spacing[0], pixel_spacing[1] * factor, pixel_spacing[2] * factor][-len(shape) :]
+            datasets.append({"path": str(i), "coordinateTransformations": [{"type": "scale", "scale": scale}]})
+        group.attrs["multiscales"] = [
+            {"version": "0.4", "name": os.path.basename(save_path).split(".")[0], "axes": axes, "datasets": datasets}
+        ]
+
+        if len(shape) == 2:
+            for level_array, level in zip(level_arrays, downscale_pyramid_planes(next(iter(planes)), factors)):
+                level_array[...] = level
+            return
+
+        def write_slab(z0, slab):
+            for level_array, level in zip(level_arrays, downscale_pyramid_planes(np.stack(slab), factors)):
+                level_array[z0 : z0 + len(slab)] = level
+
+        z0, slab = 0, []
+        for plane in planes:  # whole z chunks are written at once, no chunk is written twice
+            slab.append(plane)
+            if len(slab) == z_chunk:
+                write_slab(z0, slab)
+                z0, slab = z0 + z_chunk, []
+        if slab:
+            write_slab(z0, slab)
+
+
+def stream_image_to_ome_zarr(read_path, save_path, factors, mip_save_path=None, verbose=True, mip_codec=None):
+    """Reads the tiff image at read_path page by page and saves it as an OME-Zarr pyramid (see write_ome_zarr) at
+    save_path. For z-stacks, the full resolution MIP is found in the same pass and saved at mip_save_path if given
+    (compressed with mip_codec, see parse_codec).
+    Returns the shape of the read image or None if the image can't be processed."""
+    if verbose:
+        print(f"Reading: {read_path}")
+    with tiff.TiffFile(read_path) as tif:
+        series = tif.series[0]
+        img_shape, og_datatype = series.shape, series.dtype
+        if len(img_shape) not in (2, 3):
+            print("Can't process images with >3dimensions")
+            return None
+        mips = {}  # running max of the planes
+
+        def planes():
+            for page in series:
+                # missing pages in a multi-file series are read as zeros
+                plane = np.zeros(img_shape[-2:], og_datatype) if page is None else page.asarray()
+                if "mip" in mips:
+                    np.maximum(mips["mip"], plane, out=mips["mip"])
+                else:
+                    mips["mip"] = plane.copy()
+                yield plane
+
+        write_ome_zarr(save_path, planes(), img_shape, og_datatype, factors, pixel_spacing=(ZD, YD, XD))
+    if len(img_shape) == 3 and mip_save_path:
+        write_tiff(mip_save_path, mips["mip"], mip_codec)
+    return img_shape
+
+
+## Shared memory
+# arrays in multiprocessing.shared_memory blocks are handed to other processes by name, the pixels are never pickled
+
+SharedArraySpec = collections.namedtuple("SharedArraySpec", ["name", "shape", "dtype"])
+# resource_tracker.register is patched out while a block is attached on python < 3.13 (see attach_shared_array)
+_untracked_attach_lock = threading.Lock()
+
+
+def create_shared_array(shape, dtype):
+    """creates a zero filled array in a new shared memory block, the caller must close() and unlink() the block
+    when done with it
+    Returns: (shared memory block, np.array on the block, SharedArraySpec to attach it in other processes)"""
+    shape = tuple(int(ax_len) for ax_len in shape)
+    dtype = np.dtype(dtype)
+    # new blocks are zero filled by the OS
+    shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf), SharedArraySpec(shm.name, shape, dtype.str)
+
+
+@contextlib.contextmanager
+def attach_shared_array(spec):
+    """attaches the shared memory block of spec (see create_shared_array) in this process and yields the np.array on
+    it, the block is closed (not unlinked) on exit. The array must not be used after the with block."""
+    try:  # only the creating process unlinks the block, not this one when it exits
+        shm = shared_memory.SharedMemory(name=spec.name, track=False)
+    except TypeError:
+        # python < 3.13 has no track argument and registers the block in the resource tracker of this process. A
+        # process with its own tracker would unlink the block under the creating process when it exits (and warn
+        # about a leak), and unregistering it again would drop the creator's registration from a tracker shared with
+        # it (e.g. loky workers started with the tracker's fd). So the block isn't registered at all, like track=False
+        with _untracked_attach_lock:
+            register = resource_tracker.register
+            resource_tracker.register = lambda name, rtype: None
+            try:
+                shm = shared_memory.SharedMemory(name=spec.name)
+            finally:
+                resource_tracker.register = register
+    try:
+        yield np.ndarray(spec.shape, dtype=np.dtype(spec.dtype), buffer=shm.buf)
+    finally:
+        shm.close()
+
+
+## Acquisition index
+# One SQLite file per experiment tree with a row per directory and per file (with fish/region/channel/timepoint and
+# image shape for tiff files). It is refreshed using directory mtimes, so unchanged folders aren't listed again.
+
+
+def get_acquisition_index_path(top_dir):
+    """returns the path of the local acquisition index file of the experiment tree at top_dir"""
+    top_dir = os.path.abspath(top_dir)
+    digest = hashlib.sha1(top_dir.encode()).hexdigest()[:16]
+    return os.path.join(ACQ_INDEX_DIR, f"{os.path.basename(top_dir)}_{digest}.sqlite")
+
+
+def find_acquisition_index(path):
+    """finds the acquisition index of path or of its nearest indexed parent folder
+    Returns: (indexed top_dir, index_path), or (None, None) if path isn't indexed"""
+    path = os.path.abspath(path)
+    while True:
+        index_path = get_acquisition_index_path(path)
+        if os.path.isfile(index_path):
+            return (path, index_path)
+        if os.path.dirname(path) == path:  # reached root
+            return (None, None)
+        path = os.path.dirname(path)
+
+
+def open_acquisition_index(index_path):
+    """opens (and creates if needed) the SQLite acquisition index at index_path"""
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    con = sqlite3.connect(index_path, timeout=60)
+    con.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, parent TEXT, mtime_ns INTEGER);
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY, dir TEXT, filename TEXT, size INTEGER, mtime_ns INTEGER,
+            fish INTEGER, region INTEGER, channel TEXT, timepoint INTEGER, overflow INTEGER, shape TEXT, dtype TEXT
+        );
+        CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+        CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+        """
+    )
+    return con
+
+
+def scan_dir(dir_path, known_mtime_ns=None):
+    """lists dir_path with os.scandir
+    Returns: (mtime_ns, (subdir names, [(filename, size, mtime_ns), ...])), listing is None if the directory mtime
+    is still known_mtime_ns and (None, None) if the directory doesn't exist anymore"""
+    try:
+        mtime_ns = os.stat(dir_path).st_mtime_ns
+    except FileNotFoundError:
+        return (None, None)
+    if mtime_ns == known_mtime_ns:  # nothing added, removed or renamed in this directory
+        return (mtime_ns, None)
+    subdirs, files = [], []
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            if entry.name.startswith(TMP_PREFIX):  # output that is still being written
+                continue
+            if entry.is_dir():
+                subdirs.append(entry.name)
+            elif entry.is_file():
+                file_stat = entry.stat()
+                files.append((entry.name, file_stat.st_size, file_stat.st_mtime_ns))
+    return (mtime_ns, (subdirs, files))
+
+
+def parse_acquisition_path(rel_path):
+    """finds fish, region (pos), channel, timepoint and MMStack overflow number in the path of an image relative to
+    the experiment folder, the last match wins (file name over folder names). Missing values are None."""
+    stem = os.path.join(os.path.dirname(rel_path), os.path.basename(rel_path).split(".")[0])
+    fields = {"fish": None, "region": None, "channel": None, "timepoint": None, "overflow": None}
+    for match in IMG_NAME_FIELD_RE.finditer(stem):
+        key = match.lastgroup
+        if key == "channel":
+            fields[key] = match[key].upper()
+        else:
+            fields["region" if key == "pos" else key] = int(match[key])
+    return fields
+
+
+def index_file_record(top_dir, file_path, size, mtime_ns):
+    """returns the row of file_path for the acquisition index, tiff files are parsed and their shape probed"""
+    record = {"fish": None, "region": None, "channel": None, "timepoint": None, "overflow": None}
+    shape, dtype = None, None
+    if file_path.split(".")[-1] in ("tif", "tiff"):
+        record = parse_acquisition_path(os.path.relpath(file_path, top_dir))
+        try:
+            img_shape, img_dtype = probe_image_shape(file_path)
+            shape, dtype = json.dumps(img_shape), str(img_dtype)
+        except Exception as err:  # unreadable/partial tiff, keep it in the index without a shape
+            print(f"Warning: Couldn't read the header of {file_path}: {err}")
+    return (
+        file_path,
+        os.path.dirname(file_path),
+        os.path.basename(file_path),
+        size,
+        mtime_ns,
+        record["fish"],
+        record["region"],
+        record["channel"],
+        record["timepoint"],
+        record["overflow"],
+        shape,
+        dtype,
+    )
+
+
+def update_acquisition_index(top_dir, start_dir=None, num_threads=16):
+    """Scans the experiment tree at top_dir into its local acquisition index (created on the first call).
+    Directories are listed level by level in parallel threads, directories whose mtime didn't change since the last
+    scan aren't listed again and only new or modified files are parsed and probed.
+    start_dir refreshes only that subtree. Returns the index path."""
+    top_dir = os.path.abspath(top_dir)
+    start_dir = os.path.abspath(start_dir or top_dir)
+    index_path = get_acquisition_index_path(top_dir)
+    con = open_acquisition_index(index_path)
+    subtree_query = "SELECT path, parent, mtime_ns FROM dirs WHERE path = ? OR substr(path, 1, ?) = ?"
+    subtree_args = (start_dir, len(start_dir) + 1, start_dir + os.sep)
+    try:
+        with con, ThreadPoolExecutor(num_threads) as pool:  # one transaction per update
+            known_mtimes, known_children = {}, {}
+            for dir_path, parent, mtime_ns in con.execute(subtree_query, subtree_args):
+                known_mtimes[dir_path] = mtime_ns
+                known_children.setdefault(parent, []).append(dir_path)
+
+            visited_dirs, changed_files = set(), []
+            level = [start_dir]
+            while level:
+                next_level = []
+                scans = pool.map(lambda dir_path: scan_dir(dir_path, known_mtimes.get(dir_path)), level)
+                for dir_path, (mtime_ns, listing) in zip(level, scans):
+                    if mtime_ns is None:  # removed during the scan
+                        continue
+                    visited_dirs.add(dir_path)
+                    if listing is None:  # unchanged, use the stored listing
+                        next_level.extend(known_children.get(dir_path, []))
+                        continue
+                    subdirs, files = listing
+                    parent = None if dir_path == top_dir else os.path.dirname(dir_path)
+                    con.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)", (dir_path, parent, mtime_ns))
+                    next_level.extend(os.path.join(dir_path, sub) for sub in subdirs)
+
+                    known_files = {
+                        filename: (size, file_mtime_ns)
+                        for filename, size, file_mtime_ns in con.execute(
+                            "SELECT filename, size, mtime_ns FROM files WHERE dir = ?", (dir_path,)
+                        )
+                    }
+                    current_filenames = {filename for filename, _, _ in files}
+                    con.executemany(
+                        "DELETE FROM files WHERE path = ?",
+                        [(os.path.join(dir_path, filename),) for filename in known_files if filename not in current_filenames],
+                    )
+                    for filename, size, file_mtime_ns in files:
+                        if known_files.get(filename) != (size, file_mtime_ns):  # new or modified
+                            changed_files.append((os.path.join(dir_path, filename), size, file_mtime_ns))
+                level = next_level
+
+            # remove directories that don't exist anymore
+            removed_dirs = [(dir_path,) for dir_path in known_mtimes if dir_path not in visited_dirs]
+            con.executemany("DELETE FROM dirs WHERE path = ?", removed_dirs)
+            con.executemany("DELETE FROM files WHERE dir = ?", removed_dirs)
+
+            # parse and probe the tiff headers of new files in parallel
+            records = pool.map(lambda args: index_file_record(top_dir, *args), changed_files)
+            con.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", records)
+    finally:
+        con.close()
+    return index_path
+
+
+def walk_acquisition(top_dir):
+    """Drop-in replacement for os.walk(top_dir) (top-down, subfolders can be pruned in place).
+    If top_dir is inside an indexed experiment, that subtree of the index is refreshed and read instead of listing
+    every folder again; otherwise falls back to os.walk."""
+    index_top_dir, index_path = find_acquisition_index(top_dir)
+    if index_path is None:
+        for root, subfolders, filenames in os.walk(top_dir):
+            # skip outputs that are still being written, subfolders can still be pruned in place by the caller
+            subfolders[:] = [sub for sub in subfolders if not sub.startswith(TMP_PREFIX)]
+            yield root, subfolders, [filename for filename in filenames if not filename.startswith(TMP_PREFIX)]
+        return
+    update_acquisition_index(index_top_dir, start_dir=top_dir)
+    abs_top_dir = os.path.abspath(top_dir)
+    con = open_acquisition_index(index_path)
+    try:
+        dir_stack = [abs_top_dir]
+        while dir_stack:
+            abs_root = dir_stack.pop()
+            subfolders = natsorted(
+                os.path.basename(dir_path)
+                for (dir_path,) in con.execute("SELECT path FROM dirs WHERE parent = ?", (abs_root,))
+            )
+            filenames = natsorted(
+                filename for (filename,) in con.execute("SELECT filename FROM files WHERE dir = ?", (abs_root,))
+            )
+            # keep the same form of path (relative/absolute) that was passed in
+            root = top_dir if abs_root == abs_top_dir else os.path.join(top_dir, os.path.relpath(abs_root, abs_top_dir))
+            yield root, subfolders, filenames
+            dir_stack.extend(os.path.join(abs_root, sub) for sub in reversed(subfolders))
+    finally:
+        con.close()
+
+
+def query_acquisition_index(top_dir, **filters):
+    """Returns the tiff file records (dicts with path, fish, region, channel, timepoint, overflow, shape, dtype,
+    size, mtime_ns) under top_dir from its acquisition index, sorted by path.
+    filters are column=value pairs, e.g. channel="GFP", fish=1. Returns None if top_dir isn't indexed."""
+    index_top_dir, index_path = find_acquisition_index(top_dir)
+    if index_path is None:
+        return None
+    update_acquisition_index(index_top_dir, start_dir=top_dir)
+    abs_top_dir = os.path.abspath(top_dir)
+    columns = ["path", "fish", "region", "channel", "timepoint", "overflow", "shape", "dtype", "size", "mtime_ns"]
+    query = f"SELECT {', '.join(columns)} FROM files WHERE shape IS NOT NULL AND (dir = ? OR substr(dir, 1, ?) = ?)"
+    args = [abs_top_dir, len(abs_top_dir) + 1, abs_top_dir + os.sep]
+    for column, value in filters.items():
+        if column not in columns:
+            raise ValueError(f"Unknown acquisition index column: {column}")
+        query += f" AND {column} = ?"
+        args.append(value)
+    con = open_acquisition_index(index_path)
+    try:
+        records = [dict(zip(columns, row)) for row in con.execute(query, args)]
+    finally:
+        con.close()
+    for record in records:
+        record["shape"] = tuple(json.loads(record["shape"]))
+    return natsorted(records, key=lambda record: record["path"])
+
+
+## notes.txt stage positions
+# Every acquisition has a notes.txt (ConfigParser format) with a 'Fish <n> Region <m>' section per stage position.
+# It is parsed once into a table and cached per path and file modification time, so every fish, channel and stitcher
+# reuses it.
+
+NOTES_NAMES = ("notes.txt", "Notes.txt")
+# stage x, y, z keys of a region, abbreviated (WIL and KLA LSM store this format) or long
+NOTES_POSITION_KEYS = (("x_pos", "y_pos", "z_stack_start_pos"), ("x_position", "y_position", "z_start_position"))
+NOTES_REGION_SECTION = re.compile(r"fish\s*(\d+)\s*region\s*(\d+)", re.IGNORECASE)
+
+# config: the parsed ConfigParser, fish, region: 1D int arrays, coords: stage x, y, z of every region (NaN if missing)
+NotesTable = collections.namedtuple("NotesTable", ["path", "config", "fish", "region", "coords"])
+
+
+def find_notes_file(start_path):
+    """finds the nearest notes.txt (any of NOTES_NAMES) in start_path or the folders above it, in one walk up
+    Returns: path of the file, None if not found"""
+    cur_path = os.path.abspath(start_path)
+    while True:
+        for notes_name in NOTES_NAMES:
+            if os.path.isfile(os.path.join(cur_path, notes_name)):
+                print(f"found {notes_name} at:" + cur_path)
+                return os.path.join(cur_path, notes_name)
+        if os.path.dirname(cur_path) == cur_path:  # reached root
+            print(f"Warning: Couldn't find notes.txt file in the directory structure of {start_path}")
+            return None
+        cur_path = os.path.dirname(cur_path)
+
+
+def load_notes_table(notes_path):
+    """Returns: NotesTable of the notes.txt at notes_path, parsed once and cached per path and file modification time
+    (the table is shared, don't modify it)"""
+    file_stat = os.stat(notes_path)
+    return _load_notes_table(os.path.abspath(notes_path), file_stat.st_mtime_ns, file_stat.st_size)
+
+
+@functools.lru_cache(maxsize=256)
+def _load_notes_table(notes_path, mtime_ns, file_size):
+    """cached by load_notes_table, a modified file gets a new (mtime_ns, file_size) key"""
+    config = configparser.ConfigParser()
+    config.read(notes_path)
+    fish, region, coords = [], [], []
+    for section in config.sections():
+        match = NOTES_REGION_SECTION.fullmatch(section.strip())
+        if match is None:
+            continue
+        # each region is read with the key style it has
+        keys = next((keys for keys in NOTES_POSITION_KEYS if config.has_option(section, keys[0])), NOTES_POSITION_KEYS[0])
+        fish.append(int(match.group(1)))
+        region.append(int(match.group(2)))
+        coords.append([config.getfloat(section, key, fallback=np.nan) for key in keys])
+    return NotesTable(
+        notes_path,
+        config,
+        np.array(fish, dtype=int),
+        np.array(region, dtype=int),
+        np.array(coords, dtype=float).reshape(-1, 3),
+    )
+
+
+def read_stage_coords(start_path, fish_num, pos_max, interactive=True):
+    """reads the stage x, y, z of regions 1 to pos_max of fish fish_num from the nearest notes.txt above start_path
+    (see find_notes_file and load_notes_table), with interactive=False a missing notes.txt exits instead of asking
+    Returns: np.array of shape (pos_max, 3)"""
+    notes_path = find_notes_file(start_path)
+    if notes_path is None and not interactive:
+        print(f"Error: Can't find notes.txt above {start_path}. Exiting")
+        exit(1)
+    if notes_path is None:
+        print("Error: Can't find notes.txt, Enter manually")
+        notes_path = input("Enter complete path (should end with .txt): ")
+    notes_table = load_notes_table(notes_path)
+
+    # row of every region in the table, -1 if missing
+    rows = np.full(pos_max, -1)
+    fish_rows = np.flatnonzero((notes_table.fish == fish_num) & (notes_table.region >= 1) & (notes_table.region <= pos_max))
+    rows[notes_table.region[fish_rows] - 1] = fish_rows
+    stage_coords = notes_table.coords[rows] if len(notes_table.coords) else np.full((pos_max, 3), np.nan)
+    missing = (rows < 0) | np.isnan(stage_coords).any(axis=1)
+    if missing.any():
+        print(
+            f"Error: No stage position of Fish {fish_num} Region {(np.flatnonzero(missing) + 1).tolist()} in {notes_path}. "
+            "Exiting"
+        )
+        exit(1)
+    print(f"Found stage_coords: \n{stage_coords}")
+    return stage_coords
+
+
+## Run manifest
+# Every finished output is recorded as one JSON line (stage, inputs with their size and mtime, parameters hash,
+# outputs, status) in a manifest next to the outputs, so a rerun after a crash skips the up to date work.
+# Only the driver (never a joblib worker) appends to a manifest, a line cut off by a killed run is ignored.
+MANIFEST_NAME = "batch_manifest.jsonl"
+
+
+def params_hash(**params):
+    """returns a short hash of the parameters (anything json serializable, or with a str) of a processing stage"""
+    return hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def input_stamp(read_paths):
+    """Returns: ([size], [mtime_ns]) of the files in read_paths, None if any of them is missing"""
+    try:
+        stats = [os.stat(read_path) for read_path in read_paths]
+    except FileNotFoundError:
+        return None
+    return ([stat.st_size for stat in stats], [stat.st_mtime_ns for stat in stats])
+
+
+def load_manifest(manifest_path):
+    """reads the run manifest at manifest_path, later records of an input replace the earlier ones
+    Returns: dict {(stage, input paths): record}, empty if there is no manifest yet"""
+    manifest = {}
+    if not os.path.isfile(manifest_path):
+        return manifest
+    with open(manifest_path, encoding="utf-8") as manifest_file:
+        for line in manifest_file:
+            try:
+                record = json.loads(line)
+            except ValueError:  # truncated line of a killed run
+                continue
+            manifest[(record["stage"], tuple(record["inputs"]))] = record
+    return manifest
+
+
+def is_up_to_date(manifest, stage, read_paths, params_digest):
+    """returns True if the manifest has a finished record of stage for read_paths with the same parameters, the
+    inputs haven't changed (size and mtime) since and all its outputs still exist"""
+    record = manifest.get((stage, tuple(read_paths)))
+    if record is None or record["status"] != "done" or record["params"] != params_digest:
+        return False
+    if input_stamp(read_paths) != (record["size"], record["mtime_ns"]):
+        return False
+    return all(os.path.exists(output) for output in record["outputs"])
+
+
+def append_manifest(manifest_path, stage, read_paths, params_digest, outputs, status="done"):
+    """appends the record of one finished (or failed) input to the manifest at manifest_path and flushes it to disk,
+    outputs that weren't written (e.g. MIPs of 2D images) are left out"""
+    stamp = input_stamp(read_paths) or ([], [])
+    record = {
+        "stage": stage,
+        "inputs": list(read_paths),
+        "size": stamp[0],
+        "mtime_ns": stamp[1],
+        "params": params_digest,
+        "outputs": [output for output in outputs if output and os.path.exists(output)],
+        "status": status,
+    }
+    write_manifest_record(manifest_path, record)
+
+
+def write_manifest_record(manifest_path, record):
+    """appends record (see append_manifest) to the manifest at manifest_path and flushes it to disk"""
+    os.makedirs(os.path.dirname(manifest_path) or ".", exist_ok=True)
+    with open(manifest_path, "a+b") as manifest_file:
+        if manifest_file.tell() > 0:  # start on a new line if the last record was cut off
+            manifest_file.seek(-1, os.SEEK_END)
+            if manifest_file.read(1) != b"\n":
+                manifest_file.write(b"\n")
+        manifest_file.write((json.dumps(record) + "\n").encode("utf-8"))
+        manifest_file.flush()
+        os.fsync(manifest_file.fileno())
+
+
+def relocate_manifest_outputs(manifest_path, moved_paths):
+    """records the new location of outputs moved after they were written (e.g. sorted into channel folders) in the
+    manifest at manifest_path, so that reruns still find them and skip their inputs
+    moved_paths: dict {old path: new path}"""
+    moved_paths = {os.path.normpath(old_path): new_path for old_path, new_path in moved_paths.items()}
+    for record in load_manifest(manifest_path).values():
+        outputs = [moved_paths.get(os.path.normpath(output), output) for output in record["outputs"]]
+        if outputs != record["outputs"]:  # later records of an input replace the earlier ones
+            write_manifest_record(manifest_path, dict(record, outputs=outputs))
+
+
 # Important functions
 
 
 def read_n_downscale_image(read_path, n):
     """Reads the image from read_path and downscales it by a factor of n in x and y dimensions."""
     print(f"Reading: {read_path}")
-    img = tiff.imread(read_path)
+    img = read_tiff_stack(read_path)
     print(f"Shape of read image {img.shape}")
+    if len(img.shape) not in (2, 3):
+        print("Can't process images with >3dimensions")
+        return None
+    if np.issubdtype(img.dtype, np.integer):
+        # integer box filter over y & x (no ds in z), no float round trip
+        return downscale_planes_int(img, n)
     if len(img.shape) == 2:  # 2 dimensional image, e.g. BF image
         # use a kernel of nxn, ds by a factor of n in x & y
         img_downscaled = skimage.transform.downscale_local_mean(img, (n, n))
-    elif len(img.shape) == 3:  # image zstack
+    else:  # image zstack
         # use a kernel of 1xnxn, no ds in z
         img_downscaled = skimage.transform.downscale_local_mean(img, (1, n, n))
-    else:
-        print("Can't process images with >3dimensions")
-        return None
     # the downsampling algorithm produces float values,
     # so recast the ds image to the original datatype
     return np.round(img_downscaled).astype(img.dtype)
 
 
-def single_acquisition_downsample(acq_path, new_trg_path, n):
-    """downsamples the images in the Acquisition folder at the acq_path and saves them in the new_trg_path"""
+def single_acquisition_downsample(acq_path, new_trg_path, n, mip_trg_path=None, zarr_factors=None, codec=None):
+    """downsamples the images in the Acquisition folder at the acq_path and saves them in the new_trg_path.
+    Fused mode: if mip_trg_path is given, every z-stack is read once to also save its downsampled MIP
+    (in '<channelname>_mip' next to the downsampled stack) and its full resolution MIP (in mip_trg_path)
+    OME-Zarr mode: if zarr_factors are given (e.g. [1, 2, 4, 8]), every image is saved as one '.ome.zarr' pyramid
+    with a level per factor instead of a tiff downscaled by n (only the full resolution MIP is saved in fused mode)
+    Multi-level mode: if n is a list of factors (e.g. [2, 4, 8]) and new_trg_path a list of as many folders, every image
+    is read once and each downscaled level is saved in its own folder (4x is made from 2x, 8x from 4x...)
+    codec: tiff compression of the saved images and MIPs (see parse_codec), by default the n=1 copies are compressed
+    with 'deflate' and everything else is uncompressed
+    Images already downsampled with the same parameters (see the run manifest in new_trg_path) are skipped"""
+    copy_codec = codec or "deflate"  # n=1 is a compressed copy
+    n_list = list(n) if isinstance(n, (list, tuple)) else [n]
+    trg_path_list = list(new_trg_path) if isinstance(new_trg_path, (list, tuple)) else [new_trg_path]
+    if zarr_factors:  # all levels go in the one pyramid, n isn't used
+        n_list = n_list[:1]
+    if len(n_list) != len(trg_path_list):
+        print("Error: Need one target folder for every downscaling factor. Exiting")
+        exit()
+    n, new_trg_path = n_list[0], trg_path_list[0]  # single level modes
+    manifest_path = os.path.join(new_trg_path, MANIFEST_NAME)
+    manifest = load_manifest(manifest_path)
+    params_digest = params_hash(
+        n=n_list, trg=trg_path_list, mip_trg=mip_trg_path, zarr_factors=zarr_factors, codec=codec
+    )
     # Assuming the acq_path has the acquisition dir:
     # acq_path = Acquisition dir -> {fish1 dir, fish2 dir, etc.} + notes.txt
     files = os.listdir(acq_path)
@@ -187,13 +1378,17 @@ def single_acquisition_downsample(acq_path, new_trg_path, n):
         og_name = filename_list[0]  # first of list=name
         ext = filename_list[-1]  # last of list=extension
         if ext == "txt":  # copy text files
-            shutil.copy(os.path.join(acq_path, filename), new_trg_path)
+            for trg_path in trg_path_list:
+                copy_file(os.path.join(acq_path, filename), trg_path)
+            if mip_trg_path:  # notes.txt is needed to stitch the MIPs
+                os.makedirs(mip_trg_path, exist_ok=True)
+                copy_file(os.path.join(acq_path, filename), mip_trg_path)
             print(f"copied text file: {filename}")
 
     # find if multiple `fish` folders are present at `acq_path`
     multi_fish_flag = find_multi_subdir(subdir_path=acq_path, subdir_name="fish")
 
-    for root, subfolders, filenames in os.walk(acq_path):
+    for root, subfolders, filenames in walk_acquisition(acq_path):
         for filename in filenames:
             filepath = os.path.join(root, filename)
             filename_list = filename.split(".")
@@ -201,6 +1396,9 @@ def single_acquisition_downsample(acq_path, new_trg_path, n):
             ext = filename_list[-1]  # last of list=extension
 
             if (ext == "tif" or ext == "tiff") and (not check_overflowed_stack(og_name)):  # all tiff files, except overflowed stacks
+                if is_up_to_date(manifest, "downsample", [filepath], params_digest):
+                    print(f"up to date, skipping: {filepath}")
+                    continue
                 if multi_fish_flag:  # save the ds images in fish folder
                     fish_num_str = filepath[filepath.casefold().rfind("fish") + len("fish")]
                     try:
@@ -208,29 +1406,82 @@ def single_acquisition_downsample(acq_path, new_trg_path, n):
                     except ValueError:
                         print(f"Error: Couldn't find fish number in {filepath}")
                         exit()
-                    save_path = os.path.join(new_trg_path, "fish" + str(fish_num))
-                    check_create_save_path(save_path)  # make fish num folders
+                    save_path_list = [os.path.join(trg_path, "fish" + str(fish_num)) for trg_path in trg_path_list]
+                    for save_path in save_path_list:
+                        check_create_save_path(save_path)  # make fish num folders
                 else:
-                    save_path = new_trg_path
+                    save_path_list = trg_path_list
+                save_path = save_path_list[0]
+
+                save_name = f"{og_name.replace("_MMStack", "")}"
+                save_name = check_n_rename_old_imgname(save_name, root)
+                mip_save_path, ds_mip_save_path = None, None
+                if mip_trg_path:  # fused mode, MIPs are only saved for z-stacks
+                    mip_save_path = get_mip_save_path(save_path.replace(new_trg_path, mip_trg_path), save_name, ext)
+                    ds_mip_name = save_name if n == 1 else f"{save_name}_ds"
+                    ds_mip_save_path = get_mip_save_path(save_path, ds_mip_name, ext)
+
+                outputs = [mip_save_path, ds_mip_save_path]  # saved files, for the run manifest
+                if zarr_factors:  # all downscaling levels in one file
+                    outputs = [os.path.join(save_path, f"{save_name}.ome.zarr"), mip_save_path]
+                    stream_image_to_ome_zarr(
+                        read_path=filepath,
+                        save_path=outputs[0],
+                        factors=zarr_factors,
+                        mip_save_path=mip_save_path,
+                        mip_codec=codec,
+                    )
+
+                elif len(n_list) > 1:  # all levels from one read, n=1 is the compressed copy
+                    level_names = [save_name if factor == 1 else f"{save_name}_ds" for factor in n_list]
+                    level_save_paths = [
+                        os.path.join(level_save_path, f"{level_name}.{ext}")
+                        for level_save_path, level_name in zip(save_path_list, level_names)
+                    ]
+                    ds_mip_save_paths = [
+                        get_mip_save_path(level_save_path, level_name, ext) if mip_trg_path else None
+                        for level_save_path, level_name in zip(save_path_list, level_names)
+                    ]
+                    outputs = level_save_paths + ds_mip_save_paths + [mip_save_path]
+                    stream_downscale_image_levels(
+                        read_path=filepath,
+                        save_paths=level_save_paths,
+                        factors=n_list,
+                        mip_save_path=mip_save_path,
+                        ds_mip_save_paths=ds_mip_save_paths,
+                        codecs=[copy_codec if factor == 1 else codec for factor in n_list],
+                        mip_codec=codec,
+                    )
 
-                if n == 1: # no downscaling needed
-                    img = tiff.imread(filepath)
-                    save_name = f"{og_name.replace("_MMStack", "")}"
-                    save_name = check_n_rename_old_imgname(save_name, root)
+                elif n == 1: # no downscaling needed
                     save_name = f"{save_name}.{ext}"
+                    outputs.append(os.path.join(save_path, save_name))
                     # shutil.copy(src=filepath, dst=os.path.join(save_path, save_name))
-                    tiff.imwrite(os.path.join(save_path, save_name), data=img, compression='Deflate')
-                    print(f"compressed image: {os.path.join(save_path, save_name)}")
+                    # a compressed copy streamed page by page like the downscaled images, MIPs from the same read
+                    stream_downscale_image_levels(
+                        read_path=filepath,
+                        save_paths=[outputs[-1]],
+                        factors=[1],
+                        mip_save_path=mip_save_path,
+                        ds_mip_save_paths=[ds_mip_save_path],
+                        codecs=[copy_codec],
+                        mip_codec=codec,
+                    )
+                    print(f"compressed image: {outputs[-1]}")
 
                 else: # downscale by n
-                    save_name = f"{og_name.replace("_MMStack", "")}"
-                    save_name = check_n_rename_old_imgname(save_name, root)
                     save_name = f"{save_name}_ds.{ext}"
-                    
-                    tiff.imwrite(
-                        os.path.join(save_path, save_name),
-                        read_n_downscale_image(read_path=filepath, n=n),
+                    outputs.append(os.path.join(save_path, save_name))
+                    # stream page by page instead of reading the whole stack
+                    stream_downscale_image(
+                        read_path=filepath,
+                        save_path=os.path.join(save_path, save_name),
+                        n=n,
+                        mip_save_path=mip_save_path,
+                        ds_mip_save_path=ds_mip_save_path,
+                        codec=codec,
                     )
+                append_manifest(manifest_path, "downsample", [filepath], params_digest, outputs)
 
 
 def find_2D_images(main_dir):
@@ -239,7 +1490,7 @@ def find_2D_images(main_dir):
     bf_path, gfp_mip_path, rfp_mip_path = "", "", ""
     bf_img_list, gfp_img_list, rfp_img_list = [], [], []
 
-    for root, subfolders, filenames in os.walk(main_dir):
+    for root, subfolders, filenames in walk_acquisition(main_dir):
         for filename in filenames:
             # filepath = os.path.join(root, filename)
             # print(f'Reading: {filepath}')
@@ -255,7 +1506,7 @@ def find_2D_images(main_dir):
                         remove_non_image_files(natsorted(os.listdir(root)), root)
                     )
                     bf_flag = True
-                elif "mip" in og_name.casefold():
+                elif og_name.casefold().endswith(PROJECTIONS["max"]):  # only MIPs, not the other projections
                     if (not gfp_flag) and ("gfp" in og_name.casefold()):
                         print("GFP MIP images found at:" + root)
                         gfp_mip_path = root
@@ -294,7 +1545,7 @@ def find_3D_images(main_dir):
     gfp_flag, rfp_flag = False, False  # 0 means not found, 1 mean found
     gfp_path, rfp_path = "", ""
     gfp_img_list, rfp_img_list = [], []
-    for root, subfolders, filenames in os.walk(main_dir):
+    for root, subfolders, filenames in walk_acquisition(main_dir):
         for filename in filenames:
             # print(f'Reading: {filename}')
             # filepath = os.path.join(root, filename)
@@ -305,7 +1556,7 @@ def find_3D_images(main_dir):
             if ext == "tif" or ext == "tiff":
                 if ("bf" not in og_name) and (
                     "mip" not in og_name
-                ):  # ignore BF and MIP
+                ) and not og_name.endswith(tuple(PROJECTIONS.values())):  # ignore BF, MIP and other projections
                     if ("gfp" in og_name) and (not gfp_flag):  # find GFP
                         print("GFP images found at:" + root)
                         gfp_path = root
@@ -335,87 +1586,128 @@ def find_3D_images(main_dir):
     )
 
 
-def find_lsm_scope(img_h, img_w):
+def find_lsm_scope(img_h, img_w, scope=None, ds_factor=None, interactive=True):
     """Finds LSM Scope and downscaling factor automatically using image height and width.
+    scope ('KLA'/'WIL' or 1/2) and ds_factor can be given to skip the automatic detection (e.g. from a command line),
+    with interactive=False a failed detection exits instead of asking the user.
     Returns:
+    scope_flag = LSM scope, 1 - KLA, 2 - WIL,
     ds_factor_h = downscaling factor in height,
     ds_factor_w = downscaling factor in width"""
 
-    global findscope_flag  # refer to the global var
     ds_factor_w, ds_factor_h = 1, 1
-
-    if img_w == img_h:  # probably KLA LSM
-        findscope_flag = 1
+    scope_flag = {"kla": 1, "wil": 2}.get(str(scope).casefold(), scope) if scope else None
+
+    if scope_flag is not None:  # given by the user
+        if scope_flag not in (1, 2):
+            print(f"User Error: Unknown LSM scope '{scope}', use KLA or WIL. Exiting")
+            exit(1)
+        if ds_factor:
+            ds_factor_h, ds_factor_w = ds_factor, ds_factor
+        else:  # only the scope is given, find the downscaling factor from its camera size
+            ds_factor_h = (2048 if scope_flag == 1 else 2160) // img_h
+            ds_factor_w = (2048 if scope_flag == 1 else 2560) // img_w
+
+    elif img_w == img_h:  # probably KLA LSM
+        scope_flag = 1
         ds_factor_h = 2048 // img_h
         ds_factor_w = 2048 // img_w
         r = 2048 % img_h
         if r > 0:  # implying downscaling factor is in fraction
-            findscope_flag = 0
+            scope_flag = 0
             print("Downscaling factor in fraction. Can't process automatically.")
 
     elif img_w > img_h:  # probably WIL LSM
-        findscope_flag = 2
+        scope_flag = 2
         ds_factor_h = 2160 // img_h
         ds_factor_w = 2560 // img_w
         if ds_factor_h != ds_factor_w:
-            findscope_flag = 0
+            scope_flag = 0
         r_h = 2160 % img_h
         r_w = 2560 % img_w
         if r_h > 0 or r_w > 0:  # implying downscaling factor is in fraction
-            findscope_flag = 0
+            scope_flag = 0
             print("Downscaling factor in fraction. Can't process automatically.")
+    else:
+        scope_flag = 0
 
-    if findscope_flag == 1:
+    if scope_flag == 1:
         print("LSM Scope used: KLA")
         print(f"Downscaling factor = {ds_factor_w}")
-    elif findscope_flag == 2:
+    elif scope_flag == 2:
         print("LSM Scope used: WIL")
         print(f"Downscaling factor = {ds_factor_w}")
 
-    if findscope_flag == 0:  # couldn't find scope, enter manually
+    if scope_flag == 0 and not interactive:  # unattended run, nobody to ask
+        print("ERROR: Failed to determine LSM scope automatically, give the scope and downscaling factor. Exiting")
+        exit(1)
+    if scope_flag == 0:  # couldn't find scope, enter manually
         print("ERROR: Failed to determine LSM scope automatically.\nEnter manually")
-        findscope_flag = int(
+        scope_flag = int(
             input(
                 "Enter the scope used:\n1 - KLA LSM Scope\n2 - WIL LSM Scope\nInput (1/2): "
             )
         )
-        if findscope_flag == 1 or findscope_flag == 2:
+        if scope_flag == 1 or scope_flag == 2:
             ds_factor_h = int(input("Enter the downscaling factor in height: "))
             ds_factor_w = int(input("Enter the downscaling factor in width: "))
         else:
             print("Fatal Error: Exiting")
             exit()
-    return (ds_factor_h, ds_factor_w)
-
-
-def find_stage_coords_n_pixel_width_from_2D_images(ch_flags, ch_paths, ch_img_lists):
-    """Send channel flags and paths in the order [bf, gfp, rfp]"""
-    # change global image_height and image_width
-    global img_h, img_w, new_spacing
+    return (scope_flag, ds_factor_h, ds_factor_w)
+
+
+class FishGeometry(object):
+    """Stage geometry of one fish, found by find_stage_coords_n_pixel_width_from_2D/3D_images and passed to the
+    stitchers, so several fish can be processed at the same time.
+    stage_coords: stage x, y, z of every position read from notes.txt, shape (pos_max, 3)
+    pos_max: number of positions (regions)
+    img_h, img_w: image height and width in pixels
+    scope_flag: LSM scope, 1 - KLA, 2 - WIL
+    new_spacing: pixel width (plane, row, col) in µm
+    global_coords_px: stage_coords in pixels with the first position as origin"""
+
+    def __init__(self, stage_coords, pos_max, img_h, img_w, scope_flag, new_spacing):
+        self.stage_coords = stage_coords
+        self.pos_max = pos_max
+        self.img_h, self.img_w = img_h, img_w
+        self.scope_flag = scope_flag
+        self.new_spacing = new_spacing
+        self.global_coords_px = global_coordinate_changer(stage_coords, new_spacing)
+
+
+def find_stage_coords_n_pixel_width_from_2D_images(
+    ch_flags, ch_paths, ch_img_lists, scope=None, ds_factor=None, interactive=True
+):
+    """Send channel flags and paths in the order [bf, gfp, rfp]
+    scope, ds_factor and interactive are passed to find_lsm_scope
+    Returns: FishGeometry of the fish"""
     # unpack variables
     bf_flag, gfp_flag, rfp_flag = ch_flags
     bf_path, gfp_mip_path, rfp_mip_path = ch_paths
     bf_img_list, gfp_img_list, rfp_img_list = ch_img_lists
-    # find the nearest notes.txt
-    config = configparser.ConfigParser()
     start_path = ""
     img_path = ""  # dummy
-    # get start_path for search
+    img_list = []
+    # get start_path for search of the nearest notes.txt
     # get sample image to find scope and downscaling factor
     if bf_flag:
         start_path = bf_path
         img_path = os.path.join(bf_path, bf_img_list[0])
+        img_list = bf_img_list
     elif gfp_flag:
         start_path = gfp_mip_path
         img_path = os.path.join(gfp_mip_path, gfp_img_list[0])
+        img_list = gfp_img_list
     elif rfp_flag:
         start_path = rfp_mip_path
         img_path = os.path.join(rfp_mip_path, rfp_img_list[0])
+        img_list = rfp_img_list
 
     # get sample image dimensions
-    img = tiff.imread(img_path)
-    img_h, img_w = img.shape[0], img.shape[1]
-    (ds_h, ds_w) = find_lsm_scope(img_h, img_w)
+    img_shape, _ = probe_image_shape(img_path)  # header only, no need to read the image
+    img_h, img_w = img_shape[0], img_shape[1]
+    (scope_flag, ds_h, ds_w) = find_lsm_scope(img_h, img_w, scope, ds_factor, interactive)
     new_spacing = np.array(
         [ZD, YD * ds_h, XD * ds_w]
     )  # downscale x&y by n, skimage coords = z, y, x plane, row, col
@@ -427,67 +1719,44 @@ def find_stage_coords_n_pixel_width_from_2D_images(ch_flags, ch_paths, ch_img_li
     )  # find fish number starting from the img_name
     print(f"found fish_num = {fish_num}")
 
-    target1 = "notes.txt"
-    target2 = "Notes.txt"
-    notes_path = find_nearest_target_file(
-        start_path, target1
-    ) or find_nearest_target_file(start_path, target2)
-    if notes_path is None:
-        print("Error: Can't find notes.txt, Enter manually")
-        notes_path = input("Enter complete path (should end with .txt): ")
-    config.read(notes_path)
-
-    # print(config.sections())
-    abbrev = config.getfloat(f"Fish {fish_num} Region 1", "x_pos", fallback=False)
-    if abbrev:
-        # config_prop_list = ["x_pos", "y_pos", "z_pos"]
-        config_prop_list = [
-            "x_pos",
-            "y_pos",
-            "z_stack_start_pos",
-        ]  # wil and kla stores in this format
-        print(f"abbreviated props... reading {config_prop_list}")
-    else:
-        # config_prop_list = ["x_position", "y_position", "z_position"]
-        config_prop_list = ["x_position", "y_position", "z_start_position"]
-        print(f"not abbreviated props... reading {config_prop_list}")
-    stage_coords = np.zeros(shape=(pos_max, 3))
-    for i in range(1, pos_max + 1):
-        for j, val in enumerate(config_prop_list):  # x/y/z axes
-            stage_coords[i - 1][j] = config.getfloat(f"Fish {fish_num} Region {i}", val)
-    print(f"Found stage_coords: \n{stage_coords}")
-    return stage_coords
+    pos_max = int(np.max(parse_image_filenames(img_list)[0].pos))  # number of positions
+    # the nearest notes.txt is parsed once per acquisition and shared by all fish and channels
+    stage_coords = read_stage_coords(start_path, fish_num, pos_max, interactive)
+    return FishGeometry(stage_coords, pos_max, img_h, img_w, scope_flag, new_spacing)
 
 
-def find_stage_coords_n_pixel_width_from_3D_images(ch_flags, ch_paths, ch_img_lists):
-    """Send channel flags and paths in the order [gfp, rfp]"""
-    # change global image_height and image_width
-    global img_h, img_w, new_spacing
+def find_stage_coords_n_pixel_width_from_3D_images(
+    ch_flags, ch_paths, ch_img_lists, scope=None, ds_factor=None, interactive=True
+):
+    """Send channel flags and paths in the order [gfp, rfp]
+    scope, ds_factor and interactive are passed to find_lsm_scope
+    Returns: FishGeometry of the fish"""
     # unpack variables
     gfp_flag, rfp_flag = ch_flags
     gfp_stack_path, rfp_stack_path = ch_paths
     gfp_img_list, rfp_img_list = ch_img_lists
-    # find the nearest notes.txt
-    config = configparser.ConfigParser()
     start_path = ""
     img_path = ""  # dummy
-    # get start_path for search
+    img_list = []
+    # get start_path for search of the nearest notes.txt
     # get sample image to find scope and downscaling factor
     if gfp_flag:
         start_path = gfp_stack_path
         img_path = os.path.join(start_path, gfp_img_list[0])
+        img_list = gfp_img_list
     elif rfp_flag:
         start_path = rfp_stack_path
         img_path = os.path.join(start_path, rfp_img_list[0])
+        img_list = rfp_img_list
     print(start_path)
     print(img_path)
     # get sample image dimensions
-    img = (tiff.imread(img_path))[0]  # type: ignore #get one z slice
-    if img.ndim != 2:
-        print(f"ERROR: Image dimension is {img.ndim + 1}, expected 3")
+    img_shape, _ = probe_image_shape(img_path)  # header only, no need to read the stack
+    if len(img_shape) != 3:
+        print(f"ERROR: Image dimension is {len(img_shape)}, expected 3")
         exit()
-    img_h, img_w = img.shape[0], img.shape[1]
-    (ds_h, ds_w) = find_lsm_scope(img_h, img_w)
+    img_h, img_w = img_shape[1], img_shape[2]
+    (scope_flag, ds_h, ds_w) = find_lsm_scope(img_h, img_w, scope, ds_factor, interactive)
     new_spacing = np.array(
         [ZD, YD * ds_h, XD * ds_w]
     )  # downscale x&y by n, skimage coords = z, y, x plane, row, col
@@ -499,39 +1768,13 @@ def find_stage_coords_n_pixel_width_from_3D_images(ch_flags, ch_paths, ch_img_li
     )  # find fish number starting from the img_name
     print(f"found fish_num = {fish_num}")
 
-    target1 = "notes.txt"
-    target2 = "Notes.txt"
-    notes_path = find_nearest_target_file(
-        start_path, target1
-    ) or find_nearest_target_file(start_path, target2)
-    if notes_path is None:
-        print("Error: Can't find notes.txt, Enter manually")
-        notes_path = input("Enter complete path (should end with .txt): ")
-    config.read(notes_path)
-
-    # print(config.sections())
-    abbrev = config.getfloat(f"Fish {fish_num} Region 1", "x_pos", fallback=False)
-    if abbrev:
-        # config_prop_list = ["x_pos", "y_pos", "z_pos"]
-        config_prop_list = [
-            "x_pos",
-            "y_pos",
-            "z_stack_start_pos",
-        ]  # wil and kla stores in this format
-        print(f"abbreviated props... reading {config_prop_list}")
-    else:
-        # config_prop_list = ["x_position", "y_position", "z_position"]
-        config_prop_list = ["x_position", "y_position", "z_start_position"]
-        print(f"not abbreviated props... reading {config_prop_list}")
-    stage_coords = np.zeros(shape=(pos_max, 3))
-    for i in range(1, pos_max + 1):
-        for j, val in enumerate(config_prop_list):  # x/y/z axes
-            stage_coords[i - 1][j] = config.getfloat(f"Fish {fish_num} Region {i}", val)
-    print(f"Found stage_coords: \n{stage_coords}")
-    return stage_coords
+    pos_max = int(np.max(parse_image_filenames(img_list)[0].pos))  # number of positions
+    # the nearest notes.txt is parsed once per acquisition and shared by all fish and channels
+    stage_coords = read_stage_coords(start_path, fish_num, pos_max, interactive)
+    return FishGeometry(stage_coords, pos_max, img_h, img_w, scope_flag, new_spacing)
 
 
-def global_coordinate_changer(stage_coords):
+def global_coordinate_changer(stage_coords, new_spacing):
     """Parameters: stage_coords: read from notes.txt to stitch images
                 new_spacing: contains pixel width of the images
     Returns: 2D np.array same shape as stage_coords
@@ -580,19 +1823,284 @@ def median_bg_subtraction(img_wo_bg_sub):
 
 
 def check_overflowed_stack(filename):
-    """return True if the 'filename' is a overflowed_stack else False"""
-    num = filename[filename.casefold().rfind("mmstack_") + len("mmstack_")]
-    return re.match(r"\d", num)
-
-
-def oswalk_batchprocess_mip(main_dir):
-    """Uses oswalk to find all 3D images in main_dir and create MIPs for GFP and RFP channels."""
+    """return True if the 'filename' (without extension) is a overflowed_stack else False, e.g. 'fish1_GFP_MMStack_1'
+    or 'fish1_GFP_MMStack_Pos0_1'"""
+    return re.search(r"mmstack(_pos\d+)?_\d+$", filename.casefold()) is not None
+
+
+def find_overflow_stacks(read_path):
+    """Returns: paths of the overflow files of the stack at read_path in order, e.g. 'fish1_GFP_MMStack_1.ome.tif',
+    'fish1_GFP_MMStack_2.ome.tif' for 'fish1_GFP_MMStack.ome.tif' (Micro-Manager continues a stack in a new file
+    once a file reaches 4 GB)"""
+    root, filename = os.path.split(read_path)
+    og_name, dot, exts = filename.partition(".")
+    overflow_paths = []
+    while True:
+        overflow_path = os.path.join(root, f"{og_name}_{len(overflow_paths) + 1}{dot}{exts}")
+        if not os.path.isfile(overflow_path):
+            return overflow_paths
+        overflow_paths.append(overflow_path)
+
+
+def count_stack_planes(read_path):
+    """Returns: number of planes of the tiff image at read_path with its overflow files (the planes iter_stack_planes
+    yields), from the file headers only"""
+    with tiff.TiffFile(read_path) as tif:
+        series = tif.series[0]
+        n_planes = int(np.prod(series.shape[:-2]))
+        multi_file_flag = any(page is not None and page.parent is not tif for page in series)
+    if not multi_file_flag:
+        for overflow_path in find_overflow_stacks(read_path):
+            with tiff.TiffFile(overflow_path) as tif:
+                n_planes += len(tif.pages)
+    return n_planes
+
+
+def iter_stack_planes(read_path):
+    """yields the 2D planes of the tiff image at read_path one page at a time, so only one plane is in memory.
+    Pages of a multi-file series (e.g. OME-TIFF) are read from the files the series refers to. If the series is only
+    this file, its overflow files (see find_overflow_stacks) are read after it as the rest of the stack.
+    Missing pages in a multi-file series are read as zeros."""
+    multi_file_flag = False
+    with tiff.TiffFile(read_path) as tif:
+        series = tif.series[0]
+        plane_shape, og_datatype = series.shape[-2:], series.dtype
+        for page in series:
+            if page is None:
+                yield np.zeros(plane_shape, og_datatype)
+                continue
+            multi_file_flag = multi_file_flag or page.parent is not tif
+            yield page.asarray()
+    if not multi_file_flag:
+        for overflow_path in find_overflow_stacks(read_path):
+            with tiff.TiffFile(overflow_path) as tif:
+                for page in tif.pages:
+                    yield page.asarray()
+
+
+# projections found in one pass over the planes of a z-stack (see stream_projections), saved with these suffixes in
+# '<channelname><suffix>' folders, e.g. 'gfp_meanip/fish1_GFP_meanip.tif'
+PROJECTIONS = {"max": "_mip", "min": "_minip", "mean": "_meanip", "std": "_stdip", "argmax": "_argmaxip"}
+# MIPs of z slabs are saved as one small stack per image, e.g. 'gfp_slabmip/fish1_GFP_slabmip.tif'
+SLAB_MIP_SUFFIX = "_slabmip"
+
+
+def is_projection_output(name):
+    """Returns: True if name (a folder name or a file name without extension) is a projection folder or file saved by
+    save_projections, e.g. 'gfp_mip', 'gfp_slabmip' or 'fish1_GFP_slabmip' (see PROJECTIONS and SLAB_MIP_SUFFIX),
+    which the MIP walkers must not project again"""
+    return name.casefold().endswith(tuple(PROJECTIONS.values()) + (SLAB_MIP_SUFFIX,))
+
+
+def parse_projections(text):
+    """parses comma separated projection names, e.g. 'max,mean,std' (command line and prompt answers, see PROJECTIONS)
+    Returns: list of the projection names in the order of PROJECTIONS"""
+    projections = [val.strip().casefold() for val in str(text).split(",") if val.strip()]
+    unknown = [projection for projection in projections if projection not in PROJECTIONS]
+    if unknown or not projections:
+        raise ValueError(f"'{text}' is not a comma separated list of {list(PROJECTIONS)}, e.g. 'max,mean'")
+    return [projection for projection in PROJECTIONS if projection in projections]
+
+
+def parse_slab(text):
+    """parses the slab size and optional stride in planes, e.g. '25' or '25:5' (command line and prompt answers)
+    Returns: (slab_size, slab_stride), slab_stride is None for slabs that don't overlap"""
+    size, _, stride = str(text).partition(":")
+    try:
+        slab_size, slab_stride = int(size), int(stride) if stride.strip() else None
+    except ValueError:
+        raise ValueError(f"'{text}' is not a slab size with an optional stride, e.g. '25' or '25:5'")
+    if slab_size < 1 or (slab_stride is not None and slab_stride < 1):
+        raise ValueError(f"slab size and stride in '{text}' MUST be positive integers")
+    return (slab_size, slab_stride)
+
+
+def parse_z_ranges(text):
+    """parses comma separated z ranges of planes counted from 1 (like Fiji) with both ends included, e.g. '1-50,100-150'
+    Returns: list of (start, stop) plane ranges counted from 0 with stop excluded (like python slices)"""
+    z_ranges = []
+    for val in str(text).split(","):
+        if not val.strip():
+            continue
+        start, _, stop = val.partition("-")
+        try:
+            z_ranges.append((int(start) - 1, int(stop)))
+        except ValueError:
+            raise ValueError(f"'{text}' is not a comma separated list of z ranges, e.g. '1-50,100-150'")
+        if z_ranges[-1][0] < 0 or z_ranges[-1][0] >= z_ranges[-1][1]:
+            raise ValueError(f"z range '{val}' MUST be 'first-last' with 1 <= first <= last")
+    return z_ranges
+
+
+def slab_ranges(n_planes, slab_size=None, slab_stride=None, z_ranges=None):
+    """finds the slabs of a stack of n_planes planes: slabs of slab_size planes every slab_stride planes (default
+    slab_size, i.e. no overlap) from the first plane until the last plane is in a slab (the last slab can be thinner),
+    and the z_ranges (see parse_z_ranges) clipped to the stack
+    Returns: sorted list of (start, stop) plane ranges, stop excluded"""
+    slabs = set()
+    if slab_size:
+        slab_stride = slab_stride or slab_size
+        z0 = 0
+        while True:
+            slabs.add((z0, min(z0 + slab_size, n_planes)))
+            if z0 + slab_size >= n_planes:
+                break
+            z0 += slab_stride
+    for z0, z1 in z_ranges or []:
+        z0, z1 = max(z0, 0), min(z1, n_planes)
+        if z0 < z1:
+            slabs.add((z0, z1))
+    return sorted(slabs)
+
+
+def fold_block_mip(slab_mips, slab_filled, slabs, block_start, block_mip):
+    """adds the MIP of a block of planes starting at block_start, which never crosses a slab boundary, to the MIPs of
+    the slabs it is in (see stream_projections)"""
+    for i, (z0, z1) in enumerate(slabs):
+        if z0 <= block_start < z1:
+            if slab_filled[i]:
+                np.maximum(slab_mips[i], block_mip, out=slab_mips[i])
+            else:
+                slab_mips[i] = block_mip
+                slab_filled[i] = True
+
+
+def stream_projections(read_path, projections=("max",), slab_size=None, slab_stride=None, z_ranges=None):
+    """finds the projections (see PROJECTIONS) of the z-stack at read_path in one pass over its planes, read one at a
+    time with its overflow files (see iter_stack_planes) by a reader thread a few planes ahead (see prefetch), with
+    fixed size accumulators irrespective of the number of z slices: running max/min, running mean and sum of squared deviations (Welford) for mean/std and the plane of the
+    running max for argmax
+    Returns: dict of projection name: 2D np.array, None if the image is not a z-stack.
+    max and min are in the image datatype, mean and std (of all planes, like np.std) in float32 and argmax (first
+    plane with the max value) in uint16.
+    With slab_size or z_ranges the MIPs of the slabs (see slab_ranges) are found in the same pass, as a 3D np.array
+    (slab, y, x) under the 'slab' key with the slabs in the order of slab_ranges. The stack is split in blocks at every
+    slab boundary and every plane is only added to the MIP of its block, which is then added to all the slabs over it,
+    so overlapping slabs reuse the same partial maxima instead of reading or comparing a plane once per slab."""
+    if len(probe_image_shape(read_path)[0]) != 3:
+        return None
+    slabs = []
+    if slab_size or z_ranges:
+        slabs = slab_ranges(count_stack_planes(read_path), slab_size, slab_stride, z_ranges)
+    slab_boundaries = {z for slab in slabs for z in slab}
+    slab_mips, slab_filled = None, [False] * len(slabs)
+    block_start, block_mip = None, None  # running max of the planes since the last slab boundary
+    accumulators = {}
+    n_planes = 0
+    for plane in prefetch(iter_stack_planes(read_path)):  # the next planes are read while this one is added
+        if slabs:
+            if slab_mips is None:
+                slab_mips = np.zeros((len(slabs),) + plane.shape, plane.dtype)
+            if block_mip is not None and n_planes in slab_boundaries:
+                fold_block_mip(slab_mips, slab_filled, slabs, block_start, block_mip)
+                block_mip = None
+            if block_mip is None:
+                block_start, block_mip = n_planes, plane.copy()
+            else:
+                np.maximum(block_mip, plane, out=block_mip)
+        if not n_planes:
+            if "max" in projections or "argmax" in projections:
+                accumulators["max"] = plane.copy()
+            if "argmax" in projections:
+                accumulators["argmax"] = np.zeros(plane.shape, np.uint16)
+            if "min" in projections:
+                accumulators["min"] = plane.copy()
+            if "mean" in projections or "std" in projections:
+                accumulators["mean"] = plane.astype(np.float64)
+                accumulators["m2"] = np.zeros(plane.shape, np.float64)
+        else:
+            if "argmax" in accumulators:
+                accumulators["argmax"][plane > accumulators["max"]] = n_planes
+            if "max" in accumulators:
+                np.maximum(accumulators["max"], plane, out=accumulators["max"])
+            if "min" in accumulators:
+                np.minimum(accumulators["min"], plane, out=accumulators["min"])
+            if "mean" in accumulators:
+                delta = plane - accumulators["mean"]
+                accumulators["mean"] += delta / (n_planes + 1)
+                accumulators["m2"] += delta * (plane - accumulators["mean"])
+        n_planes += 1
+    if block_mip is not None:
+        fold_block_mip(slab_mips, slab_filled, slabs, block_start, block_mip)
+
+    arr_projections = {}
+    for projection in projections:
+        if projection == "mean":
+            arr_projections[projection] = accumulators["mean"].astype(np.float32)
+        elif projection == "std":
+            arr_projections[projection] = np.sqrt(accumulators["m2"] / n_planes).astype(np.float32)
+        else:
+            arr_projections[projection] = accumulators[projection]
+    if slabs:
+        arr_projections["slab"] = slab_mips
+    return arr_projections
+
+
+def stream_mip(read_path):
+    """finds the Max Intensity Projection of the z-stack at read_path as a running maximum of its planes, read one at
+    a time with its overflow files (see stream_projections), so memory use is two planes and the PREFETCH_DEPTH planes
+    read ahead irrespective of the number of z slices
+    Returns: 2D np.array of the MIP in the image datatype, None if the image is not a z-stack"""
+    arr_projections = stream_projections(read_path, ["max"])
+    return None if arr_projections is None else arr_projections["max"]
+
+
+def projections_params_hash(codec, projections, slab_size=None, slab_stride=None, z_ranges=None):
+    """Returns: params_hash of the projection stage, the default (MIP only, no slabs) keeps the digest of earlier runs"""
+    params = {"codec": codec}
+    if list(projections) != ["max"]:
+        params["projections"] = list(projections)
+    if slab_size or z_ranges:
+        params["slabs"] = [slab_size, slab_stride or slab_size, z_ranges]
+    return params_hash(**params)
+
+
+def save_projections(filepath, arr_projections, codec=None, channel_names=("GFP", "RFP")):
+    """saves the projections of the image at filepath (see stream_projections) in '<channelname><suffix>' folders
+    next to it, e.g. 'gfp_mip' (see PROJECTIONS and SLAB_MIP_SUFFIX), if its name has one of the channel_names
+    Returns: list of the saved paths"""
+    root, filename = os.path.split(filepath)
+    filename_list = filename.split(".")
+    og_name = filename_list[0]  # first of list=name
+    ext = filename_list[-1]  # last of list=extension
+    if og_name.endswith("_MMStack"):  # remove 'MMStack' in saved name
+        og_name = og_name[: -len("_MMStack")]
+    outputs = []
+    for ch_name in channel_names:  # save the arrays in right directory with correct channel name
+        if ch_name.casefold() in og_name.casefold():
+            for projection, arr_projection in arr_projections.items():
+                suffix = SLAB_MIP_SUFFIX if projection == "slab" else PROJECTIONS[projection]
+                dest = os.path.join(root, ch_name.casefold() + suffix)
+                if not os.path.exists(dest):  # check if the dest exists
+                    print("Write path doesn't exist.")
+                    os.makedirs(dest, exist_ok=True)
+                    print(f"Directory '{ch_name.casefold()}{suffix}' created")
+                save_name = og_name + suffix + "." + ext
+                write_tiff(os.path.join(dest, save_name), arr_projection, codec)
+                outputs.append(os.path.join(dest, save_name))
+    return outputs
+
+
+def oswalk_batchprocess_mip(
+    main_dir, codec=None, projections=("max",), slab_size=None, slab_stride=None, z_ranges=None
+):
+    """Uses oswalk to find all 3D images in main_dir and create MIPs for GFP and RFP channels.
+    codec: tiff compression of the MIPs (see parse_codec), default uncompressed
+    projections: projections found together with the MIP or instead of it, each saved in its own folder
+    (see PROJECTIONS and save_projections), default only the MIP
+    slab_size, slab_stride, z_ranges: also save the MIPs of these z slabs as a stack (see slab_ranges)
+    The stacks are read one plane at a time with their overflow files (see stream_projections).
+    Images whose MIPs are up to date (see the run manifest in main_dir) are skipped"""
     print("Finding Max Intensity Projections...")
     print(
         "Warning: This code ONLY works with single channel z-stack tiff images. It will give unpredictable results with >3 dimensions"
     )
-    channel_names = ["GFP", "RFP"]
-    for root, subfolders, filenames in os.walk(main_dir):
+    manifest_path = os.path.join(main_dir, MANIFEST_NAME)
+    manifest = load_manifest(manifest_path)
+    params_digest = projections_params_hash(codec, projections, slab_size, slab_stride, z_ranges)
+    for root, subfolders, filenames in walk_acquisition(main_dir):
+        # skip the saved projections, the slab MIP stacks would be projected again into nested folders on every run
+        subfolders[:] = [sub for sub in subfolders if not is_projection_output(sub)]
         for filename in filenames:
             # print(f'Reading: {filename}')
             filepath = os.path.join(root, filename)
@@ -602,43 +2110,42 @@ def oswalk_batchprocess_mip(main_dir):
             ext = filename_list[-1]  # last of list=extension
 
             if (ext == "tif" or ext == "tiff") and (
-                not check_overflowed_stack(og_name)
-            ):  # tiff files which are not spilled-over stacks
-                read_image = tiff.imread(filepath)
-                if len(read_image.shape) == 3:  # check if 3D images
+                not check_overflowed_stack(og_name) and not is_projection_output(og_name)
+            ):  # tiff files which are not spilled-over stacks or projections
+                read_paths = [filepath] + find_overflow_stacks(filepath)
+                if is_up_to_date(manifest, "mip", read_paths, params_digest):
+                    continue
+                outputs = []  # saved MIPs, for the run manifest
+                # one plane and the accumulators in memory, not the whole stack
+                arr_projections = stream_projections(filepath, projections, slab_size, slab_stride, z_ranges)
+                if arr_projections is not None:  # check if 3D images
                     print(f"Processing MIP for: {filepath}")
-                    arr_mip = np.max(read_image, axis=0)  # create MIP
                     # arr_mip_wo_bg_sub = np.max(read_image, axis=0) #create MIP
                     # arr_mip = median_bg_subtraction(arr_mip_wo_bg_sub)
-                    for (
-                        ch_name
-                    ) in (
-                        channel_names
-                    ):  # save mip array in right directory with correct channel name
-                        if ch_name.casefold() in og_name.casefold():
-                            dest = os.path.join(root, ch_name.casefold() + "_mip")
-                            if not os.path.exists(dest):  # check if the dest exists
-                                print("Write path doesn't exist.")
-                                os.makedirs(dest)
-                                print(f"Directory '{ch_name.casefold()}_mip' created")
-                            # the downsampling algorithm produces float values,
-                            # so recast the ds image to the original datatype
-                            img_mip = np.round(arr_mip).astype(read_image.dtype)
-
-                            if og_name.endswith(
-                                "_MMStack"
-                            ):  # remove 'MMStack' in saved name
-                                save_name = og_name[: -len("_MMStack")] + "_mip." + ext
-                            else:
-                                save_name = og_name + "_mip." + ext
-                            tiff.imwrite(os.path.join(dest, save_name), img_mip)
+                    outputs = save_projections(filepath, arr_projections, codec)
+                append_manifest(manifest_path, "mip", read_paths, params_digest, outputs)
 
 
-def img_stitcher_2D(global_coords_px, img_list):
-    """accept a list of 2D images in img_list and use stage_coords read from notes.txt to stitch images
+def img_stitcher_2D(fish_geometry, img_list):
+    """accept a list of 2D images in img_list and use the fish_geometry (stage_coords read from notes.txt) to stitch images
+    The images can be np.arrays or SharedArraySpec of shared memory blocks filled by other processes (see
+    create_shared_array), which are read in place.
     Returns: 2D np.array containing the stitched image
     """
-    if findscope_flag == 0:
+    with contextlib.ExitStack() as stack:
+        img_list = [
+            stack.enter_context(attach_shared_array(img)) if isinstance(img, SharedArraySpec) else img
+            for img in img_list
+        ]
+        stitched_images = _img_stitcher_2D(fish_geometry, img_list)
+        del img_list  # the shared blocks can only be closed once no array uses them
+    return stitched_images
+
+
+def _img_stitcher_2D(fish_geometry, img_list):
+    """img_stitcher_2D of a list of np.arrays"""
+    global_coords_px, scope_flag = fish_geometry.global_coords_px, fish_geometry.scope_flag
+    if scope_flag == 0:
         print("ERROR: Couldn't find the LSM scope")
         exit()
     # poses = np.shape(img_list)[0]
@@ -648,10 +2155,10 @@ def img_stitcher_2D(global_coords_px, img_list):
 
     # stitched image ax0 is going down, ax1 is to the right
     ax0_offset, ax1_offset = [], []
-    if findscope_flag == 2:  # wil lsm, stitch horizontally
+    if scope_flag == 2:  # wil lsm, stitch horizontally
         ax0_offset = global_coords_px[:, 0] * -1  # ax0 = -Global X_DV
         ax1_offset = global_coords_px[:, 1]  # ax1 = Global Y_AP
-    elif findscope_flag == 1:  # kla lsm, stitch vertically
+    elif scope_flag == 1:  # kla lsm, stitch vertically
         ax0_offset = global_coords_px[:, 1]  # ax0 = Global Y_AP
         ax1_offset = global_coords_px[:, 0]  # ax1 = Global X_DV
 
@@ -687,32 +2194,54 @@ def img_stitcher_2D(global_coords_px, img_list):
     return (stitched_image, stitched_image_bg_sub)
 
 
-def img_stitcher_3D(global_coords_px, img_path_list, bg_sub=True, save_path=None, compression_type=None):
-    """Accept a list of 3D image paths in img_path_list and use global_coords_px to stitch images.
-    Returns: 3D np.array containing the stitched image.
+def stitch_2D_single_timepoint(
+    ch_path, img_names, fish_geometry, save_paths, ref_img_histogram=None, tile_size=None, codec=None
+):
+    """reads the 2D images of all pos of one timepoint (img_names) from ch_path, stitches them and saves
+    save_paths = (stitched png path, bg subtracted and rescaled png path), paths ending with '.zarr' are saved as
+    OME-Zarr pyramids and paths ending with '.tif' as tiffs with the codec string codec (see parse_codec), tiled if
+    tile_size is given (see write_tiff).
+    The bg subtracted image is histogram matched to ref_img_histogram; without a reference it is saved as is.
+    Returns: the bg subtracted stitched image if no ref_img_histogram was given (i.e. this is the reference), else None
     """
-    if findscope_flag == 0:
-        print("ERROR: Couldn't find the LSM scope")
-        exit()
-
-    # Read the first image to get the shape and datatype
-    first_img = tiff.imread(img_path_list[0])
-    if len(first_img.shape) != 3:
-        print(
-            f"{img_path_list[0]}: Image shape is not 3D... something is wrong. exiting..."
-        )
-        exit()
-
-    og_datatype = first_img.dtype
-    img_height = first_img.shape[1]
-    img_width = first_img.shape[2]
-    z_width = [tiff.imread(img_path).shape[0] for img_path in img_path_list]
-
+    img_list_per_tp = []
+    for img_name in img_names:
+        img = tiff.imread(os.path.join(ch_path, img_name))
+        if len(img.shape) != 2:
+            raise ValueError(f"{img_name}: Image shape is not 2D... something is wrong")
+        img_list_per_tp.append(img)
+
+    stitched_img, stitched_img_bgsub = img_stitcher_2D(fish_geometry, img_list_per_tp)
+    # By default, the min/max intensities of the input image are stretched to the limits allowed by the image’s dtype, since in_range defaults to ‘image’ and out_range defaults to ‘dtype’:
+    # stitched_img_bgsub_rescaled = skimage.exposure.rescale_intensity(stitched_img_bgsub) #produces images with pulsing mean intensity
+
+    # use histogram matching using the first image
+    if ref_img_histogram is None:  # this is the reference image
+        stitched_img_bgsub_rescaled = stitched_img_bgsub
+    else:  # match the histogram to the reference image
+        stitched_img_bgsub_rescaled = (
+            skimage.exposure.match_histograms(image=stitched_img_bgsub, reference=ref_img_histogram)
+        ).astype(stitched_img_bgsub.dtype)
+
+    for save_path, img in zip(save_paths, (stitched_img, stitched_img_bgsub_rescaled)):
+        if save_path.endswith(".zarr"):  # OME-Zarr pyramid
+            write_ome_zarr(save_path, [img], img.shape, img.dtype, pixel_spacing=fish_geometry.new_spacing)
+        elif save_path.endswith((".tif", ".tiff")):
+            write_tiff(save_path, img, codec, tile_size=tile_size)
+        else:  # save the stitched image and the bg subtracted stitched image
+            save_image(save_path, img)
+    return stitched_img_bgsub if ref_img_histogram is None else None
+
+
+def find_stitch_offsets_3D(fish_geometry, img_height, img_width, z_width):
+    """finds the offset of every 3D image in the stitched image and the shape of the stitched image
+    Returns: (z_offset, ax0_offset, ax1_offset), (z_max, ax0_max, ax1_max)"""
+    global_coords_px = fish_geometry.global_coords_px
     # Determine offsets based on the scope type
-    if findscope_flag == 2:  # wil lsm, stitch horizontally
+    if fish_geometry.scope_flag == 2:  # wil lsm, stitch horizontally
         ax0_offset = global_coords_px[:, 0] * -1  # ax0 = -Global X_DV
         ax1_offset = global_coords_px[:, 1]  # ax1 = Global Y_AP
-    elif findscope_flag == 1:  # kla lsm, stitch vertically
+    elif fish_geometry.scope_flag == 1:  # kla lsm, stitch vertically
         ax0_offset = global_coords_px[:, 1]  # ax0 = Global Y_AP
         ax1_offset = global_coords_px[:, 0]  # ax1 = Global X_DV
     z_offset = global_coords_px[:, 2]  # ax2 = Global Z_lr
@@ -726,13 +2255,120 @@ def img_stitcher_3D(global_coords_px, img_path_list, bg_sub=True, save_path=None
     ax0_max = img_height + np.max(ax0_offset)
     ax1_max = img_width + np.max(ax1_offset)
     z_max = np.max(z_width) + np.max(z_offset)
+    return (z_offset, ax0_offset, ax1_offset), (z_max, ax0_max, ax1_max)
+
+
+def plan_stitch_3D(fish_geometry, img_path_list):
+    """finds the stitched image shape and the box of every 3D image in it from the image headers
+    Returns: (stitched shape, datatype, list of boxes), a box is a tuple of (start, stop) for every axis"""
+    if fish_geometry.scope_flag == 0:
+        print("ERROR: Couldn't find the LSM scope")
+        exit()
+
+    # Get the shape and datatype from the image headers
+    first_img_shape, og_datatype = probe_image_shape(img_path_list[0])
+    if len(first_img_shape) != 3:
+        print(
+            f"{img_path_list[0]}: Image shape is not 3D... something is wrong. exiting..."
+        )
+        exit()
+
+    img_height = first_img_shape[1]
+    img_width = first_img_shape[2]
+    z_width = [probe_image_shape(img_path)[0][0] for img_path in img_path_list]
+
+    (z_offset, ax0_offset, ax1_offset), stitched_shape = find_stitch_offsets_3D(
+        fish_geometry, img_height, img_width, z_width
+    )
+    boxes = [
+        ((int(z0), int(z0) + z_len), (int(h0), int(h0) + img_height), (int(w0), int(w0) + img_width))
+        for z0, h0, w0, z_len in zip(z_offset, ax0_offset, ax1_offset, z_width)
+    ]
+    return tuple(int(ax_max) for ax_max in stitched_shape), og_datatype, boxes
+
+
+def subtract_box(box, cut):
+    """Returns: list of disjoint boxes covering box minus cut, boxes are tuples of (start, stop) for every axis"""
+    if any(start >= cut_stop or stop <= cut_start for (start, stop), (cut_start, cut_stop) in zip(box, cut)):
+        return [box]  # no overlap
+    pieces, rest = [], list(box)
+    for axis, ((start, stop), (cut_start, cut_stop)) in enumerate(zip(box, cut)):
+        # the parts of the box before and after the cut on this axis, the rest is narrowed to the overlap
+        if start < cut_start:
+            pieces.append(tuple(rest[:axis] + [(start, cut_start)] + rest[axis + 1 :]))
+        if cut_stop < stop:
+            pieces.append(tuple(rest[:axis] + [(cut_stop, stop)] + rest[axis + 1 :]))
+        rest[axis] = (max(start, cut_start), min(stop, cut_stop))
+    return pieces
+
+
+def owned_boxes(boxes):
+    """boxes: box of every tile in the stitched image, in stitching order (later tiles overwrite the overlap)
+    Returns: for every tile, the disjoint boxes of the stitched image it sets, i.e. its box minus the boxes of all later
+    tiles. Placing only these, the tiles can be placed in any order or at the same time with the same result"""
+    owned = []
+    for i, box in enumerate(boxes):
+        pieces = [box]
+        for later_box in boxes[i + 1 :]:
+            pieces = [piece for kept in pieces for piece in subtract_box(kept, later_box)]
+        owned.append(pieces)
+    return owned
+
+
+def place_tile(stitched_image, tile, tile_box, owned=None):
+    """copies tile into its tile_box of stitched_image, only the owned boxes of it (see owned_boxes) if given"""
+    for piece in owned if owned is not None else [tile_box]:
+        stitched_image[tuple(slice(start, stop) for start, stop in piece)] = tile[
+            tuple(slice(start - box_start, stop - box_start) for (start, stop), (box_start, _) in zip(piece, tile_box))
+        ]
+
+
+def place_tile_3D(stitched_spec, img_path, tile_box, owned=None, bg_sub=True):
+    """reads the 3D image at img_path, subtracts its background if bg_sub and places it in the stitched image in the
+    shared memory block stitched_spec (see create_shared_array and place_tile), so worker processes place their tiles
+    straight into the stitched image without sending any pixels back"""
+    img = read_tiff_stack(img_path)
+    if len(img.shape) != 3:
+        raise ValueError(f"{img_path}: Image shape is not 3D... something is wrong")
+    if bg_sub:
+        img = median_bg_subtraction(img)
+    with attach_shared_array(stitched_spec) as stitched_image:
+        place_tile(stitched_image, img, tile_box, owned)
+        del stitched_image  # the shared block can only be closed once no array uses it
+
+
+def save_stitched_3D(stitched_image, fish_geometry, save_path, compression_type=None, tile_size=None):
+    """saves the stitched image at save_path (as an OME-Zarr pyramid if it ends with '.zarr', else a BigTIFF
+    compressed with the codec string compression_type and tiled if tile_size is given, see write_tiff)"""
+    if save_path.endswith(".zarr"):  # OME-Zarr pyramid
+        write_ome_zarr(
+            save_path,
+            stitched_image,
+            stitched_image.shape,
+            stitched_image.dtype,
+            pixel_spacing=fish_geometry.new_spacing,
+        )
+    else:
+        write_tiff(save_path, stitched_image, compression_type, tile_size=tile_size, bigtiff=True)
+
+
+def img_stitcher_3D(
+    fish_geometry, img_path_list, bg_sub=True, save_path=None, compression_type=None, tile_size=None
+):
+    """Accept a list of 3D image paths in img_path_list and use the fish_geometry to stitch images.
+    If save_path is given the stitched image is saved there (as an OME-Zarr pyramid if it ends with '.zarr'),
+    tiffs are compressed with the codec string compression_type (see parse_codec, e.g. 'Deflate' or 'zstd:3+predictor')
+    and saved in tiles if tile_size is given (see write_tiff).
+    Returns: 3D np.array containing the stitched image.
+    """
+    stitched_shape, og_datatype, boxes = plan_stitch_3D(fish_geometry, img_path_list)
 
     # Create empty stitched image
-    stitched_image = np.zeros([z_max, ax0_max, ax1_max], dtype=og_datatype)
+    stitched_image = np.zeros(stitched_shape, dtype=og_datatype)
 
     # Process and stitch images one by one
-    for i, img_path in enumerate(img_path_list):
-        img = tiff.imread(img_path)
+    for img_path, tile_box in zip(img_path_list, boxes):
+        img = read_tiff_stack(img_path)
         if len(img.shape) != 3:
             print(
                 f"{img_path}: Image shape is not 3D... something is wrong. exiting..."
@@ -742,10 +2378,7 @@ def img_stitcher_3D(global_coords_px, img_path_list, bg_sub=True, save_path=None
         if bg_sub:
             img = median_bg_subtraction(img)
 
-        z0, h0, w0 = z_offset[i], ax0_offset[i], ax1_offset[i]
-        stitched_image[
-            z0 : z0 + z_width[i], h0 : h0 + img_height, w0 : w0 + img_width
-        ] = img
+        place_tile(stitched_image, img, tile_box)
 
     # Additional check
     if stitched_image.dtype != og_datatype:
@@ -753,7 +2386,88 @@ def img_stitcher_3D(global_coords_px, img_path_list, bg_sub=True, save_path=None
 
     # Save the stitched image if save_path is provided
     if save_path:
-        tiff.imwrite(save_path, data=stitched_image, compression=compression_type, bigtiff=True)
+        save_stitched_3D(stitched_image, fish_geometry, save_path, compression_type, tile_size)
         return None
     else:
         return stitched_image
+
+
+def stream_median(series):
+    """finds the median pixel intensity of the tiff series page by page (same value as np.median of the whole image).
+    Integer images are counted in a histogram so only one page is in memory at a time."""
+    if not (np.issubdtype(series.dtype, np.unsignedinteger) and np.dtype(series.dtype).itemsize <= 2):
+        return np.median(series.asarray())
+    hist = np.zeros(2 ** (8 * np.dtype(series.dtype).itemsize), dtype=np.int64)
+    for page in series:
+        if page is not None:
+            hist += np.bincount(page.asarray().ravel(), minlength=len(hist))
+    cum_hist = np.cumsum(hist)
+    total = cum_hist[-1]
+    # np.median averages the two middle values for an even number of pixels
+    lower = np.searchsorted(cum_hist, (total - 1) // 2 + 1)
+    upper = np.searchsorted(cum_hist, total // 2 + 1)
+    return np.float64(lower + upper) / 2
+
+
+def img_stitcher_3D_streaming(
+    fish_geometry, img_path_list, save_path, bg_sub=True, compression_type=None, tile_size=None
+):
+    """Out-of-core version of img_stitcher_3D: stitches the 3D images in img_path_list and saves the stitched
+    image at save_path (BigTIFF, or OME-Zarr pyramid if it ends with '.zarr') one z plane at a time, without holding
+    the stitched volume in memory.
+    The stitched shape is found from the tiff headers and every image plane is read once, when its output
+    plane is written (images with bg_sub are read once more to find their median).
+    compression_type: tiff codec string, see parse_codec. tile_size: tile width of tiled tiffs, see write_tiff"""
+    if fish_geometry.scope_flag == 0:
+        print("ERROR: Couldn't find the LSM scope")
+        exit()
+
+    img_shape_list = [probe_image_shape(img_path)[0] for img_path in img_path_list]
+    for img_path, img_shape in zip(img_path_list, img_shape_list):
+        if len(img_shape) != 3:
+            print(f"{img_path}: Image shape is not 3D... something is wrong. exiting...")
+            exit()
+    og_datatype = probe_image_shape(img_path_list[0])[1]
+    img_height, img_width = img_shape_list[0][1], img_shape_list[0][2]
+    z_width = [img_shape[0] for img_shape in img_shape_list]
+
+    with contextlib.ExitStack() as stack:
+        series_list = [stack.enter_context(tiff.TiffFile(img_path)).series[0] for img_path in img_path_list]
+        (z_offset, ax0_offset, ax1_offset), stitched_shape = find_stitch_offsets_3D(
+            fish_geometry, img_height, img_width, z_width
+        )
+        stitched_shape = tuple(int(ax_max) for ax_max in stitched_shape)
+        bg_list = [stream_median(series) if bg_sub else None for series in series_list]
+
+        def stitched_planes():
+            for z in range(stitched_shape[0]):
+                stitched_plane = np.zeros(stitched_shape[1:], dtype=og_datatype)
+                # same order as img_stitcher_3D, later images overwrite the overlap
+                for i, series in enumerate(series_list):
+                    if not (z_offset[i] <= z < z_offset[i] + z_width[i]):
+                        continue
+                    page = series[z - z_offset[i]]
+                    if page is None:  # missing page in a multi-file series
+                        continue
+                    img_plane = page.asarray()
+                    if bg_sub:  # subtract the median of the whole image, like median_bg_subtraction
+                        img_plane = img_plane - bg_list[i]
+                        img_plane[img_plane < 0] = 0
+                    h0, w0 = ax0_offset[i], ax1_offset[i]
+                    stitched_plane[h0 : h0 + img_height, w0 : w0 + img_width] = img_plane
+                yield stitched_plane
+
+        if save_path.endswith(".zarr"):  # OME-Zarr pyramid, written plane by plane as well
+            write_ome_zarr(
+                save_path, stitched_planes(), stitched_shape, og_datatype, pixel_spacing=fish_geometry.new_spacing
+            )
+        else:
+            write_tiff(
+                save_path,
+                stitched_planes(),
+                compression_type,
+                tile_size=tile_size,
+                shape=stitched_shape,
+                dtype=og_datatype,
+                bigtiff=True,
+            )